@@ -1,25 +1,320 @@
-from flask import Flask, Response, request
+from flask import Flask, Response, g, request, stream_with_context
 from flask_pymongo import PyMongo
 from datetime import datetime
+from cache import Generation, KnownIds, ResponseCache
+from ids import IdAllocator
+from serialize import CITY_FIELDS, CITY_TEMPERATURE_FIELDS, COUNTRY_FIELDS, JSON_MIMETYPE, TEMPERATURE_FIELDS, dumps, format_city, format_country, format_temperatures, json_array_chunks, parse_timestamp, utcnow
+import storage
+import changes
+import rollups
+import plans
+import queries
+import jobs
+import export
+import importer
+import ingest
+import live
+import metrics
+import argparse
 import json
+import os
+import threading
 import time
 
 # init flask app
 app = Flask(__name__)
 
 # init mongo db
-app.config["MONGO_URI"] = "mongodb://mongo:27017/tema2scd"
-mongo = PyMongo(app)
+app.config["MONGO_URI"] = os.environ.get("MONGO_URI", "mongodb://mongo:27017/tema2scd")
+
+# MongoClient pool settings: each worker process has its own pool
+def mongo_options():
+    return {
+        "maxPoolSize" : int(os.environ.get("MONGO_MAX_POOL_SIZE", 100)),
+        "minPoolSize" : int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        "maxIdleTimeMS" : int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 60000)),
+        "waitQueueTimeoutMS" : int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000)),
+        "connectTimeoutMS" : int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+        "serverSelectionTimeoutMS" : int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+        "socketTimeoutMS" : int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 30000)),
+        # count and time every mongo command (see metrics.py)
+        "event_listeners" : [metrics.command_listener]
+    }
+
+mongo = PyMongo(app, **mongo_options())
+
+# init the temperatures store: collection (default, one document per reading),
+# timeseries (MongoDB time-series collection, needs MongoDB 7.0+),
+# buckets (one document per city and day, see storage.BucketStore)
+# or partitioned (one collection per month, see storage.PartitionedStore)
+# on a sharded cluster (MONGO_URI of a mongos), TEMPERATURES_SHARD_KEY=range|hashed shards
+# the readings of the collection layout by city (see storage.SHARD_KEYS)
+app.config["TEMPERATURES_STORAGE"] = os.environ.get("TEMPERATURES_STORAGE", "collection")
+app.config["TEMPERATURES_SHARD_KEY"] = os.environ.get("TEMPERATURES_SHARD_KEY") or None
+temperature_store = storage.create_store(
+    mongo, app.config["TEMPERATURES_STORAGE"], shard_key = app.config["TEMPERATURES_SHARD_KEY"]
+)
+
+# init id allocators (counters-backed, one per collection)
+# ids are reserved from the counter in blocks of ID_BLOCK_SIZE and handed out in memory
+app.config["ID_BLOCK_SIZE"] = int(os.environ.get("ID_BLOCK_SIZE", 1))
+country_ids = IdAllocator(mongo, "countries", app.config["ID_BLOCK_SIZE"])
+city_ids = IdAllocator(mongo, "cities", app.config["ID_BLOCK_SIZE"])
+temperature_ids = IdAllocator(mongo, "temperatures", app.config["ID_BLOCK_SIZE"])
+# change sequence of the readings (see changes.py): one seq per write, never in blocks
+change_seqs = IdAllocator(mongo, changes.COUNTER)
+
+# max number of readings accepted by one bulk request
+app.config["BULK_MAX_ITEMS"] = int(os.environ.get("BULK_MAX_ITEMS", 10000))
+
+# max page size of the temperature queries and number of entries per streamed chunk
+app.config["PAGE_MAX_LIMIT"] = int(os.environ.get("PAGE_MAX_LIMIT", 10000))
+app.config["STREAM_CHUNK_SIZE"] = int(os.environ.get("STREAM_CHUNK_SIZE", 1000))
+# readings per chunk of the exports (and per batch read from mongo)
+app.config["EXPORT_BATCH_SIZE"] = int(os.environ.get("EXPORT_BATCH_SIZE", 10000))
+# most cities in one batch read (route 21)
+app.config["BATCH_MAX_CITIES"] = int(os.environ.get("BATCH_MAX_CITIES", 1000))
+
+# init the cache of the countries/cities lists (serialized JSON, with ETag)
+# set CACHE_REDIS_URL to share it between all the workers, otherwise every worker keeps its
+# own and the writes of any worker invalidate all of them (through the reference generation,
+# read from mongo at most every REFERENCE_MAX_AGE seconds: a change made by another worker
+# is seen within that time, the lookups in between don't query mongo)
+app.config["REFERENCE_MAX_AGE"] = float(os.environ.get("REFERENCE_MAX_AGE", 0.5))
+reference_generation = Generation(mongo, "reference", app.config["REFERENCE_MAX_AGE"])
+reference_cache = ResponseCache(
+    max_entries = int(os.environ.get("CACHE_MAX_ENTRIES", 256)),
+    ttl = int(os.environ.get("CACHE_TTL", 60)),
+    redis_url = os.environ.get("CACHE_REDIS_URL"),
+    generation = reference_generation
+)
+
+# init the background jobs (cascading deletes), run by a thread pool in each worker
+app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS", 1))
+app.config["JOB_TTL"] = int(os.environ.get("JOB_TTL", 24 * 3600))
+# a job whose heartbeat is older than JOB_STALE_AFTER seconds was left by a stopped worker
+# and is run again by another one (see jobs.JobRunner)
+app.config["JOB_STALE_AFTER"] = int(os.environ.get("JOB_STALE_AFTER", 60))
+
+# since=<seq> sync: tombstones of deleted readings are kept TOMBSTONE_TTL seconds, and only
+# the changes older than SYNC_SETTLE seconds are sent
+app.config["TOMBSTONE_TTL"] = int(os.environ.get("TOMBSTONE_TTL", 30 * 24 * 3600))
+app.config["SYNC_SETTLE"] = float(os.environ.get("SYNC_SETTLE", 2))
+job_runner = jobs.JobRunner(mongo, app.config["JOB_WORKERS"], app.config["JOB_STALE_AFTER"])
+
+# every worker starts its job monitor on its first request, so the jobs of a stopped worker
+# are taken over even by the workers that never start a job
+@app.before_request
+def start_job_runner():
+    job_runner.start()
+
+# init the maps of existing countries/cities used by the foreign key checks
+# (cities keep their country id, needed by every temperature write)
+# every country/city write bumps the reference generation (reference_cache.clear()), so the
+# maps of the other workers are reloaded on their first check after REFERENCE_MAX_AGE
+app.config["KNOWN_IDS_REFRESH"] = int(os.environ.get("KNOWN_IDS_REFRESH", 30))
+known_countries = KnownIds(mongo, "countries", refresh = app.config["KNOWN_IDS_REFRESH"], generation = reference_generation)
+known_cities = KnownIds(mongo, "cities", ["id_tara"], refresh = app.config["KNOWN_IDS_REFRESH"], generation = reference_generation)
+
+# live updates (route 22): subscribers per worker, readings kept for a slow subscriber,
+# polling interval and window (seconds) without a replica set, and the keep-alive interval
+# of idle streams
+# each subscriber holds a thread of the gthread worker (GUNICORN_THREADS, see gunicorn.conf.py)
+# until it disconnects, so at most threads - 1 are accepted: one thread is always left for
+# the other routes; many listeners are served by route 22 of the async app (app_async.py),
+# where a subscriber holds no thread
+app.config["GUNICORN_THREADS"] = int(os.environ.get("GUNICORN_THREADS", 4))
+app.config["LIVE_MAX_SUBSCRIBERS"] = min(
+    int(os.environ.get("LIVE_MAX_SUBSCRIBERS", app.config["GUNICORN_THREADS"] - 1)),
+    app.config["GUNICORN_THREADS"] - 1
+)
+app.config["LIVE_QUEUE_SIZE"] = int(os.environ.get("LIVE_QUEUE_SIZE", 1000))
+app.config["LIVE_POLL_INTERVAL"] = float(os.environ.get("LIVE_POLL_INTERVAL", 1))
+app.config["LIVE_POLL_LAG"] = float(os.environ.get("LIVE_POLL_LAG", 5))
+app.config["LIVE_KEEPALIVE"] = float(os.environ.get("LIVE_KEEPALIVE", 15))
+live_updates = live.LiveUpdates(
+    temperature_store,
+    max_subscribers = app.config["LIVE_MAX_SUBSCRIBERS"],
+    queue_size = app.config["LIVE_QUEUE_SIZE"],
+    poll_interval = app.config["LIVE_POLL_INTERVAL"],
+    lag = app.config["LIVE_POLL_LAG"]
+)
+
+# buffered ingestion (route 10, see ingest.py): with INGEST_BUFFERED=true a new reading is
+# queued and written by a background thread in group commits, the route returns 202 (429
+# when INGEST_QUEUE_SIZE readings are already queued in the worker); INGEST_JOURNAL_DIR
+# keeps the queued readings in a local journal too, replayed after a crash: at startup and
+# by every new worker (the replacement of a crashed worker writes what it left)
+app.config["INGEST_BUFFERED"] = os.environ.get("INGEST_BUFFERED", "false").lower() in ("1", "true")
+app.config["INGEST_QUEUE_SIZE"] = int(os.environ.get("INGEST_QUEUE_SIZE", 10000))
+app.config["INGEST_BATCH_SIZE"] = int(os.environ.get("INGEST_BATCH_SIZE", 500))
+app.config["INGEST_FLUSH_INTERVAL"] = float(os.environ.get("INGEST_FLUSH_INTERVAL", 0.05))
+app.config["INGEST_JOURNAL_DIR"] = os.environ.get("INGEST_JOURNAL_DIR")
+app.config["INGEST_JOURNAL_FSYNC"] = os.environ.get("INGEST_JOURNAL_FSYNC", "false").lower() in ("1", "true")
+app.config["INGEST_SHUTDOWN_TIMEOUT"] = float(os.environ.get("INGEST_SHUTDOWN_TIMEOUT", 10))
+write_behind = ingest.WriteBehind(
+    mongo, temperature_store, change_seqs,
+    queue_size = app.config["INGEST_QUEUE_SIZE"],
+    batch_size = app.config["INGEST_BATCH_SIZE"],
+    flush_interval = app.config["INGEST_FLUSH_INTERVAL"],
+    journal_dir = app.config["INGEST_JOURNAL_DIR"],
+    journal_fsync = app.config["INGEST_JOURNAL_FSYNC"],
+    shutdown_timeout = app.config["INGEST_SHUTDOWN_TIMEOUT"]
+)
+
+# per-request metrics (see metrics.py); with the X-Profile: 1 request header, the response
+# has a Server-Timing header with the time spent in mongo, in serialization and in the app
+# (streamed responses are timed until their first chunk)
+app.config["PROFILING"] = os.environ.get("PROFILING", "true").lower() in ("1", "true")
+
+@app.before_request
+def start_request_metrics():
+    g.start = time.perf_counter()
+    if app.config["PROFILING"] and request.headers.get("X-Profile") == "1":
+        g.profile = metrics.start_profile()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.request_duration.labels(route, request.method, response.status_code).observe(time.perf_counter() - g.start)
+
+    if not response.is_streamed:
+        metrics.response_size.labels(route).observe(response.calculate_content_length() or 0)
+    if "rows" in g:
+        metrics.response_rows.labels(route).observe(g.rows)
+
+    if "profile" in g:
+        response.headers["Server-Timing"] = g.profile.server_timing()
+    return response
+
+@app.teardown_request
+def stop_request_profile(error):
+    metrics.stop_profile()
+
+# Prometheus metrics of all the workers (see metrics.py)
+@app.route('/metrics', methods = ['GET'])
+def get_metrics():
+    return Response(metrics.render(), status = 200, content_type = metrics.CONTENT_TYPE)
 
 # config indexes on mongo db
 def configure_mongodb():
     try:
+        # ids are looked up on every route
+        mongo.db.countries.create_index("id", unique=True)
+        mongo.db.cities.create_index("id", unique=True)
         mongo.db.countries.create_index("nume_tara", unique=True)
         mongo.db.cities.create_index([("id_tara", 1), ("nume_oras", 1)], unique=True)
-        mongo.db.temperatures.create_index([("id_oras", 1), ("timestamp", 1)], unique=True)
+        # covered reads of the countries/cities lists (all the fields sent, in id order)
+        mongo.db.countries.create_index([("id", 1), ("nume_tara", 1), ("latitudine", 1), ("longitudine", 1)])
+        mongo.db.cities.create_index([("id", 1), ("id_tara", 1), ("nume_oras", 1), ("latitudine", 1), ("longitudine", 1)])
+        mongo.db.cities.create_index([("id_tara", 1), ("id", 1), ("nume_oras", 1), ("latitudine", 1), ("longitudine", 1)])
     except Exception as e:
         print(e)
 
+    # temperatures collection and indexes, depending on the storage layout
+    # (a collection of another layout stops the app, see migrate-storage)
+    temperature_store.configure()
+
+    # config location indexes: exact lat/lon filters (covering the id lookups of route 11)
+    # and GeoJSON points for near/bbox queries
+    for collection in (mongo.db.countries, mongo.db.cities):
+        collection.create_index([("latitudine", 1), ("longitudine", 1), ("id", 1)])
+        collection.create_index([("longitudine", 1), ("id", 1)])
+        collection.create_index([("location", "2dsphere")])
+
+        # add the GeoJSON point to the entries stored before it existed
+        collection.update_many(
+            {
+                "location" : {"$exists" : False},
+                "latitudine" : {"$gte" : -90, "$lte" : 90},
+                "longitudine" : {"$gte" : -180, "$lte" : 180}
+            },
+            [{"$set" : {"location" : {"type" : "Point", "coordinates" : ["$longitudine", "$latitudine"]}}}]
+        )
+
+    # config rollup collections
+    rollups.configure(mongo.db)
+    jobs.configure(mongo.db, app.config["JOB_TTL"])
+    changes.configure(mongo.db, app.config["TOMBSTONE_TTL"])
+
+    # seed the id counters from the existing max ids
+    country_ids.seed()
+    city_ids.seed()
+    temperature_ids.seed(temperature_store.max_id())
+    change_seqs.seed(changes.max_seq(mongo.db, temperature_store))
+
+    # give a change sequence to the readings stored before it existed (the since=<seq>
+    # sync reads the collection layout only)
+    if temperature_store.mode == "collection":
+        changes.restamp(temperature_store.collection, change_seqs, {"seq" : None}, changed = changes.EPOCH)
+
+    replay_journals()
+
+    # warm the maps of existing countries/cities
+    known_countries.load()
+    known_cities.load()
+
+
+# GeoJSON point of an entry, None if the coordinates are out of range (the entry then has no location)
+def geo_point(lat, lon):
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return {"type" : "Point", "coordinates" : [lon, lat]}
+
+# $set/$unset of the coordinates of an entry, keeping its GeoJSON point in sync
+def location_update(fields, lat, lon):
+    fields = dict(fields, latitudine = lat, longitudine = lon)
+    point = geo_point(lat, lon)
+    if point:
+        return {"$set" : dict(fields, location = point)}
+    return {"$set" : fields, "$unset" : {"location" : ""}}
+
+def json_response(data, status = 200):
+    if isinstance(data, list):
+        g.rows = len(data)
+    with metrics.phase("serialize"):
+        body = dumps(data)
+    return Response(body, status = status, mimetype = JSON_MIMETYPE)
+
+def error_response(message, status):
+    return json_response({"error" : message}, status)
+
+# the reads of the countries/cities lists (see configure_mongodb for their covering indexes)
+def countries_cursor():
+    return mongo.db.countries.find({}, COUNTRY_FIELDS).sort("id", 1)
+
+# near/bbox filters keep their own order (by distance for near)
+def cities_cursor(query):
+    cursor = mongo.db.cities.find(query, CITY_FIELDS)
+    if "location" not in query:
+        cursor = cursor.sort("id", 1)
+    return cursor
+
+# ids of the cities matching a filter (location filters of route 11)
+def city_ids_cursor(query):
+    return mongo.db.cities.find(query, {"_id" : 0, "id" : 1})
+
+# response of a request that started a background job: its id, and its status URL in Location
+def job_response(job_id):
+    response = json_response({"job" : job_id})
+    response.headers["Location"] = f"/api/jobs/{job_id}"
+    return response
+
+# send a cached JSON list, building and serializing it only on a cache miss
+# clients sending the ETag back in If-None-Match get 304 without a body
+def cached_json_response(key, build):
+    version = reference_cache.version()
+    entry = reference_cache.get(key, version)
+    if entry is None:
+        data = build()
+        g.rows = len(data)
+        with metrics.phase("serialize"):
+            entry = reference_cache.set(key, dumps(data), version)
+
+    body, etag = entry
+    response = Response(body, status = 200, mimetype = JSON_MIMETYPE)
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 # route 1: add a country to db
 @app.route('/api/countries', methods = ['POST'])
@@ -27,21 +322,13 @@ def post_country():
     try:
         data = request.get_json()
         if not data:
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
         # verify the existence of all required fields for POST request
         required_fields = ["nume", "lat", "lon"]
         for field in required_fields:
             if field not in data:
-                return Response(
-                    json.dumps({"error" : "invalid data, please include all required fields"}),
-                    status = 400,
-                    mimetype = 'application/json'
-                )
+                return error_response("invalid data, please include all required fields", 400)
 
         # check if the required fields have the correct type
         if (
@@ -49,15 +336,10 @@ def post_country():
             not isinstance(data.get("lat"), (float, int)) or 
             not isinstance(data.get("lon"), (float, int))
         ):
-            return Response(
-                json.dumps({"error" : "invalid data, please use correct data type for required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please use correct data type for required fields", 400)
         
         # get the next available index for this entry
-        max_id = mongo.db.countries.find_one(sort = [("id", -1)])
-        new_id = (max_id["id"] + 1) if max_id else 1
+        new_id = country_ids.next_id()
 
     
         country = {
@@ -66,57 +348,32 @@ def post_country():
             "latitudine" : data["lat"],
             "longitudine" : data["lon"]
         }
+        point = geo_point(data["lat"], data["lon"])
+        if point:
+            country["location"] = point
 
         mongo.db.countries.insert_one(country)
+        known_countries.add(country)
+        reference_cache.clear()
 
-        return Response(
-            json.dumps({"id": new_id}),
-            status = 201,
-            mimetype = 'application/json'
-        )
+        return json_response({"id": new_id}, 201)
     
     except Exception as e:
         if "duplicate key error" in str(e).lower():
-            return Response(
-                json.dumps({"error" : "a country with this name already exists"}),
-                status = 409,
-                mimetype = 'application/json'
-            )
+            return error_response("a country with this name already exists", 409)
         
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 # route 2: get all countries
 @app.route('/api/countries', methods = ['GET'])
 def get_countries():
     try:
-        countries = list(mongo.db.countries.find())
-
-        result = [
-            {
-                "id": c["id"],
-                "nume": c["nume_tara"],
-                "lat": c["latitudine"],
-                "lon": c["longitudine"]
-            }
-            for c in countries
-        ]
-
-        return Response(
-            json.dumps(result, sort_keys=False),
-            status = 200,
-            mimetype = 'application/json'
-        )
+        return cached_json_response("countries", lambda: [
+            format_country(c) for c in countries_cursor()
+        ])
     
     except Exception as e:
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 # route 3: modify a country
 @app.route('/api/countries/<int:id>', methods = ['PUT'])
@@ -124,20 +381,12 @@ def put_country(id):
     try:
         data = request.get_json()
         if not data:
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
         # verify the existence of all required fields for PUT request
         required_fields = ["id", "nume", "lat", "lon"]
         if not all (field in data for field in required_fields):
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
         # check if the required fields have the correct type
         if (
@@ -146,75 +395,61 @@ def put_country(id):
             not isinstance(data.get("lat"), (float, int)) or 
             not isinstance(data.get("lon"), (float, int))
         ):
-            return Response(
-                json.dumps({"error" : "invalid data, please use correct data type for required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please use correct data type for required fields", 400)
         
         # check if the id is valid for the route used
         if data.get("id") != id:
-            return Response(
-                json.dumps({"error" : "invalid data, please use the same id as in route"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please use the same id as in route", 400)
         
         result = mongo.db.countries.update_one(
             {"id" : id},
-            {"$set" : {
-                "nume_tara" : data.get("nume"),
-                "latitudine" : data.get("lat"),
-                "longitudine" : data.get("lon")
-            }}
+            location_update({"nume_tara" : data.get("nume")}, data.get("lat"), data.get("lon"))
         )
 
         if result.matched_count == 0:
-            return Response(
-                json.dumps({"error" : "country was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
+            return error_response("country was not found", 404)
     
+        # the cached countries/cities lists are stale now
+        reference_cache.clear()
+
         return Response(status = 200)
     
     except Exception as e:
         if "duplicate key error" in str(e).lower():
-            return Response(
-                json.dumps({"error" : "a country with this name already exists"}),
-                status = 409,
-                mimetype = 'application/json'
-            )
+            return error_response("a country with this name already exists", 409)
         
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 # route 4: delete a country
 @app.route('/api/countries/<int:id>', methods = ['DELETE'])
 def delete_country(id):
     try:
+        cities = [c["id"] for c in city_ids_cursor({"id_tara" : id})]
+
         result = mongo.db.countries.delete_one(
             {"id" : id}
         )
 
         if result.deleted_count == 0:
-            return Response(
-                json.dumps({"error" : "country was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
-    
-        return Response(status = 200)
+            return error_response("country was not found", 404)
+
+        # the cities go right away (a reload of the known ids doesn't bring them back)
+        mongo.db.cities.delete_many({"id_tara" : id})
+        known_countries.discard(id)
+        for city in cities:
+            known_cities.discard(city)
+        changes.delete_cities(mongo.db, change_seqs, {city : id for city in cities})
+
+        # the readings of the cities are deleted by a background job
+        job_id = job_runner.submit("delete_country", id, jobs.delete_country_steps(temperature_store, id, cities))
+
+        # the cached countries/cities lists are stale now
+        reference_cache.clear()
+
+        return job_response(job_id)
     
     except Exception as e:
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 
 # route 5: add a city to db
@@ -223,20 +458,12 @@ def post_city():
     try:
         data = request.get_json()
         if not data:
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
          # verify the existence of all required fields for POST request
         required_fields = ["idTara", "nume", "lat", "lon"]
         if not all(field in data for field in required_fields):
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
         # check if the required fields have the correct type
         if (
@@ -245,24 +472,15 @@ def post_city():
             not isinstance(data.get("lat"), (float, int)) or 
             not isinstance(data.get("lon"), (float, int))
         ):
-            return Response(
-                json.dumps({"error" : "invalid data, please use correct data type for required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please use correct data type for required fields", 400)
         
         # check if the country id is valid
-        country_exists = mongo.db.countries.find_one({"id": data["idTara"]})
+        country_exists = known_countries.get(data["idTara"])
         if not country_exists:
-            return Response(
-                json.dumps({"error" : "city's country was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
+            return error_response("city's country was not found", 404)
 
         # get the next available index for this entry
-        max_id = mongo.db.cities.find_one(sort = [("id", -1)])
-        new_id = (max_id["id"] + 1) if max_id else 1
+        new_id = city_ids.next_id()
 
         city = {
             "id" : new_id,
@@ -271,89 +489,51 @@ def post_city():
             "latitudine" : data.get("lat"),
             "longitudine" : data.get("lon")
         }
+        point = geo_point(data["lat"], data["lon"])
+        if point:
+            city["location"] = point
 
         mongo.db.cities.insert_one(city)
+        known_cities.add(city)
+        reference_cache.clear()
 
-        return Response(
-            json.dumps({"id" : new_id}),
-            status = 201,
-            mimetype = 'application/json'
-        )
+        return json_response({"id" : new_id}, 201)
     
     except Exception as e:
         if "duplicate key error" in str(e).lower():
-            return Response(
-                json.dumps({"error" : "a city with this name already exists"}),
-                status = 409,
-                mimetype = 'application/json'
-            )
+            return error_response("a city with this name already exists", 409)
         
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
-# route 6: get all cities
+# route 6: get all cities (optionally near a point or inside a bounding box)
 @app.route('/api/cities', methods = ['GET'])
 def get_cities():
     try:
-        cities = list(mongo.db.cities.find())
-        result = [
-            {
-                "id" : c["id"],
-                "idTara" : c["id_tara"],
-                "nume" : c["nume_oras"],
-                "lat" : c["latitudine"],
-                "lon" : c["longitudine"]
-            }
-            for c in cities
-        ]
-
-        return Response(
-            json.dumps(result, sort_keys = False),
-            status = 200,
-            mimetype = 'application/json'
+        try:
+            query = queries.area_filter(request.args, nearest = True)
+        except ValueError:
+            return error_response(queries.INVALID_AREA, 400)
+
+        # location filtered lists are cached per query string
+        return cached_json_response(
+            "cities?" + request.query_string.decode(),
+            lambda: [format_city(c) for c in cities_cursor(query)]
         )
     
     except Exception as e:
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 # route 7: get cities of a coutry
 @app.route('/api/cities/country/<int:id>', methods = ['GET'])
 def get_country_cities(id):
     try:
-        cities = list(mongo.db.cities.find(
-            {"id_tara" : id}
-        ))
-
-        result = [
-            {
-                "id" : c["id"],
-                "idTara" : c["id_tara"],
-                "nume" : c["nume_oras"],
-                "lat" : c["latitudine"],
-                "lon" : c["longitudine"]
-            }
-            for c in cities
-        ]
-
-        return Response(
-            json.dumps(result, sort_keys=False),
-            status=200,
-            mimetype='application/json'
+        return cached_json_response(
+            f"cities/country/{id}",
+            lambda: [format_city(c) for c in cities_cursor({"id_tara" : id})]
         )
     
     except Exception as e:
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 # route 8: modify a city
 @app.route('/api/cities/<int:id>', methods = ['PUT'])
@@ -361,20 +541,12 @@ def put_city(id):
     try:
         data = request.get_json()
         if not data:
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
         # verify the existence of all required fields for PUT request
         required_fields = ["id", "idTara", "nume", "lat", "lon"]
         if not all (field in data for field in required_fields):
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
                 
         # check if the required fields have the correct type
         if (
@@ -384,86 +556,97 @@ def put_city(id):
             not isinstance(data.get("lat"), (float, int)) or 
             not isinstance(data.get("lon"), (float, int))
         ):
-            return Response(
-                json.dumps({"error" : "invalid data, please use correct data type for required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please use correct data type for required fields", 400)
         
         # check if the request's id is valid for the route used
         if data.get("id") != id:
-            return Response(
-                json.dumps({"error" : "invalid data, please use the same id as in route"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please use the same id as in route", 400)
         
         # check if the country id is valid
-        country_exists = mongo.db.countries.find_one({"id": data["idTara"]})
+        country_exists = known_countries.get(data["idTara"])
         if not country_exists:
-            return Response(
-                json.dumps({"error" : "city's country was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
+            return error_response("city's country was not found", 404)
         
-        result = mongo.db.cities.update_one(
+        previous = mongo.db.cities.find_one_and_update(
             {"id" : id},
-            {"$set" : {
-                "id_tara" : data.get("idTara"),
-                "nume_oras" : data.get("nume"),
-                "latitudine" : data.get("lat"),
-                "longitudine" : data.get("lon")
-            }}
+            location_update(
+                {"id_tara" : data.get("idTara"), "nume_oras" : data.get("nume")},
+                data.get("lat"),
+                data.get("lon")
+            ),
+            projection = {"id_tara" : 1}
         )
 
-        if result.matched_count == 0:
-            return Response(
-                json.dumps({"error" : "city was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
+        if previous is None:
+            return error_response("city was not found", 404)
+
+        # the city moved to another country: move its temperature entries too
+        # and rebuild the rollups of both countries
+        if previous["id_tara"] != data["idTara"]:
+            temperature_store.set_countries({id : data["idTara"]})
+
+            # for the since=<seq> sync, the readings leave the old country and are new
+            # in the other one
+            changes.delete_cities(mongo.db, change_seqs, {id : previous["id_tara"]})
+            if temperature_store.mode == "collection":
+                changes.restamp(temperature_store.collection, change_seqs, {"id_oras" : id})
+
+            rollups.rebuild_countries(mongo.db, [previous["id_tara"], data["idTara"]])
     
+        known_cities.add({"id" : id, "id_tara" : data["idTara"]})
+
+        # the cached countries/cities lists are stale now
+        reference_cache.clear()
+
         return Response(status = 200)
     
     except Exception as e:
         if "duplicate key error" in str(e).lower():
-            return Response(
-                json.dumps({"error" : "a city with this name already exists"}),
-                status = 409,
-                mimetype = 'application/json'
-            )
+            return error_response("a city with this name already exists", 409)
         
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 # route 9: delete a city
 @app.route('/api/cities/<int:id>', methods = ['DELETE'])
 def delete_city(id):
     try:
-        result = mongo.db.cities.delete_one(
-            {"id" : id}
+        previous = mongo.db.cities.find_one_and_delete(
+            {"id" : id},
+            projection = {"id_tara" : 1}
         )
 
-        if result.deleted_count == 0:
-            return Response(
-                json.dumps({"error" : "city was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
+        if previous is None:
+            return error_response("city was not found", 404)
     
-        return Response(status = 200)
+        known_cities.discard(id)
+        changes.delete_cities(mongo.db, change_seqs, {id : previous.get("id_tara")})
+
+        # the readings of the city are deleted by a background job
+        job_id = job_runner.submit("delete_city", id, jobs.delete_city_steps(temperature_store, id, previous.get("id_tara")))
+
+        # the cached countries/cities lists are stale now
+        reference_cache.clear()
+
+        return job_response(job_id)
     
     except Exception as e:
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
+
+
+# get the country id of a temperature entry, looked up in its city for
+# entries stored before id_tara was denormalized (None if the city doesn't exist anymore)
+def reading_country(t):
+    if "id_tara" in t:
+        return t["id_tara"]
+    city = known_cities.get(t["id_oras"])
+    return city["id_tara"] if city else None
 
+# copy the current country id of every city onto its temperature entries
+# (migration for the entries stored before id_tara was denormalized, safe to run again)
+def backfill_country_ids():
+    return temperature_store.set_countries({
+        c["id"] : c["id_tara"] for c in mongo.db.cities.find({}, {"_id" : 0, "id" : 1, "id_tara" : 1})
+    })
 
 # route 10: add a temperature mesurement to db
 @app.route('/api/temperatures', methods = ['POST'])
@@ -471,252 +654,189 @@ def post_temperature():
     try:
         data = request.get_json()
         if not data:
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
         # verify the existence of all required fields for POST request
         required_fields = ["idOras", "valoare"]
         if not all (field in data for field in required_fields):
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
         # check if the required fields have the correct type
         if (
             not isinstance(data.get("idOras"), int) or 
             not isinstance(data.get("valoare"), (float, int))
         ):
-            return Response(
-                json.dumps({"error" : "invalid data, please use correct data type for required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please use correct data type for required fields", 400)
         
         # check if the city id is valid
-        city_exists = mongo.db.cities.find_one({"id": data["idOras"]})
+        city_exists = known_cities.get(data["idOras"])
         if not city_exists:
-            return Response(
-                json.dumps({"error" : "city was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
+            return error_response("city was not found", 404)
         
         # get the next available index for this entry
-        max_id = mongo.db.temperatures.find_one(sort = [("id", -1)])
-        new_id = (max_id["id"] + 1) if max_id else 1
+        new_id = temperature_ids.next_id()
 
         # create a timestamp for the entry
-        timestamp = datetime.now()
+        timestamp = utcnow()
     
         temperature = {
             "id" : new_id,
             "valoare" : data.get("valoare"),
             "timestamp" : timestamp,
             "id_oras" : data.get("idOras"),
+            "id_tara" : city_exists["id_tara"]
         }
-        mongo.db.temperatures.insert_one(temperature)
 
-        return Response(
-            json.dumps({"id" : new_id}),
-            status = 201,
-            mimetype = 'application/json'
-        )
+        # buffered: the reading is written later, in a group commit
+        if app.config["INGEST_BUFFERED"]:
+            if not write_behind.submit(temperature):
+                response = error_response("too many readings queued, please try again later", 429)
+                response.headers["Retry-After"] = "1"
+                return response
+            return json_response({"id" : new_id}, 202)
+
+        changes.stamp([temperature], change_seqs)
+        temperature_store.insert_one(temperature)
+
+        # add the entry to the rollups of its city and country
+        rollups.apply_increments(mongo.db, [temperature])
+
+        return json_response({"id" : new_id}, 201)
     
     except Exception as e:
         if "duplicate key error" in str(e).lower():
-            return Response(
-                json.dumps({"error" : "there's already a temperature entry for this city and time"}),
-                status = 409,
-                mimetype = 'application/json'
-            )
+            return error_response("there's already a temperature entry for this city and time", 409)
+        return error_response(str(e), 500)
+
+# apply a temperatures query and send the result, based on the arguments
+# limit / after / stream (see queries.page_args), or since=SEQ - send only the changes after
+# a change sequence number (see changes_response)
+# paged results are ordered by (timestamp, id); without arguments everything is sent at once
+def temperatures_response(query):
+    try:
+        limit, after, stream = queries.page_args(request.args, app.config["PAGE_MAX_LIMIT"])
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    if "since" in request.args:
+        if after or stream:
+            return error_response("since can't be used with after or stream", 400)
+        return changes_response(query, request.args["since"], limit)
+
+    if after:
+        try:
+            query = queries.after_filter(query, after)
+        except ValueError:
+            return error_response(queries.INVALID_CURSOR, 400)
+
+    cursor = temperature_store.find(
+        query,
+        sort = queries.PAGE_SORT if limit is not None or after else None,
+        limit = limit,
+        batch_size = app.config["STREAM_CHUNK_SIZE"],
+        projection = TEMPERATURE_FIELDS
+    )
+
+    if stream:
+        # build the JSON array incrementally, one chunk of entries at a time
         return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
+            stream_with_context(json_array_chunks(cursor, app.config["STREAM_CHUNK_SIZE"], format_temperatures)),
+            status = 200,
+            mimetype = JSON_MIMETYPE
         )
 
-# route 11: get temperatures based on lat, lon, start date and/or end date
+    temperatures = list(cursor)
+    response = json_response(format_temperatures(temperatures))
+
+    # there may be more entries after a full page
+    next_cursor = queries.next_cursor(temperatures, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    return response
+
+# incremental sync (since=SEQ, with optional limit=N): the readings added or changed after
+# the change sequence number SEQ, and the tombstones of the deleted ones, ordered by seq:
+#   {"id", "valoare", "timestamp", "seq"}  - a new / changed reading
+#   {"id", "seq", "deleted": true}         - a deleted reading
+#   {"idOras", "seq", "deleted": true}     - all the readings of a city were deleted
+# the seq to send next time is in X-Sync-Seq (since=0 for a full download)
+def changes_response(query, since, limit):
+    if temperature_store.mode != "collection":
+        return error_response(f"since needs TEMPERATURES_STORAGE=collection, not {temperature_store.mode}", 400)
+
+    try:
+        since = int(since)
+        if since < 0:
+            raise ValueError
+    except ValueError:
+        return error_response("invalid since, please use the X-Sync-Seq of the previous sync (or 0)", 400)
+
+    entries = changes.since(temperature_store, mongo.db, query, since, limit, app.config["SYNC_SETTLE"])
+    response = json_response([changes.format_change(e) for e in entries])
+    response.headers["X-Sync-Seq"] = str(entries[-1]["seq"] if entries else since)
+    return response
+
+# route 11: get temperatures based on lat, lon, area (near/bbox), start date and/or end date
 @app.route('/api/temperatures', methods = ['GET'])
 def get_temperatures_filtered():
     try:
-        # extract filter information (if any) from arguments
-        lat = request.args.get("lat", type = float)
-        lon = request.args.get("lon", type = float)
-        start_date = request.args.get("from")
-        end_date = request.args.get("until")
-
-        if start_date:
-            start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        if end_date:
-            end_date = datetime.strptime(end_date, "%Y-%m-%d")
-
-        # create a query with filter information
-        query = {}
-
-        # add location filter - latitude and/or longitude of the city - to query
-        if lat is not None and lon is not None:
-            cities = mongo.db.cities.find({"latitudine" : lat, "longitudine" : lon})
-            cities_ids = [c["id"] for c in cities]
-            query["id_oras"] = {"$in" : cities_ids}
-        elif lat is not None:
-            cities = mongo.db.cities.find({"latitudine" : lat})
-            cities_ids = [c["id"] for c in cities]
-            query["id_oras"] = {"$in" : cities_ids}
-        elif lon is not None:
-            cities = mongo.db.cities.find({"longitudine" : lon})
-            cities_ids = [c["id"] for c in cities]
+        # filter on the cities - latitude and/or longitude of the city, area around a point
+        # and/or bounding box - and on the timestamp - start and/or end date(s)
+        try:
+            cities_filter = queries.cities_filter(request.args)
+        except ValueError:
+            return error_response(queries.INVALID_AREA, 400)
+
+        try:
+            query = queries.date_filter(request.args)
+        except ValueError:
+            return error_response(queries.INVALID_DATE, 400)
+        if cities_filter:
+            cities_ids = [c["id"] for c in city_ids_cursor(cities_filter)]
             query["id_oras"] = {"$in" : cities_ids}
 
-        # add timestamp filter - start and/or end date(s) - to query
-        if start_date and end_date:
-            query["timestamp"] = {"$gte" : start_date, "$lte" : end_date}
-        elif start_date:
-            query["timestamp"] = {"$gte" : start_date}
-        elif end_date:
-            query["timestamp"] = {"$lte" : end_date}
-
         # apply the query on the temperatures collection
-        temperatures = list(mongo.db.temperatures.find(query))
-
-        result = [
-            {
-                "id" : t["id"],
-                "valoare" : t["valoare"],
-                "timestamp" : t["timestamp"].strftime("%Y-%m-%d")
-            }
-            for t in temperatures
-        ]
-
-        return Response(
-            json.dumps(result, sort_keys = False),
-            status = 200,
-            mimetype = 'application/json'
-        )
+        return temperatures_response(query)
     
     except Exception as e:
 
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 # route 12: get temperatures based on city, start date and/or end date
 @app.route('/api/temperatures/cities/<int:id_oras>', methods = ['GET'])
 def get_city_temperatures(id_oras):
     try:
-        # extract filter information (if any) from arguments
-        start_date = request.args.get("from")
-        end_date = request.args.get("until")
-
-        if start_date:
-            start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        if end_date:
-            end_date = datetime.strptime(end_date, "%Y-%m-%d")
-
-        # create a query with filter information
-        query = {
-            # add city id filter to query
-            "id_oras" : id_oras
-        }
-
-         # add timestamp filter - start and/or end date(s) - to query
-        if start_date and end_date:
-            query["timestamp"] = {"$gte" : start_date, "$lte" : end_date}
-        elif start_date:
-            query["timestamp"] = {"$gte" : start_date}
-        elif end_date:
-            query["timestamp"] = {"$lte" : end_date}
+        # add city id and timestamp filters to query
+        try:
+            query = {"id_oras" : id_oras, **queries.date_filter(request.args)}
+        except ValueError:
+            return error_response(queries.INVALID_DATE, 400)
 
         # apply the query on the temperatures collection
-        temperatures = list(mongo.db.temperatures.find(query))
-
-        result = [
-            {
-                "id" : t["id"],
-                "valoare" : t["valoare"],
-                "timestamp" : t["timestamp"].strftime("%Y-%m-%d")
-            }
-            for t in temperatures
-        ]
-
-        return Response(
-            json.dumps(result, sort_keys = False),
-            status = 200,
-            mimetype = 'application/json'
-        )
+        return temperatures_response(query)
 
     except Exception as e:
 
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 
 # route 13: get temperatures based on country, start date and/or end date
 @app.route('/api/temperatures/countries/<int:id_tara>', methods = ['GET'])
 def get_country_temperatures(id_tara):
     try:
-        # extract filter information (if any) from arguments
-        start_date = request.args.get("from")
-        end_date = request.args.get("until")
-
-        if start_date:
-            start_date = datetime.strptime(start_date, "%Y-%m-%d")
-        if end_date:
-            end_date = datetime.strptime(end_date, "%Y-%m-%d")
-
-        # extract cities from given country id
-        cities = list(mongo.db.cities.find({"id_tara" : id_tara}))
-        # extract ids of said cities
-        cities_ids = [c["id"] for c in cities]
-
-        # create a query with filter information
-        query = {
-            # add cities ids filter to query
-            "id_oras" : {"$in" : cities_ids}
-        }
-
-        # add timestamp filter - start and/or end date(s) - to query
-        if start_date and end_date:
-            query["timestamp"] = {"$gte": start_date, "$lte": end_date}
-        elif start_date:
-            query["timestamp"] = {"$gte": start_date}
-        elif end_date:
-            query["timestamp"] = {"$lte": end_date}
+        # add country id (denormalized on each entry) and timestamp filters to query
+        try:
+            query = {"id_tara" : id_tara, **queries.date_filter(request.args)}
+        except ValueError:
+            return error_response(queries.INVALID_DATE, 400)
 
         # apply the query on the temperatures collection
-        temperatures = list(mongo.db.temperatures.find(query))
-
-        result = [
-            {
-                "id": t["id"],
-                "valoare": t["valoare"],
-                "timestamp": t["timestamp"].strftime("%Y-%m-%d")
-            }
-            for t in temperatures
-        ]
-
-        return Response(
-            json.dumps(result, sort_keys = False),
-            status = 200,
-            mimetype = 'application/json'
-        )
+        return temperatures_response(query)
 
     except Exception as e:
 
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
 
 
 # route 14: modify a temperature entry
@@ -725,20 +845,12 @@ def put_temperature(id):
     try:
         data = request.get_json()
         if not data:
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
         # verify the existence of all required fields for PUT request
         required_fields = ["id", "idOras", "valoare"]
         if not all (field in data for field in required_fields):
-            return Response(
-                json.dumps({"error" : "invalid data, please include all required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please include all required fields", 400)
         
         # check if the required fields have the correct type
         if (
@@ -746,86 +858,543 @@ def put_temperature(id):
             not isinstance(data.get("idOras"), int) or 
             not isinstance(data.get("valoare"), (float, int))
         ):
-            return Response(
-                json.dumps({"error" : "invalid data, please use correct data type for required fields"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please use correct data type for required fields", 400)
         
         # check if the request's id is valid for the route used
         if data.get("id") != id:
-            return Response(
-                json.dumps({"error" : "invalid data, please use the same id as in route"}),
-                status = 400,
-                mimetype = 'application/json'
-            )
+            return error_response("invalid data, please use the same id as in route", 400)
         
         # check if the city id is valid
-        city_exists = mongo.db.cities.find_one({"id": data["idOras"]})
+        city_exists = known_cities.get(data["idOras"])
         if not city_exists:
-            return Response(
-                json.dumps({"error" : "city was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
+            return error_response("city was not found", 404)
         
-        result = mongo.db.temperatures.update_one(
-            {"id" : id},
-            {"$set" : {
-                "id_oras" : data.get("idOras"),
-                "valoare" : data.get("valoare")
-            }}
-        )
+        # two seqs: a tombstone in the old city (if the entry moves), then the update
+        seq = change_seqs.reserve(2)
+        previous = temperature_store.update(id, {
+            "id_oras" : data.get("idOras"),
+            "id_tara" : city_exists["id_tara"],
+            "valoare" : data.get("valoare"),
+            "seq" : seq + 1,
+            "changed" : utcnow()
+        })
 
-        if result.matched_count == 0:
-            return Response(
-                json.dumps({"error" : "temperature entry was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
+        if previous is None:
+            return error_response("temperature entry was not found", 404)
+
+        if previous["id_oras"] != data["idOras"]:
+            mongo.db[changes.TOMBSTONES].insert_one(changes.tombstone(seq, previous))
+
+        # recompute the rollups of the entry's old and new buckets
+        rollups.recompute(mongo.db, temperature_store, [
+            (previous["id_oras"], reading_country(previous), previous["timestamp"]),
+            (data["idOras"], city_exists["id_tara"], previous["timestamp"])
+        ])
     
         return Response(status = 200)
     
     except Exception as e:
         if "duplicate key error" in str(e).lower():
-            return Response(
-                json.dumps({"error" : "there's already a temperature entry for this city and time"}),
-                status = 409,
-                mimetype = 'application/json'
-            )
+            return error_response("there's already a temperature entry for this city and time", 409)
         
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
-        )
+        return error_response(str(e), 500)
     
 # route 15: delete a temperature entry
 @app.route('/api/temperatures/<int:id>', methods = ['DELETE'])
 def delete_temperature(id):
     try:
-        result = mongo.db.temperatures.delete_one(
-            {"id" : id}
-        )
+        previous = temperature_store.delete(id)
 
-        if result.deleted_count == 0:
-            return Response(
-                json.dumps({"error" : "temperature entry was not found"}),
-                status = 404,
-                mimetype = 'application/json'
-            )
+        if previous is None:
+            return error_response("temperature entry was not found", 404)
+
+        mongo.db[changes.TOMBSTONES].insert_one(changes.tombstone(change_seqs.reserve(), previous))
+
+        # recompute the rollups of the entry's bucket
+        rollups.recompute(mongo.db, temperature_store, [
+            (previous["id_oras"], reading_country(previous), previous["timestamp"])
+        ])
     
         return Response(status = 200)
     
     except Exception as e:
-        return Response(
-            json.dumps({"error" : str(e)}),
-            status = 500,
-            mimetype = 'application/json'
+        return error_response(str(e), 500)
+
+# parse a bulk request body: a JSON array or an NDJSON stream (one reading per line)
+# returns a list of readings, where unparsable NDJSON lines are kept as None
+def read_bulk_items():
+    if request.mimetype in ("application/x-ndjson", "application/ndjson", "application/jsonlines"):
+        items = []
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+
+    data = request.get_json(silent = True)
+    return data if isinstance(data, list) else None
+
+# check one reading of a bulk request, returns an error message or None
+def validate_bulk_item(item):
+    if not isinstance(item, dict) or not all(field in item for field in ["idOras", "valoare"]):
+        return "invalid data, please include all required fields"
+
+    if (
+        not isinstance(item.get("idOras"), int) or
+        not isinstance(item.get("valoare"), (float, int)) or
+        not isinstance(item.get("timestamp", ""), str)
+    ):
+        return "invalid data, please use correct data type for required fields"
+
+    if "timestamp" in item:
+        try:
+            parse_timestamp(item["timestamp"])
+        except ValueError:
+            return "invalid data, please use an ISO 8601 timestamp"
+
+    return None
+
+# route 16: add temperature measurements in bulk
+@app.route('/api/temperatures/bulk', methods = ['POST'])
+def post_temperatures_bulk():
+    try:
+        items = read_bulk_items()
+        if not items:
+            return error_response("invalid data, please send a JSON array or NDJSON stream of readings", 400)
+
+        if len(items) > app.config["BULK_MAX_ITEMS"]:
+            return error_response(f"too many readings, the limit is {app.config['BULK_MAX_ITEMS']}", 413)
+
+        # per item result, in the same order as the request
+        results = [{"error" : validate_bulk_item(item)} for item in items]
+
+        # check all the city ids at once (unknown ids with a single query)
+        cities_ids = {item["idOras"] for item, r in zip(items, results) if not r["error"]}
+        cities_countries = {
+            id : c["id_tara"] for id, c in known_cities.get_many(list(cities_ids)).items()
+        }
+        for item, r in zip(items, results):
+            if not r["error"] and item["idOras"] not in cities_countries:
+                r["error"] = "city was not found"
+
+        valid = [i for i, r in enumerate(results) if not r["error"]]
+
+        # reserve one block of ids for all the valid readings
+        temperatures = []
+        if valid:
+            first_id = temperature_ids.reserve(len(valid))
+            now = utcnow()
+
+            for offset, i in enumerate(valid):
+                item = items[i]
+                temperatures.append({
+                    "id" : first_id + offset,
+                    "valoare" : item["valoare"],
+                    "timestamp" : parse_timestamp(item["timestamp"]) if "timestamp" in item else now,
+                    "id_oras" : item["idOras"],
+                    "id_tara" : cities_countries[item["idOras"]]
+                })
+                results[i] = {"id" : first_id + offset}
+            changes.stamp(temperatures, change_seqs)
+
+            # unordered insert: a bad reading doesn't stop the rest of the batch
+            failed = temperature_store.insert_many(temperatures)
+            for index, (code, message) in failed.items():
+                i = valid[index]
+                if code == 11000:
+                    results[i] = {"error" : "there's already a temperature entry for this city and time"}
+                else:
+                    results[i] = {"error" : message}
+
+            # add the inserted entries to the rollups of their cities and countries
+            rollups.apply_increments(mongo.db, [
+                t for t, i in zip(temperatures, valid) if "id" in results[i]
+            ])
+
+        inserted = sum(1 for r in results if "id" in r)
+
+        return json_response({"inserted" : inserted, "results" : results}, 201 if inserted else 400)
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# date format of each statistics bucket
+STATS_BUCKETS = {
+    "hour" : "%Y-%m-%dT%H:00",
+    "day" : "%Y-%m-%d",
+    "month" : "%Y-%m"
+}
+
+# compute count/min/max/mean (and the requested percentiles) of the temperatures
+# of a city or country (scope), per hour/day/month bucket
+# arguments: bucket=hour|day|month, from=Date, until=Date, percentiles=50,90,99, source=raw
+# day and month buckets without percentiles are read from the precomputed rollups (see
+# rollup_stats_response), everything else is aggregated from the raw readings
+def temperature_stats_response(scope, ref_id):
+    bucket = request.args.get("bucket", "day")
+
+    if bucket not in STATS_BUCKETS:
+        return error_response("invalid bucket, please use hour, day or month", 400)
+
+    try:
+        percentiles = [float(p) for p in request.args.get("percentiles", "").split(",") if p]
+        if not all(0 <= p <= 100 for p in percentiles):
+            raise ValueError
+    except ValueError:
+        return error_response("invalid percentiles, please use values between 0 and 100", 400)
+
+    # timestamp filter - start and/or end date(s)
+    try:
+        date_range = queries.date_filter(request.args).get("timestamp", {})
+    except ValueError:
+        return error_response(queries.INVALID_DATE, 400)
+
+    if bucket in ("day", "month") and not percentiles and request.args.get("source") != "raw":
+        return rollup_stats_response(scope, ref_id, bucket, date_range)
+
+    return json_response(raw_stats(scope, ref_id, bucket, date_range, percentiles))
+
+# statistics of the readings of a city or country in a time range, aggregated from the raw readings
+def raw_stats(scope, ref_id, bucket, date_range, percentiles = ()):
+    match = {"id_oras" if scope == "city" else "id_tara" : ref_id}
+
+    if date_range:
+        match["timestamp"] = date_range
+
+    group = {
+        "_id" : {"$dateTrunc" : {"date" : "$timestamp", "unit" : bucket}},
+        "count" : {"$sum" : 1},
+        "min" : {"$min" : "$valoare"},
+        "max" : {"$max" : "$valoare"},
+        "mean" : {"$avg" : "$valoare"}
+    }
+    if percentiles:
+        group["percentiles"] = {"$percentile" : {
+            "input" : "$valoare",
+            "p" : [p / 100 for p in percentiles],
+            "method" : "approximate"
+        }}
+
+    buckets = temperature_store.aggregate(match, [
+        {"$group" : group},
+        {"$sort" : {"_id" : 1}}
+    ])
+
+    result = []
+    for b in buckets:
+        entry = {
+            "bucket" : b["_id"].strftime(STATS_BUCKETS[bucket]),
+            "count" : b["count"],
+            "min" : b["min"],
+            "max" : b["max"],
+            "mean" : b["mean"]
+        }
+        for p, value in zip(percentiles, b.get("percentiles", [])):
+            entry[f"p{p:g}"] = value
+        result.append(entry)
+    return result
+
+# read day/month statistics of a city or country from the rollup collections
+# the rollups hold whole buckets: a bucket only partly in the range (the one of a from in the
+# middle of a month, the one of until, read up to that time) is aggregated from the raw
+# readings, so the result is the same as with source=raw
+def rollup_stats_response(scope, ref_id, bucket, date_range):
+    start, following = (rollups.day_start, rollups.next_day) if bucket == "day" else (rollups.month_start, rollups.next_month)
+    low, high = date_range.get("$gte"), date_range.get("$lte")
+
+    # the whole buckets, from full_low (included) to full_high (excluded)
+    full_low = low if low is None or start(low) == low else following(low)
+    full_high = None if high is None else start(high)
+    if full_low is not None and full_high is not None and full_low >= full_high:
+        return json_response(raw_stats(scope, ref_id, bucket, date_range))
+
+    query = {"scope" : scope, "ref_id" : ref_id}
+    bounds = {}
+    if full_low is not None:
+        bounds["$gte"] = full_low
+    if full_high is not None:
+        bounds["$lt"] = full_high
+    if bounds:
+        query["bucket"] = bounds
+
+    collection = rollups.DAILY if bucket == "day" else rollups.MONTHLY
+    buckets = mongo.db[collection].find(
+        query,
+        {"_id" : 0, "bucket" : 1, "count" : 1, "sum" : 1, "min" : 1, "max" : 1}
+    ).sort("bucket", 1)
+
+    result = [
+        {
+            "bucket" : b["bucket"].strftime(STATS_BUCKETS[bucket]),
+            "count" : b["count"],
+            "min" : b["min"],
+            "max" : b["max"],
+            "mean" : b["sum"] / b["count"]
+        }
+        for b in buckets if b["count"]
+    ]
+
+    # the partial buckets at both ends
+    if low is not None and full_low != low:
+        result = raw_stats(scope, ref_id, bucket, {"$gte" : low, "$lt" : full_low}) + result
+    if high is not None:
+        result += raw_stats(scope, ref_id, bucket, {"$gte" : full_high, "$lte" : high})
+
+    return json_response(result)
+
+# route 17: get temperature statistics of a city
+@app.route('/api/temperatures/cities/<int:id_oras>/stats', methods = ['GET'])
+def get_city_temperature_stats(id_oras):
+    try:
+        return temperature_stats_response("city", id_oras)
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 18: get temperature statistics of a country
+@app.route('/api/temperatures/countries/<int:id_tara>/stats', methods = ['GET'])
+def get_country_temperature_stats(id_tara):
+    try:
+        return temperature_stats_response("country", id_tara)
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# the reads of the list routes, as (name, cursor, ordered) for plans.check, on an existing
+# city/country when there is one; near/bbox filters are left out, since geo queries
+# always read the documents
+def route_reads():
+    city = mongo.db.cities.find_one({}, {"_id" : 0, "id" : 1, "id_tara" : 1, "latitudine" : 1, "longitudine" : 1}) or {
+        "id" : 1, "id_tara" : 1, "latitudine" : 0.0, "longitudine" : 0.0
+    }
+    since = {"$gte" : datetime(2000, 1, 1)}
+    page = {"sort" : [("timestamp", 1), ("id", 1)], "limit" : 100, "projection" : TEMPERATURE_FIELDS}
+
+    reads = [
+        ("route 2: countries", countries_cursor(), True),
+        ("route 6: cities", cities_cursor({}), True),
+        ("route 7: cities of a country", cities_cursor({"id_tara" : city["id_tara"]}), True),
+        ("route 11: cities at lat/lon", city_ids_cursor({"latitudine" : city["latitudine"], "longitudine" : city["longitudine"]}), False)
+    ]
+
+    if temperature_store.mode != "collection":
+        print(f"temperature routes skipped: covered reads need TEMPERATURES_STORAGE=collection, not {temperature_store.mode}")
+    else:
+        reads += [
+            ("temperature id counter seed", temperature_store.cursor({}, sort = [("id", -1)], limit = 1, projection = {"_id" : 0, "id" : 1}), True),
+            ("route 11: temperatures", temperature_store.cursor({"timestamp" : since}, projection = TEMPERATURE_FIELDS), False),
+            ("route 11: temperatures, paged", temperature_store.cursor({"timestamp" : since}, **page), True),
+            ("route 12: city temperatures", temperature_store.cursor({"id_oras" : city["id"], "timestamp" : since}, projection = TEMPERATURE_FIELDS), False),
+            ("route 12: city temperatures, paged", temperature_store.cursor({"id_oras" : city["id"], "timestamp" : since}, **page), True),
+            ("route 13: country temperatures", temperature_store.cursor({"id_tara" : city["id_tara"]}, projection = TEMPERATURE_FIELDS), False),
+            ("route 13: country temperatures, paged", temperature_store.cursor({"id_tara" : city["id_tara"]}, **page), True),
+            ("route 21: batch temperatures", temperature_store.cursor(
+                {"id_oras" : {"$in" : [city["id"], city["id"] + 1]}, "timestamp" : since},
+                sort = [("id_oras", 1), ("timestamp", 1), ("id", 1)], projection = CITY_TEMPERATURE_FIELDS
+            ), True)
+        ]
+
+    return reads
+
+# check the query plans of the read routes (python app.py explain)
+def explain_routes():
+    return plans.report(route_reads())
+
+# route 19: get the status of a background job (e.g. the cascading delete of a country)
+@app.route('/api/jobs/<job_id>', methods = ['GET'])
+def get_job(job_id):
+    try:
+        job = job_runner.get(job_id)
+        if job is None:
+            return error_response("job was not found", 404)
+
+        return json_response(jobs.format_job(job))
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 20: export all the readings (optionally between two dates) as csv, ndjson or parquet
+# the file is streamed in chunks straight from the mongo cursor, in no particular order
+@app.route('/api/export/temperatures', methods = ['GET'])
+def export_temperatures():
+    try:
+        formats = export.available_formats()
+        file_format = request.args.get("format", "csv")
+        if file_format not in formats:
+            if file_format in export.FORMATS:
+                return error_response(f"the {file_format} export needs the pyarrow package", 400)
+            return error_response(f"invalid format, please use {', '.join(formats)}", 400)
+
+        try:
+            query = queries.date_filter(request.args)
+        except ValueError:
+            return error_response(queries.INVALID_DATE, 400)
+
+        chunks, content_type, extension = export.FORMATS[file_format]
+        cursor = temperature_store.find(
+            query,
+            batch_size = app.config["EXPORT_BATCH_SIZE"],
+            projection = export.PROJECTION
         )
 
-if __name__ == '__main__':
-    # run Mongo config
+        response = Response(
+            stream_with_context(chunks(cursor, app.config["EXPORT_BATCH_SIZE"])),
+            status = 200,
+            mimetype = content_type
+        )
+        response.headers["Content-Disposition"] = f"attachment; filename=temperatures.{extension}"
+        return response
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 21: get the temperatures of several cities at once, grouped by city
+# body: {"cities": [id, ...]} or {"idTara": id} (all its cities), plus optional "from" / "until"
+# dates shared by all the cities; the readings are read with a single $in query on the
+# (id_oras, timestamp, id, valoare) index, already ordered by city
+@app.route('/api/batch/temperatures', methods = ['POST'])
+def post_batch_temperatures():
+    try:
+        data = request.get_json(silent = True)
+        if not isinstance(data, dict) or ("cities" in data) == ("idTara" in data):
+            return error_response("invalid data, please send cities (a list of city ids) or idTara", 400)
+
+        if "idTara" in data:
+            if not isinstance(data["idTara"], int):
+                return error_response("invalid data, please use correct data type for required fields", 400)
+            if known_countries.get(data["idTara"]) is None:
+                return error_response("country was not found", 404)
+            cities_ids = [c["id"] for c in city_ids_cursor({"id_tara" : data["idTara"]}).sort("id", 1)]
+        else:
+            if not isinstance(data["cities"], list) or not all(isinstance(id, int) for id in data["cities"]):
+                return error_response("invalid data, please use correct data type for required fields", 400)
+            # without duplicates, in the order of the request
+            cities_ids = list(dict.fromkeys(data["cities"]))
+
+        if len(cities_ids) > app.config["BATCH_MAX_CITIES"]:
+            return error_response(f"too many cities, the limit is {app.config['BATCH_MAX_CITIES']}", 413)
+
+        try:
+            date_filter = queries.date_filter(data)
+        except ValueError:
+            return error_response(queries.INVALID_DATE, 400)
+
+        # one query for all the cities that exist
+        found = known_cities.get_many(cities_ids)
+        groups = {id : [] for id in cities_ids if id in found}
+        if groups:
+            query = {"id_oras" : {"$in" : list(groups)}, **date_filter}
+
+            for t in temperature_store.find(
+                query,
+                sort = [("id_oras", 1), ("timestamp", 1), ("id", 1)],
+                batch_size = app.config["STREAM_CHUNK_SIZE"],
+                projection = CITY_TEMPERATURE_FIELDS
+            ):
+                groups[t["id_oras"]].append(t)
+
+        response = json_response([
+            {"idOras" : id, "temperatures" : format_temperatures(groups[id])} if id in groups
+            else {"idOras" : id, "error" : "city was not found"}
+            for id in cities_ids
+        ])
+        # rows metric: readings, not cities
+        g.rows = sum(len(temperatures) for temperatures in groups.values())
+        return response
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 22: live updates of the new readings, as Server-Sent Events (text/event-stream)
+# arguments: city=ID or country=ID (otherwise all the readings)
+# every new reading is sent as a "temperature" event; a subscriber that falls more than
+# LIVE_QUEUE_SIZE readings behind gets an "overflow" event and the stream ends
+@app.route('/api/stream/temperatures', methods = ['GET'])
+def stream_temperatures():
+    try:
+        if temperature_store.mode != "collection":
+            return error_response(f"live updates need TEMPERATURES_STORAGE=collection, not {temperature_store.mode}", 400)
+
+        try:
+            city, country = (int(request.args[name]) if name in request.args else None for name in ("city", "country"))
+        except ValueError:
+            return error_response("invalid filter, please use city=ID or country=ID", 400)
+        if city is not None and known_cities.get(city) is None:
+            return error_response("city was not found", 404)
+        if country is not None and known_countries.get(country) is None:
+            return error_response("country was not found", 404)
+
+        subscription = live_updates.subscribe(city, country)
+        if subscription is None:
+            return error_response("too many subscribers, please try again later", 503)
+
+        keepalive = app.config["LIVE_KEEPALIVE"]
+
+        def events():
+            try:
+                yield "retry: 3000\n\n"
+                while not subscription.overflow:
+                    t = subscription.get(keepalive)
+                    if t is None:
+                        # comment line: keeps proxies from closing an idle stream
+                        yield ": keep-alive\n\n"
+                        continue
+                    yield live.sse_event("temperature", {"idOras" : t["id_oras"], **format_temperatures([t])[0]}, t["id"])
+                yield live.sse_event("overflow", {"error" : "too many readings were not read in time, please reconnect"})
+            finally:
+                live_updates.unsubscribe(subscription)
+
+        response = Response(events(), status = 200, mimetype = "text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        # no buffering by nginx
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# delete the cities of deleted countries and the readings of deleted cities
+# (left by deletes before they cascaded, or by interrupted jobs), returns the steps run
+def delete_orphans():
+    countries = {c["id"] for c in mongo.db.countries.find({}, {"_id" : 0, "id" : 1})}
+    cities = {c["id"] : c["id_tara"] for c in mongo.db.cities.find({}, {"_id" : 0, "id" : 1, "id_tara" : 1})}
+
+    orphan_cities = {}
+    for city, country in cities.items():
+        if country not in countries:
+            orphan_cities.setdefault(country, []).append(city)
+
+    steps = []
+    deleted = {}
+    for country, country_cities in orphan_cities.items():
+        steps += jobs.delete_country_steps(temperature_store, country, country_cities)
+        deleted.update((city, country) for city in country_cities)
+
+    # cities (and their countries) that still have readings
+    readings = temperature_store.aggregate({}, [{"$group" : {"_id" : {"city" : "$id_oras", "country" : "$id_tara"}}}])
+    for r in readings:
+        if r["_id"]["city"] not in cities:
+            steps += jobs.delete_city_steps(temperature_store, r["_id"]["city"], r["_id"].get("country"))
+            deleted[r["_id"]["city"]] = r["_id"].get("country")
+
+    changes.delete_cities(mongo.db, change_seqs, deleted)
+
+    rollups.run(mongo.db, steps)
+    return len(steps)
+
+# write the readings left in the journals of crashed workers (buffered ingestion)
+def replay_journals():
+    if app.config["INGEST_JOURNAL_DIR"]:
+        replayed = ingest.replay(mongo.db, temperature_store, change_seqs, app.config["INGEST_JOURNAL_DIR"])
+        if replayed:
+            print(f"{replayed} buffered readings written from the ingestion journals")
+
+# run Mongo config, retrying once if mongo is not up yet
+def init_db():
     try:
         configure_mongodb()
     except Exception as e:
@@ -833,6 +1402,77 @@ if __name__ == '__main__':
         time.sleep(5)
         configure_mongodb()
 
-    # run Flask app
-    app.run(host='0.0.0.0', debug=True)
+# application factory for WSGI servers (see wsgi.py and gunicorn.conf.py)
+def create_app():
+    init_db()
+    return app
+
+# called in every worker forked from a process that already used mongo:
+# MongoClient is not fork-safe, so each worker opens its own client (and pool),
+# and the id blocks reserved before the fork must not be shared by the workers
+def reset_after_fork():
+    mongo.init_app(app, **mongo_options())
+    for allocator in (country_ids, city_ids, temperature_ids, change_seqs):
+        allocator.reset()
+    job_runner.reset()
+    live_updates.reset()
+    write_behind.reset()
+    # a worker forked after a crash writes the journal of the crashed one (in the background,
+    # the worker starts serving right away)
+    if app.config["INGEST_JOURNAL_DIR"]:
+        threading.Thread(target = replay_journals, name = "journal-replay", daemon = True).start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest = "command")
+    commands.add_parser("serve", help = "run the Flask development server (default), use gunicorn in production")
+    commands.add_parser("configure", help = "create the indexes and seed the id counters, then exit")
+    commands.add_parser("rebuild-rollups", help = "recompute the rollup collections from all the readings")
+    commands.add_parser("backfill-country-ids", help = "copy the country id of each city onto its readings")
+    import_parser = commands.add_parser("import", help = "import historical readings from a csv or ndjson file")
+    import_parser.add_argument("file", help = "columns: valoare, timestamp (ISO 8601), idOras or oras (+ tara)")
+    import_parser.add_argument("--format", choices = ["csv", "ndjson"], help = "default: from the file extension")
+    import_parser.add_argument("--batch-size", type = int, default = 5000)
+    import_parser.add_argument("--workers", type = int, default = 4, help = "parallel insert_many batches")
+    import_parser.add_argument("--on-duplicate", choices = [importer.SKIP, importer.UPDATE], default = importer.SKIP,
+        help = "readings already stored for the same city and time: skip them or update their value")
+    commands.add_parser("delete-orphans", help = "delete the cities and readings left by deleted countries/cities")
+    commands.add_parser("explain", help = "check that the read routes are served by covering indexes")
+    migrate_parser = commands.add_parser("migrate-storage", help = "copy the readings to another storage layout")
+    migrate_parser.add_argument("--to", dest = "target", required = True, choices = list(storage.STORES))
+    migrate_parser.add_argument("--batch-size", type = int, default = 10000)
+    args = parser.parse_args()
+
+    # run Mongo config
+    init_db()
+
+    if args.command == "configure":
+        print("mongo configured")
+    elif args.command == "rebuild-rollups":
+        rollups.rebuild(mongo.db, temperature_store)
+        print("rollups rebuilt")
+    elif args.command == "backfill-country-ids":
+        print(f"{backfill_country_ids()} readings updated")
+    elif args.command == "import":
+        readings_importer = importer.Importer(
+            mongo, temperature_store, temperature_ids, change_seqs,
+            batch_size = args.batch_size, workers = args.workers, on_duplicate = args.on_duplicate
+        )
+        counts, elapsed = readings_importer.import_file(args.file, args.format)
+        print(", ".join(f"{value} {key}" for key, value in counts.items()))
+        print(f"{elapsed:.1f}s, {counts['rows'] / elapsed if elapsed else 0:.0f} rows/s")
+    elif args.command == "delete-orphans":
+        print(f"{delete_orphans()} delete steps run")
+    elif args.command == "explain":
+        if not explain_routes():
+            raise SystemExit(1)
+    elif args.command == "migrate-storage":
+        # the old collection is kept as a backup until it's dropped by hand
+        backup = f"temperatures_backup_{utcnow():%Y%m%d%H%M%S}"
+        copied = storage.migrate(mongo, temperature_store.mode, args.target, backup, args.batch_size)
+        print(f"{copied} readings copied to the {args.target} layout, old collection kept as {backup}")
+        print(f"restart the app with TEMPERATURES_STORAGE={args.target}")
+    else:
+        # run Flask app (development server)
+        app.run(host='0.0.0.0', debug=True)
 
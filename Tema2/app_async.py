@@ -0,0 +1,621 @@
+from quart import Quart, Response, request
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from cache import AsyncGeneration
+from ids import AsyncIdAllocator
+from serialize import CITY_FIELDS, COUNTRY_FIELDS, JSON_MIMETYPE, TEMPERATURE_FIELDS, dumps, format_city, format_country, format_temperatures, json_array_chunks_async, utcnow
+from storage import CollectionStore
+import rollups
+import jobs
+import changes
+import queries
+import live
+import asyncio
+import os
+
+# async variant of the REST API (routes 1-15, 19 and 22, same URLs and JSON shapes as app.py)
+# on Quart + PyMongo's AsyncMongoClient: a worker is never blocked on mongo, so
+# concurrency is not limited by the number of threads, and independent lookups
+# (e.g. existence check + id reservation) run at the same time
+# the indexes and counters are configured by the Flask app (python app.py configure)
+# only the default temperatures storage layout (TEMPERATURES_STORAGE=collection) is supported
+# run with: hypercorn app_async:app --bind 0.0.0.0:5001 --workers N
+
+# init quart app
+app = Quart(__name__)
+
+app.config["MONGO_URI"] = os.environ.get("MONGO_URI", "mongodb://mongo:27017/tema2scd")
+app.config["ID_BLOCK_SIZE"] = int(os.environ.get("ID_BLOCK_SIZE", 1))
+app.config["SYNC_SETTLE"] = float(os.environ.get("SYNC_SETTLE", 2))
+app.config["PAGE_MAX_LIMIT"] = int(os.environ.get("PAGE_MAX_LIMIT", 10000))
+app.config["STREAM_CHUNK_SIZE"] = int(os.environ.get("STREAM_CHUNK_SIZE", 1000))
+# live updates (route 22, see app.py): a subscriber holds no thread here, only its queue and
+# its connection, so a worker takes up to LIVE_MAX_SUBSCRIBERS of them
+app.config["LIVE_MAX_SUBSCRIBERS"] = int(os.environ.get("LIVE_MAX_SUBSCRIBERS", 1000))
+app.config["LIVE_QUEUE_SIZE"] = int(os.environ.get("LIVE_QUEUE_SIZE", 1000))
+app.config["LIVE_POLL_INTERVAL"] = float(os.environ.get("LIVE_POLL_INTERVAL", 1))
+app.config["LIVE_POLL_LAG"] = float(os.environ.get("LIVE_POLL_LAG", 5))
+app.config["LIVE_KEEPALIVE"] = float(os.environ.get("LIVE_KEEPALIVE", 15))
+
+# the flat temperatures layout, used to build the rollup pipelines
+store = CollectionStore(None)
+
+# background jobs running on the event loop (referenced until they finish)
+job_tasks = set()
+
+client = None
+db = None
+country_ids = None
+city_ids = None
+temperature_ids = None
+change_seqs = None
+# bumped by every country/city write, so the Flask workers drop their cached lists and id maps
+reference_generation = None
+live_updates = None
+
+MISSING_FIELDS = "invalid data, please include all required fields"
+WRONG_TYPES = "invalid data, please use correct data type for required fields"
+WRONG_ID = "invalid data, please use the same id as in route"
+NUMBER = (float, int)
+
+
+# init mongo db, the client must be created inside the event loop of the worker
+@app.before_serving
+async def init_mongo():
+    global client, db, country_ids, city_ids, temperature_ids, change_seqs, reference_generation, live_updates
+
+    if os.environ.get("TEMPERATURES_STORAGE", "collection") != store.mode:
+        raise RuntimeError("the async app supports only TEMPERATURES_STORAGE=collection")
+
+    client = AsyncMongoClient(
+        app.config["MONGO_URI"],
+        maxPoolSize = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100)),
+        minPoolSize = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        serverSelectionTimeoutMS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+    )
+    db = client.get_default_database()
+
+    country_ids = AsyncIdAllocator(db, "countries", app.config["ID_BLOCK_SIZE"])
+    city_ids = AsyncIdAllocator(db, "cities", app.config["ID_BLOCK_SIZE"])
+    temperature_ids = AsyncIdAllocator(db, "temperatures", app.config["ID_BLOCK_SIZE"])
+    change_seqs = AsyncIdAllocator(db, changes.COUNTER)
+    reference_generation = AsyncGeneration(db, "reference")
+    live_updates = live.AsyncLiveUpdates(
+        db[store.name],
+        max_subscribers = app.config["LIVE_MAX_SUBSCRIBERS"],
+        queue_size = app.config["LIVE_QUEUE_SIZE"],
+        poll_interval = app.config["LIVE_POLL_INTERVAL"],
+        lag = app.config["LIVE_POLL_LAG"]
+    )
+
+@app.after_serving
+async def close_mongo():
+    await client.close()
+
+
+def json_response(data, status = 200):
+    return Response(dumps(data), status = status, mimetype = JSON_MIMETYPE)
+
+def error_response(message, status):
+    return json_response({"error" : message}, status)
+
+# create a background job and run it on the event loop, then send its id and status URL
+async def job_response(kind, ref_id, steps):
+    job_id = await jobs.create_async(db, kind, ref_id, steps)
+    task = asyncio.create_task(jobs.run_async(db, job_id, steps))
+    job_tasks.add(task)
+    task.add_done_callback(job_tasks.discard)
+
+    response = json_response({"job" : job_id})
+    response.headers["Location"] = f"/api/jobs/{job_id}"
+    return response
+
+# check the required fields of a request body, returns an error message or None
+def check_fields(data, fields):
+    if not data or not all(field in data for field in fields):
+        return MISSING_FIELDS
+    if not all(isinstance(data.get(field), types) for field, types in fields.items()):
+        return WRONG_TYPES
+    return None
+
+# GeoJSON point of an entry, None if the coordinates are out of range (same as app.py)
+def geo_point(lat, lon):
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return {"type" : "Point", "coordinates" : [lon, lat]}
+
+def location_update(fields, lat, lon):
+    fields = dict(fields, latitudine = lat, longitudine = lon)
+    point = geo_point(lat, lon)
+    if point:
+        return {"$set" : dict(fields, location = point)}
+    return {"$set" : fields, "$unset" : {"location" : ""}}
+
+# near/bbox filters keep their own order (by distance for near), same as app.py
+def cities_cursor(query):
+    cursor = db.cities.find(query, CITY_FIELDS)
+    if "location" not in query:
+        cursor = cursor.sort("id", 1)
+    return cursor
+
+# apply a temperatures query and send the result: limit / after / stream / since, same as app.py
+async def temperatures_response(query):
+    try:
+        limit, after, stream = queries.page_args(request.args, app.config["PAGE_MAX_LIMIT"])
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    if "since" in request.args:
+        if after or stream:
+            return error_response("since can't be used with after or stream", 400)
+        return await changes_response(query, limit)
+
+    if after:
+        try:
+            query = queries.after_filter(query, after)
+        except ValueError:
+            return error_response(queries.INVALID_CURSOR, 400)
+
+    cursor = db.temperatures.find(
+        query,
+        TEMPERATURE_FIELDS,
+        sort = queries.PAGE_SORT if limit is not None or after else None,
+        limit = limit or 0,
+        batch_size = app.config["STREAM_CHUNK_SIZE"]
+    )
+
+    if stream:
+        return Response(
+            json_array_chunks_async(cursor, app.config["STREAM_CHUNK_SIZE"], format_temperatures),
+            status = 200,
+            mimetype = JSON_MIMETYPE
+        )
+
+    temperatures = await cursor.to_list()
+    response = json_response(format_temperatures(temperatures))
+
+    next_cursor = queries.next_cursor(temperatures, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    return response
+
+# incremental sync (since=SEQ, with optional limit=N), same as app.py
+async def changes_response(query, limit):
+    try:
+        since = int(request.args["since"])
+        if since < 0:
+            raise ValueError
+    except ValueError:
+        return error_response("invalid since, please use the X-Sync-Seq of the previous sync (or 0)", 400)
+
+    entries = await changes.since_async(db, query, since, limit, app.config["SYNC_SETTLE"])
+    response = json_response([changes.format_change(e) for e in entries])
+    response.headers["X-Sync-Seq"] = str(entries[-1]["seq"] if entries else since)
+    return response
+
+
+# route 1: add a country to db
+@app.route('/api/countries', methods = ['POST'])
+async def post_country():
+    try:
+        data = await request.get_json()
+        error = check_fields(data, {"nume" : str, "lat" : NUMBER, "lon" : NUMBER})
+        if error:
+            return error_response(error, 400)
+
+        new_id = await country_ids.next_id()
+
+        country = {
+            "id" : new_id,
+            "nume_tara" : data["nume"],
+            "latitudine" : data["lat"],
+            "longitudine" : data["lon"]
+        }
+        point = geo_point(data["lat"], data["lon"])
+        if point:
+            country["location"] = point
+
+        await db.countries.insert_one(country)
+        await reference_generation.bump()
+        return json_response({"id" : new_id}, 201)
+
+    except DuplicateKeyError:
+        return error_response("a country with this name already exists", 409)
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 2: get all countries
+@app.route('/api/countries', methods = ['GET'])
+async def get_countries():
+    try:
+        return json_response([format_country(c) async for c in db.countries.find({}, COUNTRY_FIELDS).sort("id", 1)])
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 3: modify a country
+@app.route('/api/countries/<int:id>', methods = ['PUT'])
+async def put_country(id):
+    try:
+        data = await request.get_json()
+        error = check_fields(data, {"id" : int, "nume" : str, "lat" : NUMBER, "lon" : NUMBER})
+        if error:
+            return error_response(error, 400)
+        if data["id"] != id:
+            return error_response(WRONG_ID, 400)
+
+        result = await db.countries.update_one(
+            {"id" : id},
+            location_update({"nume_tara" : data["nume"]}, data["lat"], data["lon"])
+        )
+        if result.matched_count == 0:
+            return error_response("country was not found", 404)
+
+        await reference_generation.bump()
+        return Response(status = 200)
+
+    except DuplicateKeyError:
+        return error_response("a country with this name already exists", 409)
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 4: delete a country
+@app.route('/api/countries/<int:id>', methods = ['DELETE'])
+async def delete_country(id):
+    try:
+        cities = [c["id"] async for c in db.cities.find({"id_tara" : id}, {"_id" : 0, "id" : 1})]
+
+        result = await db.countries.delete_one({"id" : id})
+        if result.deleted_count == 0:
+            return error_response("country was not found", 404)
+        await db.cities.delete_many({"id_tara" : id})
+        await changes.delete_cities_async(db, change_seqs, {city : id for city in cities})
+        await reference_generation.bump()
+
+        # the readings of the cities are deleted by a background job
+        return await job_response("delete_country", id, jobs.delete_country_steps(store, id, cities))
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+# route 5: add a city to db
+@app.route('/api/cities', methods = ['POST'])
+async def post_city():
+    try:
+        data = await request.get_json()
+        error = check_fields(data, {"idTara" : int, "nume" : str, "lat" : NUMBER, "lon" : NUMBER})
+        if error:
+            return error_response(error, 400)
+
+        # check the country and reserve the id at the same time
+        country_exists, new_id = await asyncio.gather(
+            db.countries.find_one({"id" : data["idTara"]}, {"_id" : 1}),
+            city_ids.next_id()
+        )
+        if not country_exists:
+            return error_response("city's country was not found", 404)
+
+        city = {
+            "id" : new_id,
+            "id_tara" : data["idTara"],
+            "nume_oras" : data["nume"],
+            "latitudine" : data["lat"],
+            "longitudine" : data["lon"]
+        }
+        point = geo_point(data["lat"], data["lon"])
+        if point:
+            city["location"] = point
+
+        await db.cities.insert_one(city)
+        await reference_generation.bump()
+        return json_response({"id" : new_id}, 201)
+
+    except DuplicateKeyError:
+        return error_response("a city with this name already exists", 409)
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 6: get all cities (optionally near a point or inside a bounding box)
+@app.route('/api/cities', methods = ['GET'])
+async def get_cities():
+    try:
+        try:
+            query = queries.area_filter(request.args, nearest = True)
+        except ValueError:
+            return error_response(queries.INVALID_AREA, 400)
+
+        return json_response([format_city(c) async for c in cities_cursor(query)])
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 7: get cities of a coutry
+@app.route('/api/cities/country/<int:id>', methods = ['GET'])
+async def get_country_cities(id):
+    try:
+        return json_response([format_city(c) async for c in cities_cursor({"id_tara" : id})])
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 8: modify a city
+@app.route('/api/cities/<int:id>', methods = ['PUT'])
+async def put_city(id):
+    try:
+        data = await request.get_json()
+        error = check_fields(data, {"id" : int, "idTara" : int, "nume" : str, "lat" : NUMBER, "lon" : NUMBER})
+        if error:
+            return error_response(error, 400)
+        if data["id"] != id:
+            return error_response(WRONG_ID, 400)
+
+        country_exists = await db.countries.find_one({"id" : data["idTara"]}, {"_id" : 1})
+        if not country_exists:
+            return error_response("city's country was not found", 404)
+
+        previous = await db.cities.find_one_and_update(
+            {"id" : id},
+            location_update({"id_tara" : data["idTara"], "nume_oras" : data["nume"]}, data["lat"], data["lon"]),
+            projection = {"id_tara" : 1}
+        )
+        if previous is None:
+            return error_response("city was not found", 404)
+
+        # the city moved to another country: move its temperature entries too
+        # and rebuild the rollups of both countries
+        if previous["id_tara"] != data["idTara"]:
+            await db.temperatures.update_many({"id_oras" : id}, {"$set" : {"id_tara" : data["idTara"]}})
+            await changes.delete_cities_async(db, change_seqs, {id : previous["id_tara"]})
+            await changes.restamp_async(db.temperatures, change_seqs, {"id_oras" : id})
+            await rollups.run_async(db, rollups.rebuild_countries_steps([previous["id_tara"], data["idTara"]]))
+
+        await reference_generation.bump()
+        return Response(status = 200)
+
+    except DuplicateKeyError:
+        return error_response("a city with this name already exists", 409)
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 9: delete a city
+@app.route('/api/cities/<int:id>', methods = ['DELETE'])
+async def delete_city(id):
+    try:
+        previous = await db.cities.find_one_and_delete({"id" : id}, projection = {"id_tara" : 1})
+        if previous is None:
+            return error_response("city was not found", 404)
+        await changes.delete_cities_async(db, change_seqs, {id : previous.get("id_tara")})
+        await reference_generation.bump()
+
+        # the readings of the city are deleted by a background job
+        return await job_response("delete_city", id, jobs.delete_city_steps(store, id, previous.get("id_tara")))
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+# route 10: add a temperature mesurement to db
+@app.route('/api/temperatures', methods = ['POST'])
+async def post_temperature():
+    try:
+        data = await request.get_json()
+        error = check_fields(data, {"idOras" : int, "valoare" : NUMBER})
+        if error:
+            return error_response(error, 400)
+
+        # check the city and reserve the id and the change seq at the same time
+        city_exists, new_id, seq = await asyncio.gather(
+            db.cities.find_one({"id" : data["idOras"]}, {"id_tara" : 1}),
+            temperature_ids.next_id(),
+            change_seqs.reserve()
+        )
+        if not city_exists:
+            return error_response("city was not found", 404)
+
+        temperature = {
+            "id" : new_id,
+            "valoare" : data["valoare"],
+            "timestamp" : utcnow(),
+            "id_oras" : data["idOras"],
+            "id_tara" : city_exists["id_tara"],
+            "seq" : seq,
+            "changed" : utcnow()
+        }
+        await db.temperatures.insert_one(temperature)
+
+        # add the entry to the rollups of its city and country
+        for name, ops in rollups.increments([temperature]).items():
+            if ops:
+                await db[name].bulk_write(ops, ordered = False)
+
+        return json_response({"id" : new_id}, 201)
+
+    except DuplicateKeyError:
+        return error_response("there's already a temperature entry for this city and time", 409)
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 11: get temperatures based on lat, lon, area (near/bbox), start date and/or end date
+@app.route('/api/temperatures', methods = ['GET'])
+async def get_temperatures_filtered():
+    try:
+        try:
+            cities_filter = queries.cities_filter(request.args)
+        except ValueError:
+            return error_response(queries.INVALID_AREA, 400)
+
+        try:
+            query = queries.date_filter(request.args)
+        except ValueError:
+            return error_response(queries.INVALID_DATE, 400)
+        if cities_filter:
+            cities_ids = [c["id"] async for c in db.cities.find(cities_filter, {"_id" : 0, "id" : 1})]
+            query["id_oras"] = {"$in" : cities_ids}
+
+        return await temperatures_response(query)
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 12: get temperatures based on city, start date and/or end date
+@app.route('/api/temperatures/cities/<int:id_oras>', methods = ['GET'])
+async def get_city_temperatures(id_oras):
+    try:
+        try:
+            query = {"id_oras" : id_oras, **queries.date_filter(request.args)}
+        except ValueError:
+            return error_response(queries.INVALID_DATE, 400)
+        return await temperatures_response(query)
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 13: get temperatures based on country, start date and/or end date
+@app.route('/api/temperatures/countries/<int:id_tara>', methods = ['GET'])
+async def get_country_temperatures(id_tara):
+    try:
+        try:
+            query = {"id_tara" : id_tara, **queries.date_filter(request.args)}
+        except ValueError:
+            return error_response(queries.INVALID_DATE, 400)
+        return await temperatures_response(query)
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 14: modify a temperature entry
+@app.route('/api/temperatures/<int:id>', methods = ['PUT'])
+async def put_temperature(id):
+    try:
+        data = await request.get_json()
+        error = check_fields(data, {"id" : int, "idOras" : int, "valoare" : NUMBER})
+        if error:
+            return error_response(error, 400)
+        if data["id"] != id:
+            return error_response(WRONG_ID, 400)
+
+        # two seqs: a tombstone in the old city (if the entry moves), then the update
+        city_exists, seq = await asyncio.gather(
+            db.cities.find_one({"id" : data["idOras"]}, {"id_tara" : 1}),
+            change_seqs.reserve(2)
+        )
+        if not city_exists:
+            return error_response("city was not found", 404)
+
+        previous = await db.temperatures.find_one_and_update(
+            {"id" : id},
+            {"$set" : {
+                "id_oras" : data["idOras"],
+                "id_tara" : city_exists["id_tara"],
+                "valoare" : data["valoare"],
+                "seq" : seq + 1,
+                "changed" : utcnow()
+            }},
+            projection = {"id" : 1, "id_oras" : 1, "id_tara" : 1, "timestamp" : 1},
+            return_document = ReturnDocument.BEFORE
+        )
+        if previous is None:
+            return error_response("temperature entry was not found", 404)
+
+        if previous["id_oras"] != data["idOras"]:
+            await db[changes.TOMBSTONES].insert_one(changes.tombstone(seq, previous))
+
+        # recompute the rollups of the entry's old and new buckets
+        await rollups.run_async(db, rollups.recompute_steps(store, [
+            (previous["id_oras"], previous.get("id_tara"), previous["timestamp"]),
+            (data["idOras"], city_exists["id_tara"], previous["timestamp"])
+        ]))
+
+        return Response(status = 200)
+
+    except DuplicateKeyError:
+        return error_response("there's already a temperature entry for this city and time", 409)
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 15: delete a temperature entry
+@app.route('/api/temperatures/<int:id>', methods = ['DELETE'])
+async def delete_temperature(id):
+    try:
+        previous = await db.temperatures.find_one_and_delete(
+            {"id" : id},
+            projection = {"id" : 1, "id_oras" : 1, "id_tara" : 1, "timestamp" : 1}
+        )
+        if previous is None:
+            return error_response("temperature entry was not found", 404)
+
+        await db[changes.TOMBSTONES].insert_one(changes.tombstone(await change_seqs.reserve(), previous))
+
+        # recompute the rollups of the entry's bucket
+        await rollups.run_async(db, rollups.recompute_steps(store, [
+            (previous["id_oras"], previous.get("id_tara"), previous["timestamp"])
+        ]))
+
+        return Response(status = 200)
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+# route 19: get the status of a background job
+@app.route('/api/jobs/<job_id>', methods = ['GET'])
+async def get_job(job_id):
+    try:
+        job = await db[jobs.JOBS].find_one({"_id" : job_id})
+        if job is None:
+            return error_response("job was not found", 404)
+
+        return json_response(jobs.format_job(job))
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+# route 22: live updates of the new readings, as Server-Sent Events (see app.py)
+@app.route('/api/stream/temperatures', methods = ['GET'])
+async def stream_temperatures():
+    try:
+        try:
+            city, country = (int(request.args[name]) if name in request.args else None for name in ("city", "country"))
+        except ValueError:
+            return error_response("invalid filter, please use city=ID or country=ID", 400)
+        if city is not None and await db.cities.find_one({"id" : city}, {"_id" : 1}) is None:
+            return error_response("city was not found", 404)
+        if country is not None and await db.countries.find_one({"id" : country}, {"_id" : 1}) is None:
+            return error_response("country was not found", 404)
+
+        subscription = live_updates.subscribe(city, country)
+        if subscription is None:
+            return error_response("too many subscribers, please try again later", 503)
+
+        keepalive = app.config["LIVE_KEEPALIVE"]
+
+        async def events():
+            try:
+                yield "retry: 3000\n\n"
+                while not subscription.overflow:
+                    t = await subscription.get(keepalive)
+                    if t is None:
+                        # comment line: keeps proxies from closing an idle stream
+                        yield ": keep-alive\n\n"
+                        continue
+                    yield live.sse_event("temperature", {"idOras" : t["id_oras"], **format_temperatures([t])[0]}, t["id"])
+                yield live.sse_event("overflow", {"error" : "too many readings were not read in time, please reconnect"})
+            finally:
+                live_updates.unsubscribe(subscription)
+
+        response = Response(events(), status = 200, mimetype = "text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        # no buffering by nginx
+        response.headers["X-Accel-Buffering"] = "no"
+        # the stream stays open until the client leaves
+        response.timeout = None
+        return response
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+if __name__ == '__main__':
+    app.run(host = '0.0.0.0', port = 5001)
@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+import uuid
+
+import httpx
+
+# load test comparing the concurrency of the Flask app (gunicorn, app.py) and the
+# async app (hypercorn, app_async.py): every target gets the same mixed workload
+# (writes + city/country/list reads) at increasing numbers of concurrent clients
+# usage (against a throwaway database, the test leaves its readings behind):
+#   python bench/loadtest.py --target flask=http://localhost:5000 --target async=http://localhost:5001
+
+# share of each request kind in the workload
+WORKLOAD = {
+    "post_temperature" : 4,
+    "city_temperatures" : 3,
+    "country_temperatures" : 2,
+    "countries" : 1
+}
+
+
+# create a country with a few cities for the test
+async def setup(client, cities):
+    name = f"loadtest-{uuid.uuid4().hex[:8]}"
+    r = await client.post("/api/countries", json = {"nume" : name, "lat" : 45.0, "lon" : 25.0})
+    r.raise_for_status()
+    country = r.json()["id"]
+
+    city_ids = []
+    for i in range(cities):
+        r = await client.post("/api/cities", json = {"idTara" : country, "nume" : f"{name}-{i}", "lat" : 45.0, "lon" : 25.0})
+        r.raise_for_status()
+        city_ids.append(r.json()["id"])
+    return country, city_ids
+
+async def request(client, kind, country, city_ids):
+    if kind == "post_temperature":
+        return await client.post("/api/temperatures", json = {"idOras" : random.choice(city_ids), "valoare" : random.uniform(-20, 40)})
+    if kind == "city_temperatures":
+        return await client.get(f"/api/temperatures/cities/{random.choice(city_ids)}")
+    if kind == "country_temperatures":
+        return await client.get(f"/api/temperatures/countries/{country}")
+    return await client.get("/api/countries")
+
+async def client_loop(client, stop_at, country, city_ids, latencies, errors):
+    kinds = list(WORKLOAD)
+    weights = list(WORKLOAD.values())
+    while time.perf_counter() < stop_at:
+        kind = random.choices(kinds, weights)[0]
+        start = time.perf_counter()
+        try:
+            r = await request(client, kind, country, city_ids)
+            if r.status_code >= 400:
+                errors[kind] = errors.get(kind, 0) + 1
+        except httpx.HTTPError:
+            errors[kind] = errors.get(kind, 0) + 1
+        latencies.append(time.perf_counter() - start)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+async def run_level(url, concurrency, duration, cities):
+    limits = httpx.Limits(max_connections = concurrency, max_keepalive_connections = concurrency)
+    async with httpx.AsyncClient(base_url = url, limits = limits, timeout = 30) as client:
+        country, city_ids = await setup(client, cities)
+
+        latencies = []
+        errors = {}
+        stop_at = time.perf_counter() + duration
+        await asyncio.gather(*[
+            client_loop(client, stop_at, country, city_ids, latencies, errors)
+            for _ in range(concurrency)
+        ])
+
+    return {
+        "concurrency" : concurrency,
+        "requests" : len(latencies),
+        "rps" : len(latencies) / duration,
+        "p50_ms" : percentile(latencies, 50) * 1000,
+        "p99_ms" : percentile(latencies, 99) * 1000,
+        "mean_ms" : statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "errors" : errors
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description = "compare the Flask and async APIs under concurrent load")
+    parser.add_argument("--target", action = "append", required = True, help = "name=url, e.g. flask=http://localhost:5000")
+    parser.add_argument("--concurrency", default = "1,8,32,128,256", help = "comma separated client counts")
+    parser.add_argument("--duration", type = float, default = 10, help = "seconds per concurrency level")
+    parser.add_argument("--cities", type = int, default = 20, help = "cities created for the test")
+    parser.add_argument("--output", help = "write the results as JSON to this file")
+    args = parser.parse_args()
+
+    targets = dict(t.split("=", 1) for t in args.target)
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    results = {}
+    print(f"{'target':<10}{'clients':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, url in targets.items():
+        results[name] = []
+        for concurrency in levels:
+            r = await run_level(url, concurrency, args.duration, args.cities)
+            results[name].append(r)
+            print(f"{name:<10}{concurrency:>8}{r['rps']:>10.1f}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}{sum(r['errors'].values()):>8}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
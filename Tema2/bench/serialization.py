@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import serialize
+
+# compares the serialization of a temperatures response (no database needed):
+#   per-row - strftime per entry + json.dumps (the previous path of the routes)
+#   bulk    - serialize.format_temperatures + serialize.dumps (orjson if installed)
+# usage:
+#   python bench/serialization.py --rows 100000 --repeat 5
+
+
+# entries as they come from Mongo with the temperatures projection
+def readings(rows):
+    start = datetime(2024, 1, 1)
+    return [
+        {"id" : i, "valoare" : random.uniform(-20, 40), "timestamp" : start + timedelta(minutes = 10 * i)}
+        for i in range(1, rows + 1)
+    ]
+
+def per_row(temperatures):
+    return json.dumps([
+        {
+            "id" : t["id"],
+            "valoare" : t["valoare"],
+            "timestamp" : t["timestamp"].strftime("%Y-%m-%d")
+        }
+        for t in temperatures
+    ], sort_keys = False).encode()
+
+def bulk(temperatures):
+    return serialize.dumps(serialize.format_temperatures(temperatures))
+
+# best of `repeat` runs, in seconds
+def measure(encode, temperatures, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encode(temperatures)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description = "compare the per-row and bulk serialization of temperature entries")
+    parser.add_argument("--rows", type = int, default = 100000, help = "entries per response")
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs per encoder (the best one is kept)")
+    args = parser.parse_args()
+
+    temperatures = readings(args.rows)
+
+    # both paths must send the same entries
+    if json.loads(per_row(temperatures)) != json.loads(bulk(temperatures)):
+        raise SystemExit("the encoders produced different responses")
+
+    print(f"encoder: {'orjson' if serialize.orjson else 'json (orjson not installed)'}, {args.rows} entries")
+    print(f"{'path':<10}{'ms':>10}{'rows/s':>14}")
+    baseline = None
+    for name, encode in (("per-row", per_row), ("bulk", bulk)):
+        elapsed = measure(encode, temperatures, args.repeat)
+        baseline = baseline or elapsed
+        print(f"{name:<10}{elapsed * 1000:>10.1f}{args.rows / elapsed:>14.0f}  x{baseline / elapsed:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,430 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, APP_DIR)
+
+# benchmark suite of the Flask API: seeds a throwaway database, then drives a mixed
+# read/write workload over the routes at a fixed number of concurrent clients and reports
+# p50/p99 latency and throughput per route; every run is saved as JSON (with the git
+# commit), so runs can be compared across commits
+#   against a local mongod, with the app served by gunicorn (needs httpx):
+#     python bench/suite.py run --mongo-uri mongodb://localhost:27017/tema2bench
+#   micro-benchmark, in process, on mongomock (no server, no network; needs mongomock),
+#   with a single client: it measures the cost of each route, not concurrency
+#     python bench/suite.py run --mongomock --readings 20000
+#   compare two runs:
+#     python bench/suite.py compare bench/results/<old>.json bench/results/<new>.json
+# the benchmark database is dropped before seeding
+
+# readings are seeded over DAYS days from START, evenly spaced for each city
+START = datetime(2024, 1, 1)
+DAYS = 30
+
+# name -> (route, default weight) of the workload (weights are relative, 0 disables a route)
+WORKLOAD = {
+    "countries" : ("GET /api/countries", 8),
+    "cities" : ("GET /api/cities", 4),
+    "country_cities" : ("GET /api/cities/country/<id>", 6),
+    "temperatures" : ("GET /api/temperatures", 8),
+    "city_temperatures" : ("GET /api/temperatures/cities/<id>", 14),
+    "country_temperatures" : ("GET /api/temperatures/countries/<id>", 8),
+    "city_stats" : ("GET /api/temperatures/cities/<id>/stats", 4),
+    "batch_temperatures" : ("POST /api/batch/temperatures", 4),
+    "post_temperature" : ("POST /api/temperatures", 30),
+    "put_temperature" : ("PUT /api/temperatures/<id>", 10),
+    "delete_temperature" : ("DELETE /api/temperatures/<id>", 4),
+    "bulk_temperatures" : ("POST /api/temperatures/bulk", 2),
+    "put_country" : ("PUT /api/countries/<id>", 1),
+    "put_city" : ("PUT /api/cities/<id>", 1)
+}
+BULK_SIZE = 100
+BATCH_CITIES = 10
+# routes that recompute rollups with $dateTrunc / $merge, which mongomock doesn't implement:
+# left out of the default mongomock workload (they can still be added with --mix)
+MONGOMOCK_UNSUPPORTED = ("put_temperature", "delete_temperature")
+
+
+# countries, cities and readings of the benchmark database (seeded through the app itself)
+class Dataset:
+    def __init__(self):
+        self.countries = []
+        # city id -> country id
+        self.cities = {}
+        self.city_ids = []
+        self.lock = threading.Lock()
+        # (id, city) of the readings posted by the benchmark: PUT and DELETE use them, so
+        # they never touch a reading that another client is deleting
+        self.posted = []
+
+    def add_posted(self, reading_id, city):
+        with self.lock:
+            self.posted.append((reading_id, city))
+
+    def take_posted(self, rng, remove = False):
+        with self.lock:
+            if not self.posted:
+                return None
+            i = rng.randrange(len(self.posted))
+            if remove:
+                self.posted[i], self.posted[-1] = self.posted[-1], self.posted[i]
+                return self.posted.pop()
+            return self.posted[i]
+
+# httpx responses have json(), Flask test client responses a json property
+def response_json(r):
+    return r.json() if callable(r.json) else r.json
+
+def position(rng):
+    return {"lat" : round(rng.uniform(-60, 70), 4), "lon" : round(rng.uniform(-170, 170), 4)}
+
+# (line, row) import rows: `per_city` readings of every city, evenly spaced over DAYS days
+def reading_rows(city_ids, per_city, rng):
+    step = timedelta(days = DAYS) / max(1, per_city)
+    line = 0
+    for city in city_ids:
+        for k in range(per_city):
+            line += 1
+            yield line, {"idOras" : city, "valoare" : round(rng.uniform(-20, 40), 2), "timestamp" : (START + k * step).isoformat()}
+
+# countries and cities through the API, the readings with the importer (as a file import would)
+def seed(app_module, client, countries, cities, readings, rng):
+    import importer
+
+    data = Dataset()
+    for i in range(countries):
+        r = client.post("/api/countries", json = {"nume" : f"bench-country-{i}", **position(rng)})
+        data.countries.append(response_json(r)["id"])
+
+    for i in range(cities):
+        country = data.countries[i % countries]
+        r = client.post("/api/cities", json = {"idTara" : country, "nume" : f"bench-city-{i}", **position(rng)})
+        city = response_json(r)["id"]
+        data.cities[city] = country
+        data.city_ids.append(city)
+
+    rows = reading_rows(data.city_ids, readings // max(1, cities), rng)
+    readings_importer = importer.Importer(app_module.mongo, app_module.temperature_store, app_module.temperature_ids, app_module.change_seqs)
+    readings_importer.cities = importer.Cities(app_module.mongo.db)
+    counts, elapsed = readings_importer.run(rows, report_every = 10)
+    print(f"seeded {len(data.countries)} countries, {len(data.city_ids)} cities, {counts['inserted']} readings in {elapsed:.1f}s")
+    return data
+
+
+# one request of each kind: returns the response (anything with a status_code)
+def day_window(rng):
+    day = START + timedelta(days = rng.randrange(DAYS))
+    return f"from={day:%Y-%m-%d}&until={day + timedelta(days = 1):%Y-%m-%d}"
+
+def request(kind, client, data, rng):
+    city = rng.choice(data.city_ids)
+    country = rng.choice(data.countries)
+
+    if kind == "countries":
+        return client.get("/api/countries")
+    if kind == "cities":
+        return client.get("/api/cities")
+    if kind == "country_cities":
+        return client.get(f"/api/cities/country/{country}")
+    if kind == "temperatures":
+        return client.get(f"/api/temperatures?{day_window(rng)}")
+    if kind == "city_temperatures":
+        return client.get(f"/api/temperatures/cities/{city}")
+    if kind == "country_temperatures":
+        return client.get(f"/api/temperatures/countries/{country}?{day_window(rng)}")
+    if kind == "city_stats":
+        return client.get(f"/api/temperatures/cities/{city}/stats")
+    if kind == "batch_temperatures":
+        cities = rng.sample(data.city_ids, min(BATCH_CITIES, len(data.city_ids)))
+        day = START + timedelta(days = rng.randrange(DAYS))
+        return client.post("/api/batch/temperatures", json = {"cities" : cities, "from" : f"{day:%Y-%m-%d}", "until" : f"{day + timedelta(days = 7):%Y-%m-%d}"})
+    if kind == "bulk_temperatures":
+        items = [{"idOras" : rng.choice(data.city_ids), "valoare" : round(rng.uniform(-20, 40), 2)} for _ in range(BULK_SIZE)]
+        return client.post("/api/temperatures/bulk", json = items)
+    if kind == "put_country":
+        return client.put(f"/api/countries/{country}", json = {"id" : country, "nume" : f"bench-country-{data.countries.index(country)}", **position(rng)})
+    if kind == "put_city":
+        i = data.city_ids.index(city)
+        return client.put(f"/api/cities/{city}", json = {"id" : city, "idTara" : data.cities[city], "nume" : f"bench-city-{i}", **position(rng)})
+
+    if kind in ("put_temperature", "delete_temperature"):
+        reading = data.take_posted(rng, remove = kind == "delete_temperature")
+        if reading is not None:
+            reading_id, city = reading
+            if kind == "put_temperature":
+                return client.put(f"/api/temperatures/{reading_id}", json = {"id" : reading_id, "idOras" : city, "valoare" : round(rng.uniform(-20, 40), 2)})
+            return client.delete(f"/api/temperatures/{reading_id}")
+
+    # post_temperature (also when there's no posted reading to update or delete yet)
+    r = client.post("/api/temperatures", json = {"idOras" : city, "valoare" : round(rng.uniform(-20, 40), 2)})
+    if r.status_code == 201:
+        data.add_posted(response_json(r)["id"], city)
+    return r
+
+
+# one benchmark client: requests back to back until stop_at, latencies recorded after warm_until
+def client_loop(make_client, data, weights, seed_value, warm_until, stop_at, samples, errors):
+    rng = random.Random(seed_value)
+    kinds = list(weights)
+    kind_weights = list(weights.values())
+    client = make_client()
+
+    while True:
+        start = time.perf_counter()
+        if start >= stop_at:
+            break
+        kind = rng.choices(kinds, kind_weights)[0]
+        try:
+            failed = request(kind, client, data, rng).status_code >= 400
+        except Exception:
+            failed = True
+        end = time.perf_counter()
+
+        if start >= warm_until:
+            samples.setdefault(kind, []).append(end - start)
+            if failed:
+                errors[kind] = errors.get(kind, 0) + 1
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def summary(latencies, errors, duration):
+    latencies = sorted(latencies)
+    return {
+        "requests" : len(latencies),
+        "errors" : errors,
+        "rps" : len(latencies) / duration,
+        "p50_ms" : percentile(latencies, 50) * 1000,
+        "p99_ms" : percentile(latencies, 99) * 1000,
+        "mean_ms" : statistics.fmean(latencies) * 1000 if latencies else 0.0
+    }
+
+# run the workload with `concurrency` client threads, returns the stats per route and in total
+def run_workload(make_client, data, weights, concurrency, warmup, duration, seed_value):
+    warm_until = time.perf_counter() + warmup
+    stop_at = warm_until + duration
+    samples = [{} for _ in range(concurrency)]
+    errors = [{} for _ in range(concurrency)]
+
+    threads = [
+        threading.Thread(target = client_loop, args = (make_client, data, weights, seed_value + i, warm_until, stop_at, samples[i], errors[i]))
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    routes = {}
+    for kind in weights:
+        latencies = [l for s in samples for l in s.get(kind, [])]
+        failed = sum(e.get(kind, 0) for e in errors)
+        routes[kind] = {"route" : WORKLOAD[kind][0], **summary(latencies, failed, duration)}
+
+    total = summary([l for s in samples for ls in s.values() for l in ls], sum(sum(e.values()) for e in errors), duration)
+    return routes, total
+
+
+# the app module on a mongomock client (in process)
+def mongomock_app(database):
+    import mongomock
+    import mongomock.collection
+
+    import app as app_module
+
+    # pymongo 4.11+ passes a sort argument to the bulk updates, which mongomock doesn't take
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+    if "sort" not in add_update.__code__.co_varnames:
+        mongomock.collection.BulkOperationBuilder.add_update = lambda self, *args, sort = None, **kwargs: add_update(self, *args, **kwargs)
+
+    client = mongomock.MongoClient()
+    app_module.mongo.cx = client
+    app_module.mongo.db = client[database]
+    app_module.configure_mongodb()
+    return app_module
+
+# the app module on the benchmark database: seeding happens in this process, then gunicorn
+# serves the app from the same database
+def mongod_app(uri):
+    os.environ["MONGO_URI"] = uri
+    import app as app_module
+
+    app_module.mongo.cx.drop_database(app_module.mongo.db.name)
+    app_module.init_db()
+    return app_module
+
+def start_server(uri, port, workers, threads):
+    env = dict(os.environ, MONGO_URI = uri, PORT = str(port), WEB_CONCURRENCY = str(workers), GUNICORN_THREADS = str(threads))
+    return subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:application"], cwd = APP_DIR, env = env)
+
+def wait_ready(url, server, timeout = 30):
+    import httpx
+
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if server is not None and server.poll() is not None:
+            raise SystemExit("the server exited before it was ready")
+        try:
+            if httpx.get(f"{url}/api/countries", timeout = 2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise SystemExit(f"{url} was not ready after {timeout}s")
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = APP_DIR, capture_output = True, text = True, check = True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd = APP_DIR, capture_output = True, text = True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def parse_weights(mix, excluded = ()):
+    weights = {kind : 0 if kind in excluded else weight for kind, (_, weight) in WORKLOAD.items()}
+    for item in mix:
+        kind, _, weight = item.partition("=")
+        if kind not in WORKLOAD:
+            raise SystemExit(f"unknown route {kind}, use one of: {', '.join(WORKLOAD)}")
+        weights[kind] = float(weight)
+    return {kind : weight for kind, weight in weights.items() if weight > 0}
+
+def print_results(routes, total):
+    print(f"{'route':<42}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for r in list(routes.values()) + [{"route" : "total", **total}]:
+        print(f"{r['route']:<42}{r['requests']:>10}{r['rps']:>10.1f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['errors']:>8}")
+
+def run(args):
+    if not args.mongomock and "bench" not in args.mongo_uri.rsplit("/", 1)[-1]:
+        raise SystemExit("the benchmark drops its database, please use a database name with 'bench' in it")
+
+    rng = random.Random(args.seed)
+    weights = parse_weights(args.mix, MONGOMOCK_UNSUPPORTED if args.mongomock else ())
+    server = None
+
+    if args.mongomock:
+        # mongomock isn't thread-safe (it changes the projection dicts while it reads them):
+        # concurrent clients would only take turns, so the run is sequential
+        if args.concurrency != 1:
+            print(f"--mongomock runs a single client, not {args.concurrency}: the results are not concurrent")
+            args.concurrency = 1
+        app_module = mongomock_app("tema2bench")
+        client = app_module.app.test_client()
+        data = seed(app_module, client, args.countries, args.cities, args.readings, rng)
+        make_client = app_module.app.test_client
+    else:
+        import httpx
+
+        app_module = mongod_app(args.mongo_uri)
+        data = seed(app_module, app_module.app.test_client(), args.countries, args.cities, args.readings, rng)
+        app_module.mongo.cx.close()
+
+        url = args.url or f"http://127.0.0.1:{args.port}"
+        if not args.url:
+            server = start_server(args.mongo_uri, args.port, args.workers, args.threads)
+        limits = httpx.Limits(max_connections = 1, max_keepalive_connections = 1)
+        make_client = lambda: httpx.Client(base_url = url, limits = limits, timeout = 30)
+
+    try:
+        if server is not None or args.url:
+            wait_ready(url, server)
+        print(f"{args.concurrency} clients, {args.warmup:.0f}s warm-up, {args.duration:.0f}s measured")
+        routes, total = run_workload(make_client, data, weights, args.concurrency, args.warmup, args.duration, args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print_results(routes, total)
+
+    result = {
+        "commit" : git_commit(),
+        "date" : datetime.now().isoformat(timespec = "seconds"),
+        "backend" : "mongomock" if args.mongomock else "mongod",
+        "storage" : app_module.temperature_store.mode,
+        "shard_key" : app_module.app.config["TEMPERATURES_SHARD_KEY"],
+        "config" : {
+            "countries" : args.countries, "cities" : args.cities, "readings" : args.readings,
+            "concurrency" : args.concurrency, "duration" : args.duration, "warmup" : args.warmup,
+            "workers" : None if args.mongomock else args.workers, "threads" : None if args.mongomock else args.threads,
+            "seed" : args.seed, "weights" : weights
+        },
+        "routes" : routes,
+        "total" : total
+    }
+    output = args.output
+    if os.path.isdir(output) or output.endswith(os.sep):
+        os.makedirs(output, exist_ok = True)
+        output = os.path.join(output, f"{datetime.now():%Y%m%d-%H%M%S}-{result['commit']}-{result['backend']}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent = 2)
+    print(f"results saved to {output}")
+
+
+# relative change of the new value, in percent
+def change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print(f"{old['commit']} ({old['date']}) -> {new['commit']} ({new['date']})")
+    if old["config"] != new["config"] or old["backend"] != new["backend"]:
+        print("warning: the runs have different configurations, the numbers may not be comparable")
+
+    print(f"{'route':<42}{'req/s':>23}{'p50 ms':>23}{'p99 ms':>23}")
+    rows = [(r, old["routes"][kind], new["routes"][kind]) for kind, r in ((k, WORKLOAD[k][0]) for k in new["routes"]) if kind in old["routes"]]
+    for route, o, n in rows + [("total", old["total"], new["total"])]:
+        cells = "".join(f"{n[key]:>14.2f} {change(o[key], n[key]):>+7.1f}%" for key in ("rps", "p50_ms", "p99_ms"))
+        print(f"{route:<42}{cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "benchmark suite of the API")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    run_parser = commands.add_parser("run", help = "seed a benchmark database and run the workload")
+    run_parser.add_argument("--mongo-uri", default = "mongodb://localhost:27017/tema2bench", help = "local mongod, the database is dropped")
+    run_parser.add_argument("--mongomock", action = "store_true", help = "run in process on mongomock (micro-benchmark)")
+    run_parser.add_argument("--url", help = "benchmark an app that is already running on --mongo-uri instead of starting gunicorn")
+    run_parser.add_argument("--port", type = int, default = 5055)
+    run_parser.add_argument("--workers", type = int, default = 2, help = "gunicorn worker processes")
+    run_parser.add_argument("--threads", type = int, default = 4, help = "gunicorn threads per worker")
+    run_parser.add_argument("--countries", type = int, default = 10)
+    run_parser.add_argument("--cities", type = int, default = 100)
+    run_parser.add_argument("--readings", type = int, default = 100000)
+    run_parser.add_argument("--concurrency", type = int, default = 16, help = "concurrent clients")
+    run_parser.add_argument("--duration", type = float, default = 30, help = "measured seconds")
+    run_parser.add_argument("--warmup", type = float, default = 5, help = "seconds run before measuring")
+    run_parser.add_argument("--mix", action = "append", default = [], metavar = "ROUTE=WEIGHT",
+        help = f"change the weight of a route (0 disables it): {', '.join(WORKLOAD)}")
+    run_parser.add_argument("--seed", type = int, default = 1, help = "random seed of the data and the workload")
+    run_parser.add_argument("--output", default = os.path.join(BENCH_DIR, "results") + os.sep, help = "JSON file or directory")
+
+    compare_parser = commands.add_parser("compare", help = "compare two saved runs")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
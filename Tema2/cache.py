@@ -0,0 +1,205 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from pymongo import ReturnDocument
+
+# optional shared backend, used only when a Redis URL is configured
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# version of some cached data shared by all the workers: a counter document in the
+# "counters" collection ({"_id": <name>, "seq": n}), incremented by every change of the data
+# a worker compares it with the version its own copy was built from, so a change made by
+# any worker invalidates the copies of all of them
+# the counter is read at most every `max_age` seconds (the lookups in between are in memory),
+# so a change made by another worker is seen within max_age; the changes of this worker are
+# seen right away
+class Generation:
+    def __init__(self, mongo, name, max_age = 0):
+        self.mongo = mongo
+        self.name = name
+        self.max_age = max_age
+        # (value, monotonic time it was read)
+        self.last = None
+
+    def current(self):
+        last = self.last
+        if last is not None and time.monotonic() - last[1] < self.max_age:
+            return last[0]
+        counter = self.mongo.db.counters.find_one({"_id" : self.name})
+        return self.remember(counter)
+
+    def bump(self):
+        counter = self.mongo.db.counters.find_one_and_update(
+            {"_id" : self.name}, {"$inc" : {"seq" : 1}}, upsert = True, return_document = ReturnDocument.AFTER
+        )
+        self.remember(counter)
+
+    def remember(self, counter):
+        value = counter["seq"] if counter else 0
+        self.last = (value, time.monotonic())
+        return value
+
+
+# same counter, bumped by an AsyncMongoClient app (its writes invalidate the caches of the sync app)
+class AsyncGeneration:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    async def bump(self):
+        await self.db.counters.update_one({"_id" : self.name}, {"$inc" : {"seq" : 1}}, upsert = True)
+
+
+# cache of serialized responses: key -> (body bytes, etag)
+# entries expire after `ttl` seconds, the least recently used ones are evicted
+# after `max_entries`; with a Redis URL the entries are shared by all workers
+# (and invalidated for all of them), otherwise each process keeps its own and a
+# shared `generation` (see Generation) invalidates them in every worker: a lookup
+# only serves entries built from the current generation
+class ResponseCache:
+    def __init__(self, max_entries = 256, ttl = 60, redis_url = None, prefix = "scd:cache", generation = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prefix = prefix
+        self.generation = generation
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.redis = None
+
+        if redis_url:
+            if redis is None:
+                print("redis package is not installed, using the in-process cache")
+            else:
+                self.redis = redis.Redis.from_url(redis_url)
+
+    @staticmethod
+    def etag(body):
+        return hashlib.blake2b(body, digest_size = 16).hexdigest()
+
+    # version of the cached data, read before the lookup and passed to get() / set(), so an
+    # entry built while the data changed is stored under the old version and never served
+    # every clear() bumps it, so old entries are never read again
+    def version(self):
+        if self.redis is not None:
+            return int(self.redis.get(f"{self.prefix}:gen") or 0)
+        if self.generation is not None:
+            return self.generation.current()
+        return 0
+
+    def redis_key(self, key, version):
+        return f"{self.prefix}:{version}:{key}"
+
+    def get(self, key, version = 0):
+        if self.redis is not None:
+            entry = self.redis.hmget(self.redis_key(key, version), "body", "etag")
+            return (entry[0], entry[1].decode()) if entry[0] is not None else None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic() or entry[3] != version:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def set(self, key, body, version = 0):
+        etag = self.etag(body)
+
+        if self.redis is not None:
+            name = self.redis_key(key, version)
+            pipe = self.redis.pipeline()
+            pipe.hset(name, mapping = {"body" : body, "etag" : etag})
+            pipe.expire(name, self.ttl)
+            pipe.execute()
+            return body, etag
+
+        with self.lock:
+            self.entries[key] = (body, etag, time.monotonic() + self.ttl, version)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+        return body, etag
+
+    def clear(self):
+        if self.generation is not None:
+            self.generation.bump()
+        if self.redis is not None:
+            self.redis.incr(f"{self.prefix}:gen")
+            return
+
+        with self.lock:
+            self.entries.clear()
+
+
+# ids known to exist in a collection (with a few fields of each entry), so the
+# foreign key checks on the write routes are in-memory lookups
+# a miss is checked in the database (the id may have been created by another
+# worker); with a shared `generation` (see Generation), bumped by every write of
+# the collection, the map is reloaded when another worker changed or deleted an id
+# (seen within the max_age of the generation), otherwise the whole map is reloaded
+# every `refresh` seconds, which bounds how long those ids are remembered
+class KnownIds:
+    def __init__(self, mongo, name, fields = (), refresh = 30, generation = None):
+        self.mongo = mongo
+        self.name = name
+        self.fields = ("id",) + tuple(fields)
+        self.projection = {"_id" : 0, **{f : 1 for f in self.fields}}
+        self.refresh = refresh
+        self.generation = generation
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.loaded_at = None
+        self.loaded_version = None
+
+    # version of the data, read before the map so a change made during the load reloads it again
+    def version(self):
+        return self.generation.current() if self.generation is not None else None
+
+    def load(self, version = None):
+        if version is None:
+            version = self.version()
+        entries = {e["id"] : e for e in self.mongo.db[self.name].find({}, self.projection)}
+        with self.lock:
+            self.entries = entries
+            self.loaded_at = time.monotonic()
+            self.loaded_version = version
+
+    def expired(self, version = None):
+        if self.loaded_at is None or version != self.loaded_version:
+            return True
+        return self.generation is None and time.monotonic() - self.loaded_at > self.refresh
+
+    # entry of an id (a dict with the selected fields), None if it doesn't exist
+    def get(self, id):
+        return self.get_many([id]).get(id)
+
+    # entries of some ids, checking all the misses with a single $in query
+    def get_many(self, ids):
+        version = self.version()
+        if self.expired(version):
+            self.load(version)
+
+        entries = self.entries
+        found = {id : entries[id] for id in ids if id in entries}
+        missing = [id for id in ids if id not in found]
+        if missing:
+            for e in self.mongo.db[self.name].find({"id" : {"$in" : missing}}, self.projection):
+                found[e["id"]] = e
+                self.add(e)
+        return found
+
+    def add(self, entry):
+        with self.lock:
+            self.entries[entry["id"]] = {f : entry[f] for f in self.fields if f in entry}
+
+    def discard(self, id):
+        with self.lock:
+            self.entries.pop(id, None)
@@ -0,0 +1,159 @@
+import heapq
+from datetime import datetime, timedelta
+from itertools import islice
+
+from pymongo import UpdateOne
+
+from serialize import utcnow
+
+# change sequence of the readings, for the incremental sync of routes 11-13 (since=<seq>):
+# every write of a reading (insert, update, import) stamps it with the next value of the
+# "temperature_changes" counter (seq) and the time of the write (changed)
+# deletes leave tombstones in temperature_tombstones, removed after a TTL:
+#   {"seq", "id", "id_oras", "id_tara", "deleted"} - a deleted reading (or one that moved
+#                                                    to another city)
+#   {"seq", "id_oras", "id_tara", "deleted"}       - all the readings of a deleted city (or
+#                                                    of a city that moved to another country)
+# the counter hands out one seq per write (no blocks), so the seqs follow the order of the
+# writes; since a write that got its seq first may still be stored after the next one, a
+# sync only returns the changes older than a few seconds (settle)
+TOMBSTONES = "temperature_tombstones"
+COUNTER = "temperature_changes"
+FIELDS = {"_id" : 0, "id" : 1, "valoare" : 1, "timestamp" : 1, "seq" : 1}
+TOMBSTONE_FIELDS = {"_id" : 0, "id" : 1, "id_oras" : 1, "seq" : 1, "deleted" : 1}
+# changed time of the readings stored before the change sequence
+EPOCH = datetime(1970, 1, 1)
+
+
+# tombstones are removed `ttl` seconds after the delete
+def configure(db, ttl):
+    db[TOMBSTONES].create_index("seq")
+    db[TOMBSTONES].create_index([("id_oras", 1), ("seq", 1)])
+    db[TOMBSTONES].create_index([("id_tara", 1), ("seq", 1)])
+    db[TOMBSTONES].create_index("deleted", expireAfterSeconds = ttl)
+
+# the largest seq handed out, to seed the counter
+def max_seq(db, store):
+    docs = [
+        db[name].find_one({"seq" : {"$ne" : None}}, {"_id" : 0, "seq" : 1}, sort = [("seq", -1)])
+        for name in store.collection_names() + [TOMBSTONES]
+    ]
+    return max((doc["seq"] for doc in docs if doc), default = 0)
+
+# stamp readings before they are written, with one reservation for all of them
+def stamp(readings, allocator):
+    if not readings:
+        return readings
+    first = allocator.reserve(len(readings))
+    now = utcnow()
+    for offset, reading in enumerate(readings):
+        reading["seq"] = first + offset
+        reading["changed"] = now
+    return readings
+
+async def stamp_async(readings, allocator):
+    if not readings:
+        return readings
+    first = await allocator.reserve(len(readings))
+    now = utcnow()
+    for offset, reading in enumerate(readings):
+        reading["seq"] = first + offset
+        reading["changed"] = now
+    return readings
+
+def tombstone(seq, reading):
+    return {
+        "seq" : seq,
+        "id" : reading["id"],
+        "id_oras" : reading["id_oras"],
+        "id_tara" : reading.get("id_tara"),
+        "deleted" : utcnow()
+    }
+
+# tombstones of all the readings of some cities: {id_oras: id_tara}
+def city_tombstones(first_seq, cities):
+    now = utcnow()
+    return [
+        {"seq" : first_seq + offset, "id_oras" : city, "id_tara" : country, "deleted" : now}
+        for offset, (city, country) in enumerate(cities.items())
+    ]
+
+def delete_cities(db, allocator, cities):
+    if cities:
+        db[TOMBSTONES].insert_many(city_tombstones(allocator.reserve(len(cities)), cities))
+
+async def delete_cities_async(db, allocator, cities):
+    if cities:
+        await db[TOMBSTONES].insert_many(city_tombstones(await allocator.reserve(len(cities)), cities))
+
+# give new seqs to the stored readings matching a filter, e.g. the readings of a city that
+# moved to another country, or (with {"seq": None}) the readings stored before the change
+# sequence; returns the number of readings stamped
+def restamp(collection, allocator, query, changed = None, batch_size = 1000):
+    count = 0
+    ids = [doc["_id"] for doc in collection.find(query, {"_id" : 1})]
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        first = allocator.reserve(len(batch))
+        now = changed or utcnow()
+        collection.bulk_write([
+            UpdateOne({"_id" : id}, {"$set" : {"seq" : first + offset, "changed" : now}})
+            for offset, id in enumerate(batch)
+        ], ordered = False)
+        count += len(batch)
+    return count
+
+async def restamp_async(collection, allocator, query, batch_size = 1000):
+    count = 0
+    ids = [doc["_id"] async for doc in collection.find(query, {"_id" : 1})]
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        first = await allocator.reserve(len(batch))
+        now = utcnow()
+        await collection.bulk_write([
+            UpdateOne({"_id" : id}, {"$set" : {"seq" : first + offset, "changed" : now}})
+            for offset, id in enumerate(batch)
+        ], ordered = False)
+        count += len(batch)
+    return count
+
+
+# filters of the changes after `seq` of the readings matching a (flat) filter: the stored
+# readings, and the tombstones (filtered by city/country only, deleting a reading that a
+# mirror doesn't have is a no-op)
+def since_filters(query, seq, settle):
+    cutoff = utcnow() - timedelta(seconds = settle)
+    readings = {**query, "seq" : {"$gt" : seq}, "changed" : {"$lte" : cutoff}}
+    tombstones = {key : value for key, value in query.items() if key != "timestamp"}
+    tombstones.update({"seq" : {"$gt" : seq}, "deleted" : {"$lte" : cutoff}})
+    return readings, tombstones
+
+# readings and tombstones (both ordered by seq) in a single list ordered by seq, at most `limit`
+def merge(readings, tombstones, limit):
+    return list(islice(heapq.merge(readings, tombstones, key = lambda entry : entry["seq"]), limit))
+
+# the changes after `seq`, ordered by seq, at most `limit`
+def since(store, db, query, seq, limit = None, settle = 2):
+    readings_filter, tombstones_filter = since_filters(query, seq, settle)
+    readings = store.find(readings_filter, sort = [("seq", 1)], limit = limit, projection = FIELDS)
+    tombstones = db[TOMBSTONES].find(tombstones_filter, TOMBSTONE_FIELDS).sort("seq", 1)
+    if limit:
+        tombstones = tombstones.limit(limit)
+    return merge(readings, tombstones, limit)
+
+async def since_async(db, query, seq, limit = None, settle = 2):
+    readings_filter, tombstones_filter = since_filters(query, seq, settle)
+    readings = db.temperatures.find(readings_filter, FIELDS).sort("seq", 1)
+    tombstones = db[TOMBSTONES].find(tombstones_filter, TOMBSTONE_FIELDS).sort("seq", 1)
+    if limit:
+        readings = readings.limit(limit)
+        tombstones = tombstones.limit(limit)
+    return merge(await readings.to_list(), await tombstones.to_list(), limit)
+
+# API format of a change: a reading, or a tombstone (of a reading or of all the readings of a city)
+def format_change(entry):
+    if "deleted" not in entry:
+        return {"id" : entry["id"], "valoare" : entry["valoare"], "timestamp" : entry["timestamp"].date(), "seq" : entry["seq"]}
+    if "id" in entry:
+        return {"id" : entry["id"], "seq" : entry["seq"], "deleted" : True}
+    return {"idOras" : entry["id_oras"], "seq" : entry["seq"], "deleted" : True}
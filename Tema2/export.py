@@ -0,0 +1,146 @@
+import csv
+import io
+from array import array
+from datetime import datetime, timedelta
+
+from serialize import dumps
+
+# optional, needed only for the parquet export
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# bulk export of the temperature readings, as chunks of bytes written straight from a
+# mongo cursor: every chunk holds up to `size` readings, so the memory used doesn't
+# depend on the size of the export
+FIELDS = ("id", "id_oras", "id_tara", "valoare", "timestamp")
+PROJECTION = {"_id" : 0, **{field : 1 for field in FIELDS}}
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds = 1)
+
+
+# the cursor in lists of `size` readings
+def batches(cursor, size):
+    batch = []
+    for reading in cursor:
+        batch.append(reading)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def csv_chunks(cursor, size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator = "\n")
+    writer.writerow(FIELDS)
+
+    for batch in batches(cursor, size):
+        writer.writerows(
+            (r["id"], r["id_oras"], r.get("id_tara", ""), r["valoare"], r["timestamp"].isoformat())
+            for r in batch
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # only the header, for an empty export
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def ndjson_chunks(cursor, size):
+    for batch in batches(cursor, size):
+        yield b"\n".join(map(dumps, batch)) + b"\n"
+
+
+# write-only file for the parquet writer: collects what was written since the last
+# chunk, and tracks the position (the writer asks for it to place the row group offsets)
+class ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    # the bytes written since the last call
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def parquet_schema():
+    return pyarrow.schema([
+        ("id", pyarrow.int64()),
+        ("id_oras", pyarrow.int64()),
+        ("id_tara", pyarrow.int64()),
+        ("valoare", pyarrow.float64()),
+        ("timestamp", pyarrow.timestamp("us"))
+    ])
+
+# arrow array of `count` values straight from a typed array buffer (no per-value conversion),
+# with an optional validity bitmap
+def column(values, kind, count, validity = None):
+    return pyarrow.Array.from_buffers(kind, count, [validity, pyarrow.py_buffer(values)])
+
+# one row group per batch: every column is filled into a typed array (array.array) and
+# handed to arrow as a buffer, instead of building a dict / list per reading
+def parquet_chunks(cursor, size):
+    schema = parquet_schema()
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression = "zstd")
+
+    for batch in batches(cursor, size):
+        ids = array("q")
+        cities = array("q")
+        countries = array("q")
+        countries_valid = []
+        values = array("d")
+        timestamps = array("q")
+
+        for r in batch:
+            ids.append(r["id"])
+            cities.append(r["id_oras"])
+            country = r.get("id_tara")
+            countries.append(country or 0)
+            countries_valid.append(country is not None)
+            values.append(r["valoare"])
+            timestamps.append((r["timestamp"] - EPOCH) // MICROSECOND)
+
+        count = len(batch)
+        validity = None if all(countries_valid) else pyarrow.array(countries_valid, pyarrow.bool_()).buffers()[1]
+        writer.write_batch(pyarrow.RecordBatch.from_arrays([
+            column(ids, pyarrow.int64(), count),
+            column(cities, pyarrow.int64(), count),
+            column(countries, pyarrow.int64(), count, validity),
+            column(values, pyarrow.float64(), count),
+            column(timestamps, pyarrow.timestamp("us"), count)
+        ], schema = schema))
+        yield sink.take()
+
+    # the footer
+    writer.close()
+    yield sink.take()
+
+
+# format -> (chunk generator, content type, file extension)
+FORMATS = {
+    "csv" : (csv_chunks, "text/csv", "csv"),
+    "ndjson" : (ndjson_chunks, "application/x-ndjson", "ndjson"),
+    "parquet" : (parquet_chunks, "application/vnd.apache.parquet", "parquet")
+}
+
+# the formats that can be used (parquet needs pyarrow)
+def available_formats():
+    return [name for name in FORMATS if name != "parquet" or pyarrow is not None]
@@ -0,0 +1,51 @@
+import multiprocessing
+import os
+import sys
+import tempfile
+
+# production server settings, every knob can be set from the environment
+#   WEB_CONCURRENCY   - worker processes (default 2 * cores + 1)
+#   GUNICORN_THREADS  - threads per worker; keep MONGO_MAX_POOL_SIZE >= threads
+#                       (a live updates subscriber holds one, at most threads - 1 of them)
+#   GUNICORN_PRELOAD  - load the app (and run the Mongo config) once, before forking
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 0))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() in ("1", "true")
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG")
+
+# Prometheus metrics of all the workers (see metrics.py): the workers write their values to
+# files in this directory, read before the app is loaded; a new empty directory for every
+# server unless PROMETHEUS_MULTIPROC_DIR is set (then it must be emptied before a start)
+if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix = "prometheus-")
+
+
+# with preload the master configured Mongo, so it holds a client:
+# close it before forking, the workers must not share its sockets
+def when_ready(server):
+    app = sys.modules.get("app")
+    if app is not None:
+        app.mongo.cx.close()
+
+
+# give every worker forked from a preloaded master its own MongoClient
+def post_fork(server, worker):
+    app = sys.modules.get("app")
+    if app is not None:
+        app.reset_after_fork()
+
+
+
+# write the readings still queued by the worker (INGEST_BUFFERED) before it exits
+# and drop its live metric values
+def worker_exit(server, worker):
+    app = sys.modules.get("app")
+    if app is not None:
+        app.write_behind.close()
+        app.metrics.process_exited(worker.pid)
@@ -0,0 +1,89 @@
+import asyncio
+import threading
+
+from pymongo import ReturnDocument
+
+
+# hands out unique, increasing ids for one collection using a counter document
+# stored in the "counters" collection: {"_id": <collection name>, "seq": <last id>}
+# every reservation is a single atomic find_one_and_update with $inc, so two
+# concurrent writers (threads, processes or hosts) can never get the same id
+class IdAllocator:
+    def __init__(self, mongo, name, block_size = 1):
+        self.mongo = mongo
+        self.name = name
+        self.block_size = max(1, int(block_size))
+        self.lock = threading.Lock()
+        self.next = 0
+        self.end = 0
+
+    # reserve `count` consecutive ids directly from the counter
+    # returns the first id of the block: [first, first + count)
+    def reserve(self, count = 1):
+        counter = self.mongo.db.counters.find_one_and_update(
+            {"_id" : self.name},
+            {"$inc" : {"seq" : count}},
+            upsert = True,
+            return_document = ReturnDocument.AFTER
+        )
+        return counter["seq"] - count + 1
+
+    # get one id, served from an in-memory block claimed with a single reservation
+    def next_id(self):
+        with self.lock:
+            if self.next >= self.end:
+                self.next = self.reserve(self.block_size)
+                self.end = self.next + self.block_size
+            new_id = self.next
+            self.next += 1
+            return new_id
+
+    # drop the in-memory block (e.g. after fork, so two workers never share it)
+    def reset(self):
+        with self.lock:
+            self.next = 0
+            self.end = 0
+
+    # make sure the counter is at least the current max id of the collection
+    # (or the given max id, for collections with another layout)
+    # $max is atomic and idempotent, so every worker can safely run this at startup
+    def seed(self, max_id = None):
+        if max_id is None:
+            # entries without an id sort last, so this is read from the id index only
+            doc = self.mongo.db[self.name].find_one({}, projection = {"_id" : 0, "id" : 1}, sort = [("id", -1)])
+            max_id = doc.get("id", 0) if doc else 0
+
+        self.mongo.db.counters.update_one(
+            {"_id" : self.name},
+            {"$max" : {"seq" : max_id}},
+            upsert = True
+        )
+
+
+# same counters and semantics as IdAllocator, for an AsyncMongoClient database
+class AsyncIdAllocator:
+    def __init__(self, db, name, block_size = 1):
+        self.db = db
+        self.name = name
+        self.block_size = max(1, int(block_size))
+        self.lock = asyncio.Lock()
+        self.next = 0
+        self.end = 0
+
+    async def reserve(self, count = 1):
+        counter = await self.db.counters.find_one_and_update(
+            {"_id" : self.name},
+            {"$inc" : {"seq" : count}},
+            upsert = True,
+            return_document = ReturnDocument.AFTER
+        )
+        return counter["seq"] - count + 1
+
+    async def next_id(self):
+        async with self.lock:
+            if self.next >= self.end:
+                self.next = await self.reserve(self.block_size)
+                self.end = self.next + self.block_size
+            new_id = self.next
+            self.next += 1
+            return new_id
@@ -0,0 +1,189 @@
+import csv
+import json
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import changes
+import rollups
+from serialize import parse_timestamp
+
+# import of historical readings from a csv or ndjson file (python app.py import FILE)
+# every row has valoare, timestamp (ISO 8601) and its city, by id (idOras) or by name
+# (oras, plus tara when cities of several countries have that name)
+# the file is read as a stream and written in batches by parallel unordered insert_many
+# calls; readings already stored for the same city and time are skipped or updated
+SKIP = "skip"
+UPDATE = "update"
+MAX_REPORTED_ERRORS = 10
+
+
+# (line number, row) of a csv file with a header, or of an ndjson file (None for bad json)
+def read_rows(path, file_format):
+    with open(path, newline = "", encoding = "utf-8") as f:
+        if file_format == "ndjson":
+            for line, text in enumerate(f, 1):
+                if not text.strip():
+                    continue
+                try:
+                    yield line, json.loads(text)
+                except ValueError:
+                    yield line, None
+        else:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+
+
+# city ids and names, loaded once for the whole import
+class Cities:
+    def __init__(self, db):
+        countries = {c["id"] : c["nume_tara"] for c in db.countries.find({}, {"_id" : 0, "id" : 1, "nume_tara" : 1})}
+        self.countries = {}
+        self.names = {}
+        for c in db.cities.find({}, {"_id" : 0, "id" : 1, "id_tara" : 1, "nume_oras" : 1}):
+            self.countries[c["id"]] = c["id_tara"]
+            self.names.setdefault(c["nume_oras"], []).append((c["id"], c["id_tara"], countries.get(c["id_tara"])))
+
+    # (id_oras, id_tara) of a row, raises ValueError
+    def resolve(self, row):
+        if row.get("idOras") not in (None, ""):
+            try:
+                city = int(row["idOras"])
+            except ValueError:
+                raise ValueError("invalid idOras")
+            if city not in self.countries:
+                raise ValueError(f"city {city} was not found")
+            return city, self.countries[city]
+
+        name = row.get("oras")
+        if not name:
+            raise ValueError("missing city, please use idOras or oras")
+
+        candidates = self.names.get(name, [])
+        if row.get("tara"):
+            candidates = [c for c in candidates if c[2] == row["tara"]]
+        if not candidates:
+            raise ValueError(f"city {name} was not found")
+        if len(candidates) > 1:
+            raise ValueError(f"city {name} exists in several countries, please add tara")
+        return candidates[0][:2]
+
+# reading of a row (without id), raises ValueError
+def parse(row, cities):
+    if not isinstance(row, dict):
+        raise ValueError("invalid row")
+
+    city, country = cities.resolve(row)
+    try:
+        value = float(row["valoare"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("invalid valoare")
+    try:
+        timestamp = parse_timestamp(row["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("invalid timestamp, please use ISO 8601")
+
+    return {"valoare" : value, "timestamp" : timestamp, "id_oras" : city, "id_tara" : country}
+
+
+class Importer:
+    def __init__(self, mongo, store, allocator, seqs, batch_size = 5000, workers = 4, on_duplicate = SKIP):
+        self.mongo = mongo
+        self.store = store
+        self.allocator = allocator
+        # change sequence allocator (see changes.py)
+        self.seqs = seqs
+        self.batch_size = batch_size
+        self.workers = workers
+        self.on_duplicate = on_duplicate
+
+        self.lock = threading.Lock()
+        self.counts = {"rows" : 0, "inserted" : 0, "updated" : 0, "skipped" : 0, "invalid" : 0, "failed" : 0}
+        # rollup buckets of the updated readings, recomputed at the end
+        self.updated_buckets = set()
+        self.cities = None
+
+    def count(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counts[key] += value
+
+    def invalid(self, line, message):
+        self.count(invalid = 1)
+        if self.counts["invalid"] <= MAX_REPORTED_ERRORS:
+            print(f"line {line}: {message}", file = sys.stderr)
+
+    # write one batch: one block of ids, one unordered insert_many, then the duplicates
+    def write(self, batch):
+        first_id = self.allocator.reserve(len(batch))
+        for offset, reading in enumerate(batch):
+            reading["id"] = first_id + offset
+        changes.stamp(batch, self.seqs)
+
+        failed = self.store.insert_many(batch)
+        inserted = [r for i, r in enumerate(batch) if i not in failed]
+        duplicates = [batch[i] for i, (code, _) in failed.items() if code == 11000]
+        errors = len(failed) - len(duplicates)
+
+        rollups.apply_increments(self.mongo.db, inserted)
+
+        if self.on_duplicate == UPDATE and duplicates:
+            self.count(updated = self.store.set_values(duplicates))
+            with self.lock:
+                self.updated_buckets.update((r["id_oras"], r["id_tara"], r["timestamp"]) for r in duplicates)
+        else:
+            self.count(skipped = len(duplicates))
+
+        self.count(inserted = len(inserted), failed = errors)
+
+    # import the rows, returns the counts and the elapsed time
+    def run(self, rows, report_every = 5):
+        start = time.perf_counter()
+        last_report = start
+        batch = []
+        pending = set()
+
+        # at most two batches per worker wait in memory, the file is read as they are written
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            def submit(batch):
+                nonlocal pending
+                while len(pending) >= 2 * self.workers:
+                    done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(self.write, batch))
+
+            for line, row in rows:
+                self.count(rows = 1)
+                try:
+                    batch.append(parse(row, self.cities))
+                except ValueError as e:
+                    self.invalid(line, e)
+                    continue
+
+                if len(batch) == self.batch_size:
+                    submit(batch)
+                    batch = []
+
+                now = time.perf_counter()
+                if now - last_report >= report_every:
+                    last_report = now
+                    print(f"{self.counts['rows']} rows, {self.counts['rows'] / (now - start):.0f} rows/s", file = sys.stderr)
+
+            if batch:
+                submit(batch)
+            for future in pending:
+                future.result()
+
+        if self.updated_buckets:
+            rollups.recompute(self.mongo.db, self.store, self.updated_buckets)
+
+        return self.counts, time.perf_counter() - start
+
+    def import_file(self, path, file_format = None):
+        if file_format is None:
+            file_format = "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+        self.cities = Cities(self.mongo.db)
+        return self.run(read_rows(path, file_format))
@@ -0,0 +1,289 @@
+import atexit
+import fcntl
+import glob
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+
+from pymongo.errors import PyMongoError
+
+import changes
+import metrics
+import rollups
+from serialize import parse_timestamp
+
+# buffered ingestion of the new readings (route 10 with INGEST_BUFFERED=true): the route
+# validates the reading, reserves its id and hands it to a queue, then returns 202; a
+# background thread of the worker writes the queued readings in group commits (one
+# insert_many per batch of up to `batch_size` readings, or every `flush_interval` seconds)
+# the readings get their change seq (see changes.py) when they are written, so a since=<seq>
+# sync never skips a reading that was still in the queue
+# with a journal, every queued reading is also appended to a local file
+# (<journal_dir>/ingest-<pid>-<random>.ndjson); the thread moves on to a new file when it
+# takes a batch, and a file is removed once all its readings are written, so the journal
+# holds about the queued readings even when the queue never empties; the journals left by
+# a crashed worker are written again at startup (replay), the readings already stored are
+# skipped as duplicates
+JOURNAL_PATTERN = "ingest-*.ndjson"
+RETRY_INTERVAL = 1
+
+
+def journal_line(reading):
+    return json.dumps({**reading, "timestamp" : reading["timestamp"].isoformat()}) + "\n"
+
+def parse_journal_line(line):
+    reading = json.loads(line)
+    reading["timestamp"] = parse_timestamp(reading["timestamp"])
+    return reading
+
+
+# a group of readings to write: stamped once with their change seqs, so a retry after an
+# error (lost connection) writes the same readings; write() goes on from where the failed
+# attempt stopped: the readings it stored are not written again and the rollups it updated
+# are not updated again (a rollup collection updated in part when the connection was lost
+# can be fixed with rebuild-rollups)
+class Group:
+    def __init__(self, seqs, readings):
+        self.readings = changes.stamp(readings, seqs)
+        self.attempted = False
+        # readings stored, once insert_many is done
+        self.inserted = None
+        # rollup collections updated (see rollups.apply_increments)
+        self.counted = set()
+
+    # returns the number of readings stored
+    # duplicates (a reading stored before a crash, then replayed) are skipped; the rollups of
+    # a group that was stored but not counted before a crash can be fixed with rebuild-rollups
+    def write(self, db, store):
+        if self.inserted is None:
+            retry, self.attempted = self.attempted, True
+            failed = store.insert_many(self.readings)
+            if retry:
+                # a duplicate id was stored by the failed attempt (ids are never reused)
+                failed = {
+                    i : (code, message) for i, (code, message) in failed.items()
+                    if code != 11000 or store.find_one({"id" : self.readings[i]["id"]}) is None
+                }
+            self.inserted = [r for i, r in enumerate(self.readings) if i not in failed]
+            self.count(failed)
+
+        rollups.apply_increments(db, self.inserted, self.counted)
+        return len(self.inserted)
+
+    def count(self, failed):
+        duplicates = sum(1 for code, _ in failed.values() if code == 11000)
+        metrics.ingest_batch_size.observe(len(self.readings))
+        metrics.ingest_readings.labels("written").inc(len(self.inserted))
+        if duplicates:
+            metrics.ingest_readings.labels("duplicate").inc(duplicates)
+        if len(failed) > duplicates:
+            metrics.ingest_readings.labels("failed").inc(len(failed) - duplicates)
+            for code, message in failed.values():
+                if code != 11000:
+                    print(f"buffered reading not written: {message}", file = sys.stderr)
+                    break
+
+# write a group of readings, returns the number of readings stored
+def commit(db, store, seqs, readings):
+    return Group(seqs, readings).write(db, store)
+
+# True while the journal is still at its path (another replay may have written and removed it)
+def still_present(journal, path):
+    try:
+        return os.path.samestat(os.fstat(journal.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+# write the journals of the workers that stopped without emptying them (those of running
+# workers are locked), returns the number of readings stored
+# several workers may replay at the same time: a journal is written by the one that locks
+# it first, the others skip it (locked, or already removed)
+def replay(db, store, seqs, journal_dir, batch_size = 1000):
+    stored = 0
+    for path in sorted(glob.glob(os.path.join(journal_dir, JOURNAL_PATTERN))):
+        try:
+            journal = open(path, "r+", encoding = "utf-8")
+        except FileNotFoundError:
+            continue
+        with journal:
+            try:
+                fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            if not still_present(journal, path):
+                continue
+
+            # a line cut by the crash was never acknowledged
+            readings = []
+            for line in journal:
+                try:
+                    readings.append(parse_journal_line(line))
+                except ValueError:
+                    continue
+                if len(readings) == batch_size:
+                    stored += commit(db, store, seqs, readings)
+                    readings = []
+            if readings:
+                stored += commit(db, store, seqs, readings)
+            os.remove(path)
+    return stored
+
+
+class WriteBehind:
+    def __init__(self, mongo, store, seqs, queue_size = 10000, batch_size = 500, flush_interval = 0.05,
+                 journal_dir = None, journal_fsync = False, shutdown_timeout = 10):
+        self.mongo = mongo
+        self.store = store
+        self.seqs = seqs
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_dir = journal_dir
+        self.journal_fsync = journal_fsync
+        self.shutdown_timeout = shutdown_timeout
+        # guards the queue together with the journal files, so the files hold exactly the
+        # readings that are queued or being written
+        self.lock = threading.Lock()
+        self.reset()
+
+    # queue a reading, returns False when the queue is full (or the worker is stopping)
+    def submit(self, reading):
+        with self.lock:
+            if self.closing:
+                return False
+            if self.thread is None:
+                self.start()
+            try:
+                self.queue.put_nowait(reading)
+            except queue.Full:
+                metrics.ingest_readings.labels("rejected").inc()
+                return False
+            if self.journals:
+                journal = self.journals[-1]
+                journal["file"].write(journal_line(reading))
+                journal["file"].flush()
+                if self.journal_fsync:
+                    os.fsync(journal["file"].fileno())
+                journal["pending"] += 1
+        return True
+
+    # the thread and the journal are created on first use, in the worker process
+    def start(self):
+        if self.journal_dir:
+            os.makedirs(self.journal_dir, exist_ok = True)
+            self.journals.append(self.open_journal())
+        self.thread = threading.Thread(target = self.run, name = "write-behind", daemon = True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # the next group: waits for a first reading, then takes the readings queued in the
+    # next `flush_interval` seconds, at most `batch_size`
+    def next_batch(self):
+        try:
+            batch = [self.queue.get(timeout = self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout = remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    # a new journal file, locked before it gets a name that replay() looks for
+    # pending: its readings that are not written yet
+    def open_journal(self):
+        name = f"ingest-{os.getpid()}-{uuid.uuid4().hex[:8]}.ndjson"
+        journal = open(os.path.join(self.journal_dir, "." + name), "a", encoding = "utf-8")
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        path = os.path.join(self.journal_dir, name)
+        os.rename(journal.name, path)
+        return {"file" : journal, "path" : path, "pending" : 0}
+
+    # the readings queued from now on go to a new journal file
+    def rotate(self):
+        with self.lock:
+            if self.journals and self.journals[-1]["pending"]:
+                self.journals.append(self.open_journal())
+
+    # `count` more readings are written (or dropped): the queue is FIFO, so they are the
+    # oldest pending ones; the older files with no pending reading left are removed
+    def release(self, count):
+        with self.lock:
+            for journal in self.journals:
+                done = min(count, journal["pending"])
+                journal["pending"] -= done
+                count -= done
+                if not count:
+                    break
+            while len(self.journals) > 1 and not self.journals[0]["pending"]:
+                journal = self.journals.popleft()
+                journal["file"].close()
+                os.remove(journal["path"])
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                if self.closing:
+                    self.drained = True
+                    return
+                continue
+            self.rotate()
+
+            # a lost connection keeps the group in memory (and in the journal) until mongo is back
+            # the group is stamped once (reserving its seqs may fail too)
+            group = None
+            while True:
+                try:
+                    if group is None:
+                        group = Group(self.seqs, batch)
+                    group.write(self.mongo.db, self.store)
+                    break
+                except PyMongoError as e:
+                    print(f"buffered readings not written, retrying: {e}", file = sys.stderr)
+                    if self.closing:
+                        return
+                    time.sleep(RETRY_INTERVAL)
+                except Exception as e:
+                    metrics.ingest_readings.labels("failed").inc(len(batch))
+                    print(f"buffered readings not written: {e}", file = sys.stderr)
+                    break
+            self.release(len(batch))
+
+    # stop accepting readings and write the queued ones, at most `shutdown_timeout` seconds
+    # (what's left stays in the journal)
+    def close(self):
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+            thread = self.thread
+        if thread is not None:
+            thread.join(self.shutdown_timeout)
+
+        with self.lock:
+            journals, self.journals = self.journals, deque()
+        for journal in journals:
+            journal["file"].close()
+            if self.drained:
+                os.remove(journal["path"])
+
+    # threads don't survive a fork: every worker starts its own thread and journal
+    def reset(self):
+        self.queue = queue.Queue(maxsize = self.queue_size)
+        self.thread = None
+        # journal files, oldest first
+        self.journals = deque()
+        self.closing = False
+        # set by the thread once the queue is written after close()
+        self.drained = False
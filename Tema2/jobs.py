@@ -0,0 +1,223 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from bson import json_util
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+import rollups
+from serialize import utcnow
+
+# background jobs (cascading deletes), tracked in the "jobs" collection so their status
+# can be read from any worker: {"_id": <job id>, "kind", "ref_id", "status", "created",
+# "finished", "progress": {"done", "total"}, "error", "steps", "heartbeat", "attempts"}
+# a job is a list of steps, like the rollup jobs: ("delete_many", collection, filter) or
+# ("aggregate", collection, pipeline); every step is idempotent, so a job can be run again
+# the process that runs a job updates its heartbeat every HEARTBEAT_INTERVAL seconds; a
+# pending/running job whose heartbeat is older than `stale_after` was left by a worker that
+# stopped (recycled or crashed), and is run again by another worker from its saved steps
+JOBS = "jobs"
+HEARTBEAT_INTERVAL = 10
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+# finished jobs are removed after `ttl` seconds
+def configure(db, ttl):
+    db[JOBS].create_index("finished", expireAfterSeconds = ttl)
+    # the stale jobs (see JobRunner.recover)
+    db[JOBS].create_index([("status", 1), ("heartbeat", 1)])
+
+def document(kind, ref_id, steps):
+    now = utcnow()
+    return {
+        "_id" : uuid.uuid4().hex,
+        "kind" : kind,
+        "ref_id" : ref_id,
+        "status" : PENDING,
+        "created" : now,
+        "progress" : {"done" : 0, "total" : len(steps)},
+        # extended JSON: the filters and pipelines have $ operators
+        "steps" : json_util.dumps(steps),
+        "heartbeat" : now,
+        "attempts" : 1
+    }
+
+def load_steps(job):
+    return [tuple(step) for step in json_util.loads(job["steps"])]
+
+# API format of a job
+def format_job(job):
+    return {
+        "id" : job["_id"],
+        "kind" : job["kind"],
+        "refId" : job["ref_id"],
+        "status" : job["status"],
+        "created" : job["created"],
+        "finished" : job.get("finished"),
+        "progress" : job["progress"],
+        "error" : job.get("error")
+    }
+
+
+# steps that delete the cities of a deleted country, their readings and their rollups
+# (the readings are deleted city by city, so the progress of large countries is visible)
+def delete_country_steps(store, country, cities):
+    names = store.collection_names()
+    steps = [("delete_many", name, store.map_fields({"id_oras" : city})) for city in cities for name in names]
+    return steps + [
+        ("delete_many", "cities", {"id_tara" : country}),
+        ("delete_many", rollups.DAILY, {"scope" : "city", "ref_id" : {"$in" : cities}}),
+        ("delete_many", rollups.MONTHLY, {"scope" : "city", "ref_id" : {"$in" : cities}})
+    ] + rollups.rebuild_countries_steps([country])
+
+# steps that delete the readings and rollups of a deleted city, and recompute its country
+def delete_city_steps(store, city, country):
+    steps = [("delete_many", name, store.map_fields({"id_oras" : city})) for name in store.collection_names()]
+    steps += [
+        ("delete_many", rollups.DAILY, {"scope" : "city", "ref_id" : city}),
+        ("delete_many", rollups.MONTHLY, {"scope" : "city", "ref_id" : city})
+    ]
+    if country is not None:
+        steps += rollups.rebuild_countries_steps([country])
+    return steps
+
+
+# runs the jobs of a (sync) PyMongo app in a small thread pool, so the request that
+# starts a job returns right away; a monitor thread updates the heartbeat of the jobs of
+# the process and takes over the stale jobs of stopped workers
+class JobRunner:
+    def __init__(self, mongo, workers = 1, stale_after = 60):
+        self.mongo = mongo
+        self.workers = max(1, int(workers))
+        self.stale_after = stale_after
+        self.reset()
+
+    # the pool and the monitor are started on first use, in the worker process that runs the jobs
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.executor = ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "jobs")
+            threading.Thread(target = self.monitor, name = "jobs-monitor", daemon = True).start()
+
+    # create a job and start it, returns its id
+    def submit(self, kind, ref_id, steps):
+        job = document(kind, ref_id, steps)
+        self.mongo.db[JOBS].insert_one(job)
+        self.enqueue(job["_id"], steps)
+        return job["_id"]
+
+    def enqueue(self, job_id, steps):
+        self.start()
+        with self.lock:
+            self.active.add(job_id)
+        self.executor.submit(self.run, job_id, steps)
+
+    def run(self, job_id, steps):
+        jobs = self.mongo.db[JOBS]
+        try:
+            jobs.update_one({"_id" : job_id}, {"$set" : {"status" : RUNNING}})
+            for done, (operation, name, argument) in enumerate(steps, 1):
+                getattr(self.mongo.db[name], operation)(argument)
+                jobs.update_one({"_id" : job_id}, {"$set" : {"progress.done" : done}})
+            jobs.update_one({"_id" : job_id}, {"$set" : {"status" : DONE, "finished" : utcnow()}})
+        except Exception as e:
+            jobs.update_one({"_id" : job_id}, {"$set" : {"status" : FAILED, "finished" : utcnow(), "error" : str(e)}})
+        finally:
+            with self.lock:
+                self.active.discard(job_id)
+
+    def get(self, job_id):
+        return self.mongo.db[JOBS].find_one({"_id" : job_id})
+
+    def monitor(self):
+        while True:
+            try:
+                self.beat()
+                self.recover()
+            except PyMongoError as e:
+                print(f"jobs monitor: {e}", file = sys.stderr)
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    # the jobs of this process are alive
+    def beat(self):
+        with self.lock:
+            active = list(self.active)
+        if active:
+            self.mongo.db[JOBS].update_many({"_id" : {"$in" : active}}, {"$set" : {"heartbeat" : utcnow()}})
+
+    # run again the pending/running jobs left by a worker that stopped, returns their number
+    # a job is taken over by one worker only: the one whose update finds the old heartbeat
+    def recover(self):
+        jobs = self.mongo.db[JOBS]
+        recovered = 0
+        stale = {"status" : {"$in" : [PENDING, RUNNING]}, "heartbeat" : {"$lt" : utcnow() - timedelta(seconds = self.stale_after)}}
+        for job in jobs.find(stale, {"_id" : 1, "heartbeat" : 1}):
+            job = jobs.find_one_and_update(
+                {"_id" : job["_id"], "heartbeat" : job["heartbeat"]},
+                {"$set" : {"status" : PENDING, "heartbeat" : utcnow()}, "$inc" : {"attempts" : 1}},
+                return_document = ReturnDocument.AFTER
+            )
+            if job is None:
+                continue
+            # jobs created before the steps were saved can't be run again
+            if "steps" not in job:
+                jobs.update_one({"_id" : job["_id"]}, {"$set" : {
+                    "status" : FAILED, "finished" : utcnow(), "error" : "interrupted by a worker restart"
+                }})
+                continue
+            print(f"job {job['_id']} ({job['kind']} {job['ref_id']}) left by a stopped worker, running it again")
+            self.enqueue(job["_id"], load_steps(job))
+            recovered += 1
+        return recovered
+
+    # threads don't survive a fork: every worker starts its own pool and monitor
+    def reset(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.executor = None
+        # ids of the jobs queued or running in this process
+        self.active = set()
+
+
+# same jobs for an AsyncMongoClient database: create the job, then run it as a task of the event loop
+async def create_async(db, kind, ref_id, steps):
+    job = document(kind, ref_id, steps)
+    await db[JOBS].insert_one(job)
+    return job["_id"]
+
+async def run_async(db, job_id, steps):
+    jobs = db[JOBS]
+    heartbeat = asyncio.create_task(beat_async(db, job_id))
+    try:
+        await jobs.update_one({"_id" : job_id}, {"$set" : {"status" : RUNNING}})
+        for done, (operation, name, argument) in enumerate(steps, 1):
+            await getattr(db[name], operation)(argument)
+            await jobs.update_one({"_id" : job_id}, {"$set" : {"progress.done" : done}})
+        await jobs.update_one({"_id" : job_id}, {"$set" : {"status" : DONE, "finished" : utcnow()}})
+    except Exception as e:
+        await jobs.update_one({"_id" : job_id}, {"$set" : {"status" : FAILED, "finished" : utcnow(), "error" : str(e)}})
+    finally:
+        heartbeat.cancel()
+
+# heartbeat of a job of the event loop (the stale jobs of a stopped async app are taken over
+# by the workers of the sync app)
+async def beat_async(db, job_id):
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        try:
+            await db[JOBS].update_one({"_id" : job_id}, {"$set" : {"heartbeat" : utcnow()}})
+        except PyMongoError as e:
+            print(f"job heartbeat: {e}", file = sys.stderr)
@@ -0,0 +1,242 @@
+import asyncio
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from serialize import dumps
+
+# live updates of the new readings (route 22, Server-Sent Events): every worker process
+# follows the temperatures collection once, in a background thread, and hands each new
+# reading to the subscribers of its city or country
+#   - with a replica set: a change stream of the inserts
+#   - without one (standalone mongod): a poll of the readings inserted in the last `lag`
+#     seconds, by _id (an ObjectId created by the app at insert time, so readings that
+#     become visible out of order, from other workers, are still found)
+# the thread starts with the first subscriber and stops after the last one leaves
+# in the sync app (gthread) every subscriber also holds a request thread; the async app
+# (AsyncLiveUpdates) follows the collection in a task of the event loop, and a subscriber
+# is only a queue and an open connection
+NOT_A_REPLICA_SET = 40573
+FIELDS = {"_id" : 1, "id" : 1, "valoare" : 1, "timestamp" : 1, "id_oras" : 1, "id_tara" : 1}
+
+
+# one Server-Sent Event
+def sse_event(event, data, id = None):
+    return (f"id: {id}\n" if id is not None else "") + f"event: {event}\ndata: " + dumps(data).decode() + "\n\n"
+
+# hand new readings to the subscribers of their city / country; a subscriber whose queue is
+# full misses them and gets the overflow flag
+def deliver(subscribers, readings):
+    for reading in readings:
+        for subscription in subscribers:
+            if subscription.matches(reading):
+                try:
+                    subscription.readings.put_nowait(reading)
+                except (queue.Full, asyncio.QueueFull):
+                    subscription.overflow = True
+
+
+class Subscription:
+    def __init__(self, city, country, size):
+        self.city = city
+        self.country = country
+        self.readings = queue.Queue(maxsize = size)
+        # set when the subscriber is too slow and readings were dropped
+        self.overflow = False
+
+    def matches(self, reading):
+        if self.city is not None:
+            return reading["id_oras"] == self.city
+        if self.country is not None:
+            return reading.get("id_tara") == self.country
+        return True
+
+    # the next reading, or None after `timeout` seconds without one
+    def get(self, timeout):
+        try:
+            return self.readings.get(timeout = timeout)
+        except queue.Empty:
+            return None
+
+
+class LiveUpdates:
+    def __init__(self, store, max_subscribers = 32, queue_size = 1000, poll_interval = 1, lag = 5):
+        self.store = store
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.lag = lag
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.thread = None
+        # "change stream" or "polling", once the thread started
+        self.source = None
+        self.resume_token = None
+
+    # returns None when the worker already has max_subscribers
+    def subscribe(self, city = None, country = None):
+        subscription = Subscription(city, country, self.queue_size)
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            self.subscribers.add(subscription)
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, name = "live-updates", daemon = True)
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def active(self):
+        with self.lock:
+            if self.subscribers:
+                return True
+            self.thread = None
+            return False
+
+    def publish(self, readings):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        deliver(subscribers, readings)
+
+    def run(self):
+        self.resume_token = None
+        follow = self.follow_change_stream
+        while True:
+            try:
+                # returns when the last subscriber left
+                follow()
+                return
+            except OperationFailure as e:
+                if e.code == NOT_A_REPLICA_SET:
+                    follow = self.follow_polling
+                    continue
+            except PyMongoError:
+                pass
+            # connection lost: start again (the change stream resumes after its last event,
+            # the polling window covers the last `lag` seconds)
+            time.sleep(self.poll_interval)
+            if not self.active():
+                return
+
+    def follow_change_stream(self):
+        pipeline = [{"$match" : {"operationType" : "insert"}}]
+        with self.store.collection.watch(pipeline, resume_after = self.resume_token, max_await_time_ms = 1000) as stream:
+            self.source = "change stream"
+            while self.active():
+                change = stream.try_next()
+                self.resume_token = stream.resume_token
+                if change is not None:
+                    self.publish([change["fullDocument"]])
+
+    def follow_polling(self):
+        self.source = "polling"
+        # the readings already in the window were inserted before the first subscriber
+        seen = None
+        while self.active():
+            since = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds = self.lag))
+            window = list(self.store.collection.find({"_id" : {"$gte" : since}}, FIELDS).sort("_id", 1))
+            if seen is not None:
+                self.publish([r for r in window if r["_id"] not in seen])
+            seen = {r["_id"] for r in window}
+            time.sleep(self.poll_interval)
+
+    # threads don't survive a fork: every worker follows the collection on its own
+    def reset(self):
+        self.subscribers = set()
+        self.thread = None
+        self.source = None
+
+
+# subscriber of the async app: its readings wait in an asyncio queue
+class AsyncSubscription(Subscription):
+    def __init__(self, city, country, size):
+        super().__init__(city, country, size)
+        self.readings = asyncio.Queue(maxsize = size)
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.readings.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+# same live updates for an AsyncMongoClient collection, followed by a task of the event loop
+# (everything runs on the loop, so no lock is needed)
+class AsyncLiveUpdates:
+    def __init__(self, collection, max_subscribers = 1000, queue_size = 1000, poll_interval = 1, lag = 5):
+        self.collection = collection
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.lag = lag
+        self.subscribers = set()
+        self.task = None
+        self.source = None
+        self.resume_token = None
+
+    # returns None when the worker already has max_subscribers
+    def subscribe(self, city = None, country = None):
+        if len(self.subscribers) >= self.max_subscribers:
+            return None
+        subscription = AsyncSubscription(city, country, self.queue_size)
+        self.subscribers.add(subscription)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+    def active(self):
+        if self.subscribers:
+            return True
+        self.task = None
+        return False
+
+    def publish(self, readings):
+        deliver(list(self.subscribers), readings)
+
+    async def run(self):
+        self.resume_token = None
+        follow = self.follow_change_stream
+        while True:
+            try:
+                await follow()
+                return
+            except OperationFailure as e:
+                if e.code == NOT_A_REPLICA_SET:
+                    follow = self.follow_polling
+                    continue
+            except PyMongoError:
+                pass
+            await asyncio.sleep(self.poll_interval)
+            if not self.active():
+                return
+
+    async def follow_change_stream(self):
+        pipeline = [{"$match" : {"operationType" : "insert"}}]
+        async with await self.collection.watch(pipeline, resume_after = self.resume_token, max_await_time_ms = 1000) as stream:
+            self.source = "change stream"
+            while self.active():
+                change = await stream.try_next()
+                self.resume_token = stream.resume_token
+                if change is not None:
+                    self.publish([change["fullDocument"]])
+
+    async def follow_polling(self):
+        self.source = "polling"
+        seen = None
+        while self.active():
+            since = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds = self.lag))
+            window = await self.collection.find({"_id" : {"$gte" : since}}, FIELDS).sort("_id", 1).to_list()
+            if seen is not None:
+                self.publish([r for r in window if r["_id"] not in seen])
+            seen = {r["_id"] for r in window}
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from pymongo import monitoring
+
+# metrics exposed on /metrics in the Prometheus text format (prometheus_client):
+#   http_request_duration_seconds{route, method, status}  - latency of each route
+#   http_response_size_bytes{route}                       - body size (not for streamed responses)
+#   http_response_rows{route}                             - entries in list responses
+#   mongodb_command_duration_seconds{command}             - every command sent to mongo
+#   mongodb_command_failures_total{command}
+#   ingest_readings_total{result}                         - buffered ingestion (see ingest.py): written,
+#                                                           duplicate, failed or rejected (queue full)
+#   ingest_batch_size                                     - readings per group commit
+# under gunicorn the workers write their values to files in PROMETHEUS_MULTIPROC_DIR (set
+# by gunicorn.conf.py before the app is loaded) and /metrics sums the files of all the
+# workers, so every worker answers with the totals of the server
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+MULTIPROC_DIR = "PROMETHEUS_MULTIPROC_DIR"
+
+
+request_duration = Histogram("http_request_duration_seconds", "Latency of the API routes", ["route", "method", "status"], buckets = LATENCY_BUCKETS)
+response_size = Histogram("http_response_size_bytes", "Size of the response bodies", ["route"], buckets = SIZE_BUCKETS)
+response_rows = Histogram("http_response_rows", "Entries returned by the list routes", ["route"], buckets = ROWS_BUCKETS)
+command_duration = Histogram("mongodb_command_duration_seconds", "Duration of the mongo commands", ["command"], buckets = LATENCY_BUCKETS)
+command_failures = Counter("mongodb_command_failures_total", "Failed mongo commands", ["command"])
+ingest_readings = Counter("ingest_readings_total", "Readings of the buffered ingestion, by result", ["result"])
+ingest_batch_size = Histogram("ingest_batch_size", "Readings per group commit of the buffered ingestion", buckets = ROWS_BUCKETS)
+
+# the metrics of the whole server: of all the workers in multiprocess mode, else of this process
+def render():
+    if os.environ.get(MULTIPROC_DIR):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+# drop the live values of a stopped worker (gunicorn worker_exit)
+def process_exited(pid):
+    if os.environ.get(MULTIPROC_DIR):
+        multiprocess.mark_process_dead(pid)
+
+
+# per-request profile: time spent in each phase (mongo, serialize), filled in by the
+# command listener and phase() on the thread that serves the request
+local = threading.local()
+
+class Profile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.mongo_commands = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    # Server-Timing header: one entry per phase, the rest of the time is app (validation, logic)
+    def server_timing(self):
+        total = time.perf_counter() - self.start
+        entries = [
+            f'mongo;dur={self.phases.get("mongo", 0) * 1000:.2f};desc="{self.mongo_commands} commands"',
+            f'serialize;dur={self.phases.get("serialize", 0) * 1000:.2f}',
+            f'app;dur={max(0, total - sum(self.phases.values())) * 1000:.2f}',
+            f'total;dur={total * 1000:.2f}'
+        ]
+        return ", ".join(entries)
+
+def start_profile():
+    local.profile = Profile()
+    return local.profile
+
+def stop_profile():
+    local.profile = None
+
+def current_profile():
+    return getattr(local, "profile", None)
+
+# time a block of a request as one phase of its profile
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile = current_profile()
+        if profile is not None:
+            profile.add(name, time.perf_counter() - start)
+
+
+# records every mongo command (registered on the client with event_listeners)
+class CommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        command_failures.labels(command = event.command_name).inc()
+        self.record(event)
+
+    def record(self, event):
+        seconds = event.duration_micros / 1e6
+        command_duration.labels(command = event.command_name).observe(seconds)
+        profile = current_profile()
+        if profile is not None:
+            profile.add("mongo", seconds)
+            profile.mongo_commands += 1
+
+command_listener = CommandMetrics()
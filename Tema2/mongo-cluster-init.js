@@ -0,0 +1,47 @@
+// sets up the local sharded cluster of docker-compose.sharded.yml: the config server and the
+// two shards are single-member replica sets, then the shards are added through the mongos
+// safe to run again, the steps already done are skipped
+// run with: mongosh --nodb mongo-cluster-init.js
+
+function connectTo(host) {
+    while (true) {
+        try {
+            const conn = new Mongo(host);
+            conn.getDB("admin").runCommand({ping : 1});
+            return conn;
+        } catch (e) {
+            sleep(1000);
+        }
+    }
+}
+
+function initiate(host, id, configsvr) {
+    const admin = connectTo(host).getDB("admin");
+    try {
+        admin.runCommand({replSetGetStatus : 1});
+    } catch (e) {
+        admin.runCommand({replSetInitiate : {_id : id, configsvr : configsvr, members : [{_id : 0, host : host}]}});
+    }
+    while (!admin.runCommand({hello : 1}).isWritablePrimary) {
+        sleep(1000);
+    }
+    print(`${id} ready`);
+}
+
+initiate("configsvr:27017", "configrs", true);
+initiate("shard1:27017", "shard1rs", false);
+initiate("shard2:27017", "shard2rs", false);
+
+const mongos = connectTo("mongos:27017").getDB("admin");
+for (const shard of ["shard1rs/shard1:27017", "shard2rs/shard2:27017"]) {
+    while (true) {
+        try {
+            mongos.runCommand({addShard : shard});
+            break;
+        } catch (e) {
+            print(`addShard ${shard}: ${e.message}, retrying`);
+            sleep(1000);
+        }
+    }
+}
+printjson(mongos.runCommand({listShards : 1}).shards);
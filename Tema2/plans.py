@@ -0,0 +1,47 @@
+# checks of the query plans of the read routes, with explain(): each route must be served
+# by an index (IXSCAN) without reading the documents (FETCH) or scanning the whole
+# collection (COLLSCAN), and the sorted (paged) reads without an in-memory SORT
+# run with: python app.py explain   (exits with 1 if a plan doesn't pass)
+
+NOT_COVERED = {"FETCH", "COLLSCAN"}
+
+
+# the slot based engine (MongoDB 7.0+) nests the plan under queryPlan
+def unwrap(plan):
+    return plan.get("queryPlan", plan)
+
+# all the stages of the winning plan of an explain() output
+# through a mongos, the plan starts with SINGLE_SHARD (a targeted read) or SHARD_MERGE /
+# SHARD_MERGE_SORT (sent to every shard), followed by the stages of each shard
+def plan_stages(explanation):
+    stages = []
+    pending = [unwrap(explanation["queryPlanner"]["winningPlan"])]
+    while pending:
+        stage = pending.pop()
+        stages.append(stage["stage"])
+        if "inputStage" in stage:
+            pending.append(stage["inputStage"])
+        pending.extend(stage.get("inputStages", []))
+        pending.extend(unwrap(shard["winningPlan"]) for shard in stage.get("shards", []))
+    return stages
+
+# the stages of a cursor's plan and the problems found in them
+def check(cursor, ordered = False):
+    stages = plan_stages(cursor.explain())
+    problems = [s for s in stages if s in NOT_COVERED]
+    if "IXSCAN" not in stages:
+        problems.append("no IXSCAN")
+    if ordered and "SORT" in stages:
+        problems.append("SORT")
+    return stages, problems
+
+# print the plans of (name, cursor, ordered) reads, returns True if all of them passed
+def report(reads):
+    passed = True
+    for name, cursor, ordered in reads:
+        stages, problems = check(cursor, ordered)
+        passed = passed and not problems
+        print(f"{'ok' if not problems else 'FAIL':<6}{name:<40}{' <- '.join(stages)}")
+        if problems:
+            print(f"{'':<6}{', '.join(problems)}")
+    return passed
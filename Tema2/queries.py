@@ -0,0 +1,123 @@
+import base64
+from datetime import datetime
+
+from serialize import parse_timestamp
+
+# filters and keyset pages of the list routes, shared by the sync (app.py) and the async
+# (app_async.py) apps; `args` are the query arguments of the request (Flask or Quart)
+INVALID_AREA = "invalid location filter, please use near=lat,lon&radius=km or bbox=minLat,minLon,maxLat,maxLon"
+INVALID_CURSOR = "invalid cursor"
+INVALID_DATE = "invalid date, please use YYYY-MM-DD"
+
+# paged results are ordered by (timestamp, id)
+PAGE_SORT = [("timestamp", 1), ("id", 1)]
+
+
+# build a location filter (on the 2dsphere index) from the arguments:
+#   near=lat,lon&radius=km             - entries within radius km of the point (default 10 km)
+#   bbox=minLat,minLon,maxLat,maxLon   - entries inside the bounding box (not together with near)
+# with nearest = True, near also orders the entries by distance
+# raises ValueError for malformed arguments
+def area_filter(args, nearest = False):
+    area = {}
+    near = args.get("near")
+    bbox = args.get("bbox")
+
+    if near:
+        lat, lon = [float(v) for v in near.split(",")]
+        radius = args.get("radius", 10, type = float)
+        if radius <= 0:
+            raise ValueError("radius")
+
+        point = {"type" : "Point", "coordinates" : [lon, lat]}
+        if nearest:
+            area["$nearSphere"] = {"$geometry" : point, "$maxDistance" : radius * 1000}
+        else:
+            area["$geoWithin"] = {"$centerSphere" : [[lon, lat], radius / 6378.1]}
+
+    if bbox:
+        if near:
+            raise ValueError("near and bbox")
+
+        min_lat, min_lon, max_lat, max_lon = [float(v) for v in bbox.split(",")]
+        area["$geoWithin"] = {"$geometry" : {
+            "type" : "Polygon",
+            "coordinates" : [[
+                [min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]
+            ]]
+        }}
+
+    return {"location" : area} if area else {}
+
+# filter on the cities of route 11: latitude and/or longitude of the city, area around a
+# point and/or bounding box (see area_filter, raises ValueError)
+def cities_filter(args):
+    query = area_filter(args)
+    lat = args.get("lat", type = float)
+    lon = args.get("lon", type = float)
+
+    if lat is not None:
+        query["latitudine"] = lat
+    if lon is not None:
+        query["longitudine"] = lon
+    return query
+
+# timestamp filter - start and/or end date(s), from=YYYY-MM-DD&until=YYYY-MM-DD
+# `args` may also be a JSON body; raises ValueError for a malformed date
+def date_filter(args):
+    start_date = args.get("from")
+    end_date = args.get("until")
+
+    date_range = {}
+    try:
+        if start_date:
+            date_range["$gte"] = datetime.strptime(start_date, "%Y-%m-%d")
+        if end_date:
+            date_range["$lte"] = datetime.strptime(end_date, "%Y-%m-%d")
+    except TypeError:
+        raise ValueError(INVALID_DATE)
+    return {"timestamp" : date_range} if date_range else {}
+
+
+# page arguments of a temperatures query, returns (limit, after, stream):
+#   limit=N       - at most N entries, the cursor of the next page is in X-Next-Cursor
+#   after=CURSOR  - continue after the last entry of a previous page
+#   stream=true   - send the JSON array in chunks, straight from the mongo cursor
+# raises ValueError with the error message
+def page_args(args, max_limit):
+    limit = args.get("limit")
+    after = args.get("after")
+    stream = args.get("stream", "").lower() in ("1", "true")
+
+    if limit is not None:
+        # a limit that is not a number is an error, not a request for everything
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= max_limit:
+            raise ValueError(f"invalid limit, please use a value between 1 and {max_limit}")
+    return limit, after, stream
+
+# keyset cursor of a temperatures page: the (timestamp, id) of its last entry
+def encode_cursor(t):
+    return base64.urlsafe_b64encode(f"{t['timestamp'].isoformat()}|{t['id']}".encode()).decode()
+
+def decode_cursor(token):
+    timestamp, last_id = base64.urlsafe_b64decode(token.encode()).decode().split("|")
+    return parse_timestamp(timestamp), int(last_id)
+
+# add the keyset filter - entries strictly after the cursor - to query
+# raises ValueError for a malformed cursor
+def after_filter(query, token):
+    timestamp, last_id = decode_cursor(token)
+    return {"$and" : [query, {"$or" : [
+        {"timestamp" : {"$gt" : timestamp}},
+        {"timestamp" : timestamp, "id" : {"$gt" : last_id}}
+    ]}]}
+
+# cursor of the page after a full page, None after the last one
+def next_cursor(temperatures, limit):
+    if limit is not None and len(temperatures) == limit:
+        return encode_cursor(temperatures[-1])
+    return None
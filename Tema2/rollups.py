@@ -0,0 +1,225 @@
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+# precomputed temperature statistics, one document per (scope, ref_id, bucket):
+# {"scope": "city" | "country", "ref_id": <id>, "bucket": <start of day / month>,
+#  "count": n, "sum": s, "min": m, "max": M}
+DAILY = "temperatures_daily"
+MONTHLY = "temperatures_monthly"
+
+
+def day_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, timestamp.day)
+
+def month_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, 1)
+
+def next_day(timestamp):
+    return day_start(timestamp) + timedelta(days = 1)
+
+def next_month(timestamp):
+    return datetime(timestamp.year + (timestamp.month == 12), timestamp.month % 12 + 1, 1)
+
+
+def configure(db):
+    for name in (DAILY, MONTHLY):
+        db[name].create_index([("scope", 1), ("ref_id", 1), ("bucket", 1)], unique=True)
+
+
+# rollup upserts for new readings ({"id_oras", "id_tara", "valoare", "timestamp"}), per collection
+# readings that fall into the same bucket are combined into a single $inc/$min/$max upsert
+def increments(readings):
+    totals = {}
+    for r in readings:
+        value = r["valoare"]
+        for name, bucket in ((DAILY, day_start(r["timestamp"])), (MONTHLY, month_start(r["timestamp"]))):
+            for scope, ref_id in (("city", r["id_oras"]), ("country", r.get("id_tara"))):
+                if ref_id is None:
+                    continue
+
+                key = (name, scope, ref_id, bucket)
+                if key not in totals:
+                    totals[key] = [1, value, value, value]
+                else:
+                    t = totals[key]
+                    t[0] += 1
+                    t[1] += value
+                    t[2] = min(t[2], value)
+                    t[3] = max(t[3], value)
+
+    ops = {DAILY : [], MONTHLY : []}
+    for (name, scope, ref_id, bucket), (count, total, low, high) in totals.items():
+        ops[name].append(UpdateOne(
+            {"scope" : scope, "ref_id" : ref_id, "bucket" : bucket},
+            {
+                "$inc" : {"count" : count, "sum" : total},
+                "$min" : {"min" : low},
+                "$max" : {"max" : high}
+            },
+            upsert = True
+        ))
+    return ops
+
+
+# last stages of every rebuild pipeline: reshape the $group output and upsert it
+def merge_stages(scope, into):
+    return [
+        {"$project" : {
+            "_id" : 0,
+            "scope" : {"$literal" : scope},
+            "ref_id" : "$_id.ref_id",
+            "bucket" : "$_id.bucket",
+            "count" : 1,
+            "sum" : 1,
+            "min" : 1,
+            "max" : 1
+        }},
+        {"$merge" : {
+            "into" : into,
+            "on" : ["scope", "ref_id", "bucket"],
+            "whenMatched" : "replace",
+            "whenNotMatched" : "insert"
+        }}
+    ]
+
+# $group of rollup documents into coarser buckets
+def rollup_group(ref_id, unit):
+    return {"$group" : {
+        "_id" : {"ref_id" : ref_id, "bucket" : {"$dateTrunc" : {"date" : "$bucket", "unit" : unit}}},
+        "count" : {"$sum" : "$count"},
+        "sum" : {"$sum" : "$sum"},
+        "min" : {"$min" : "$min"},
+        "max" : {"$max" : "$max"}
+    }}
+
+# city days, from the raw readings (runs on the collection of the temperatures store)
+def city_daily_pipeline(store, match):
+    return store.pipeline(match) + [
+        {"$group" : {
+            "_id" : {"ref_id" : "$id_oras", "bucket" : {"$dateTrunc" : {"date" : "$timestamp", "unit" : "day"}}},
+            "count" : {"$sum" : 1},
+            "sum" : {"$sum" : "$valoare"},
+            "min" : {"$min" : "$valoare"},
+            "max" : {"$max" : "$valoare"}
+        }}
+    ] + merge_stages("city", DAILY)
+
+# city months, from the city days (runs on the daily collection)
+def city_monthly_pipeline(match):
+    return [
+        {"$match" : {"scope" : "city", **match}},
+        rollup_group("$ref_id", "month")
+    ] + merge_stages("city", MONTHLY)
+
+# country days, from the city days of the country's cities (runs on the daily collection)
+def country_daily_pipeline(match, country_match):
+    return [
+        {"$match" : {"scope" : "city", **match}},
+        {"$lookup" : {"from" : "cities", "localField" : "ref_id", "foreignField" : "id", "as" : "city"}},
+        {"$unwind" : "$city"},
+        {"$match" : country_match},
+        rollup_group("$city.id_tara", "day")
+    ] + merge_stages("country", DAILY)
+
+# country months, from the country days (runs on the daily collection)
+def country_monthly_pipeline(match):
+    return [
+        {"$match" : {"scope" : "country", **match}},
+        rollup_group("$ref_id", "month")
+    ] + merge_stages("country", MONTHLY)
+
+
+# the recompute/rebuild jobs below are lists of steps, so they can be run by
+# both the sync (PyMongo) and the async (AsyncMongoClient) apps:
+# ("delete_one" | "delete_many", collection, filter) or ("aggregate", collection, pipeline)
+
+# steps that recompute the buckets touched by changed or deleted readings
+# buckets is an iterable of (id_oras, id_tara, timestamp), store is the temperatures store
+# writes are not blocked while a bucket is recomputed, so a new reading of the same city and
+# day can be counted twice (its $inc lands after a $merge that already saw it) or lost (its
+# $inc lands before a $merge that didn't); the bucket is right again at its next recompute,
+# and rebuild-rollups fixes all of them
+def recompute_steps(store, buckets):
+    days = {(city, country, day_start(t)) for city, country, t in buckets}
+    steps = []
+
+    for city, country, day in days:
+        month = month_start(day)
+        month_range = {"bucket" : {"$gte" : month, "$lt" : next_month(month)}}
+        match = {"id_oras" : city, "timestamp" : {"$gte" : day, "$lt" : day + timedelta(days = 1)}}
+
+        steps.append(("delete_one", DAILY, {"scope" : "city", "ref_id" : city, "bucket" : day}))
+        steps += [("aggregate", name, city_daily_pipeline(store, match)) for name in store.collection_names(match)]
+        steps += [
+            ("delete_one", MONTHLY, {"scope" : "city", "ref_id" : city, "bucket" : month}),
+            ("aggregate", DAILY, city_monthly_pipeline({"ref_id" : city, **month_range}))
+        ]
+
+        if country is None:
+            continue
+
+        steps += [
+            ("delete_one", DAILY, {"scope" : "country", "ref_id" : country, "bucket" : day}),
+            ("aggregate", DAILY, country_daily_pipeline({"bucket" : day}, {"city.id_tara" : country})),
+            ("delete_one", MONTHLY, {"scope" : "country", "ref_id" : country, "bucket" : month}),
+            ("aggregate", DAILY, country_monthly_pipeline({"ref_id" : country, **month_range}))
+        ]
+
+    return steps
+
+# steps that recompute all the buckets of some countries (e.g. after a city moved to another country)
+def rebuild_countries_steps(countries):
+    steps = []
+    for country in countries:
+        steps += [
+            ("delete_many", DAILY, {"scope" : "country", "ref_id" : country}),
+            ("delete_many", MONTHLY, {"scope" : "country", "ref_id" : country}),
+            ("aggregate", DAILY, country_daily_pipeline({}, {"city.id_tara" : country})),
+            ("aggregate", DAILY, country_monthly_pipeline({"ref_id" : country}))
+        ]
+    return steps
+
+# steps that recompute everything from the raw readings (backfill)
+# (a day is never split between collections, so every collection of the store can be
+# rolled up on its own)
+def rebuild_steps(store):
+    return [
+        ("delete_many", DAILY, {}),
+        ("delete_many", MONTHLY, {})
+    ] + [
+        ("aggregate", name, city_daily_pipeline(store, {})) for name in store.collection_names()
+    ] + [
+        ("aggregate", DAILY, city_monthly_pipeline({})),
+        ("aggregate", DAILY, country_daily_pipeline({}, {})),
+        ("aggregate", DAILY, country_monthly_pipeline({}))
+    ]
+
+
+def run(db, steps):
+    for operation, name, argument in steps:
+        getattr(db[name], operation)(argument)
+
+async def run_async(db, steps):
+    for operation, name, argument in steps:
+        await getattr(db[name], operation)(argument)
+
+
+# add new readings to the rollups
+# done: names of the rollup collections already updated with these readings, filled in as
+# they are updated, so a retry after an error doesn't count the readings twice
+def apply_increments(db, readings, done = None):
+    done = set() if done is None else done
+    for name, ops in increments(readings).items():
+        if ops and name not in done:
+            db[name].bulk_write(ops, ordered = False)
+        done.add(name)
+
+def recompute(db, store, buckets):
+    run(db, recompute_steps(store, buckets))
+
+def rebuild_countries(db, countries):
+    run(db, rebuild_countries_steps(countries))
+
+def rebuild(db, store):
+    run(db, rebuild_steps(store))
@@ -0,0 +1,99 @@
+import json
+from datetime import datetime, timezone
+
+# orjson is optional: it encodes straight to bytes in C (including dates), with the
+# standard json module as fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# shared by the Flask (app.py) and async (app_async.py) apps: the fields each route
+# reads from Mongo (projections, so no _id, location, etc. is sent over the wire),
+# the API format of the entries, and a fast JSON encoder for the responses
+JSON_MIMETYPE = 'application/json'
+
+COUNTRY_FIELDS = {"_id" : 0, "id" : 1, "nume_tara" : 1, "latitudine" : 1, "longitudine" : 1}
+CITY_FIELDS = {"_id" : 0, "id" : 1, "id_tara" : 1, "nume_oras" : 1, "latitudine" : 1, "longitudine" : 1}
+TEMPERATURE_FIELDS = {"_id" : 0, "id" : 1, "valoare" : 1, "timestamp" : 1}
+# temperatures of several cities, grouped by city (batch route)
+CITY_TEMPERATURE_FIELDS = {**TEMPERATURE_FIELDS, "id_oras" : 1}
+
+
+def _default(value):
+    # dates / datetimes, for the json fallback
+    return value.isoformat()
+
+# serialize to JSON bytes
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, default = _default, separators = (",", ":")).encode()
+
+# datetime of an ISO 8601 timestamp, raises ValueError
+# readings are stored as naive UTC times: a timestamp with an offset is converted to UTC,
+# so its day / month (rollups, buckets, partitions) is the one of the stored time
+def parse_timestamp(text):
+    timestamp = datetime.fromisoformat(text)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo = None)
+    return timestamp
+
+# current time, as the naive UTC time the readings and the TTL fields are stored in
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo = None)
+
+def format_country(c):
+    return {
+        "id" : c["id"],
+        "nume" : c["nume_tara"],
+        "lat" : c["latitudine"],
+        "lon" : c["longitudine"]
+    }
+
+def format_city(c):
+    return {
+        "id" : c["id"],
+        "idTara" : c["id_tara"],
+        "nume" : c["nume_oras"],
+        "lat" : c["latitudine"],
+        "lon" : c["longitudine"]
+    }
+
+# API format of temperature entries, for a whole batch at once: the timestamps are sent
+# as dates ("YYYY-MM-DD"), encoded by dumps instead of a strftime call per entry
+def format_temperatures(temperatures):
+    return [
+        {"id" : t["id"], "valoare" : t["valoare"], "timestamp" : t["timestamp"].date()}
+        for t in temperatures
+    ]
+
+# a JSON array in pieces, one chunk of `size` entries at a time (for streamed responses)
+def json_array_chunks(entries, size, format_chunk = list):
+    yield b"["
+    chunk = []
+    first = True
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == size:
+            yield (b"" if first else b",") + dumps(format_chunk(chunk))[1:-1]
+            chunk = []
+            first = False
+    if chunk:
+        yield (b"" if first else b",") + dumps(format_chunk(chunk))[1:-1]
+    yield b"]"
+
+# same, from an async cursor (async app)
+async def json_array_chunks_async(entries, size, format_chunk = list):
+    yield b"["
+    chunk = []
+    first = True
+    async for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == size:
+            yield (b"" if first else b",") + dumps(format_chunk(chunk))[1:-1]
+            chunk = []
+            first = False
+    if chunk:
+        yield (b"" if first else b",") + dumps(format_chunk(chunk))[1:-1]
+    yield b"]"
@@ -0,0 +1,820 @@
+import heapq
+import re
+from itertools import chain, islice
+
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
+
+from rollups import day_start
+
+# storage layouts of the temperature readings
+# the routes always work with flat readings:
+#   {"id", "valoare", "timestamp", "id_oras", "id_tara"}
+# and filters on those fields; each store maps them to its own layout
+DUPLICATE_READING = "duplicate key error: there's already a temperature entry for this city and time"
+
+# shard keys of the readings collection on a sharded cluster (TEMPERATURES_SHARD_KEY),
+# both start with the city, so the reads of a city go to a single shard:
+#   range  - (id_oras, timestamp): the readings of a city are stored in time order, the
+#            chunks of a busy city are split by time
+#   hashed - hash of id_oras: the cities are spread evenly over the shards
+SHARD_KEYS = {
+    "range" : {"id_oras" : 1, "timestamp" : 1},
+    "hashed" : {"id_oras" : "hashed"}
+}
+
+
+# fields overwritten in a stored reading: its value and its change sequence (see changes.py)
+def changed_values(reading):
+    return {key : reading[key] for key in ("valoare", "seq", "changed") if key in reading}
+
+
+# default layout: one document per reading in a plain collection
+class CollectionStore:
+    mode = "collection"
+
+    def __init__(self, mongo, name = "temperatures", shard_key = None):
+        self.mongo = mongo
+        self.name = name
+        self.shard_key = shard_key
+
+    @property
+    def collection(self):
+        return self.mongo.db[self.name]
+
+    # collections that may hold readings matching a filter (jobs and rollups run on each)
+    def collection_names(self, query = None):
+        return [self.name]
+
+    def configure(self):
+        if self.shard_key is not None and self.mongo.db.client.admin.command("hello").get("msg") != "isdbgrid":
+            print(f"{self.name} not sharded: TEMPERATURES_SHARD_KEY needs a connection to a mongos")
+            self.shard_key = None
+
+        # on a sharded cluster, unique indexes must start with the shard key: ids come from
+        # the counter, so a plain index is enough
+        if self.shard_key is not None and self.collection.index_information().get("id_1", {}).get("unique"):
+            self.collection.drop_index("id_1")
+        self.collection.create_index("id", unique = self.shard_key is None)
+        self.collection.create_index([("id_oras", 1), ("timestamp", 1)], unique = True)
+        # keyset pagination ordered by (timestamp, id), for all readings and per city/country
+        # (id_tara is denormalized on each reading); valoare is in the indexes too, so the
+        # reads of the routes (id, valoare, timestamp) are covered: served from the index only
+        self.collection.create_index([("timestamp", 1), ("id", 1), ("valoare", 1)])
+        self.collection.create_index([("id_oras", 1), ("timestamp", 1), ("id", 1), ("valoare", 1)])
+        self.collection.create_index([("id_tara", 1), ("timestamp", 1), ("id", 1), ("valoare", 1)])
+        # change sequence (since=<seq> sync of all the readings, of a city or of a country)
+        self.collection.create_index("seq")
+        self.collection.create_index([("id_oras", 1), ("seq", 1)])
+        self.collection.create_index([("id_tara", 1), ("seq", 1)])
+
+        if self.shard_key is not None:
+            self.shard()
+
+    # shard the collection (once, the cluster keeps it sharded)
+    def shard(self):
+        client = self.mongo.db.client
+        namespace = f"{self.mongo.db.name}.{self.name}"
+        sharded = client.config.collections.find_one({"_id" : namespace, "dropped" : {"$ne" : True}})
+        if sharded is not None:
+            if dict(sharded["key"]) != self.shard_key:
+                print(f"{namespace} is already sharded on {dict(sharded['key'])}, TEMPERATURES_SHARD_KEY ignored")
+            return
+
+        if "hashed" in self.shard_key.values():
+            self.collection.create_index(list(self.shard_key.items()))
+        client.admin.command("enableSharding", self.mongo.db.name)
+        client.admin.command("shardCollection", namespace, key = self.shard_key)
+
+    # send a filter to the shards that hold its readings only: a filter on the country alone
+    # would go to every shard, so it becomes a filter on the cities of the country (the shard
+    # key prefix), which is also covered by the (id_oras, timestamp, id, valoare) index
+    def route(self, query):
+        if self.shard_key is None or not query:
+            return query
+        if "$and" in query:
+            return {**query, "$and" : [self.route(q) for q in query["$and"]]}
+        if "id_tara" in query and "id_oras" not in query:
+            query = dict(query)
+            query["id_oras"] = {"$in" : self.mongo.db.cities.distinct("id", {"id_tara" : query.pop("id_tara")})}
+        return query
+
+    # rename the fields of a filter / update from the flat reading to the stored layout
+    def map_fields(self, query):
+        return query
+
+    # stored document -> flat reading
+    def load(self, doc):
+        return doc
+
+    # flat reading -> stored document
+    def dump(self, reading):
+        return reading
+
+    # aggregation stages that produce the flat readings matching a filter
+    def pipeline(self, match):
+        return [{"$match" : self.route(match)}]
+
+    def aggregate(self, match, stages):
+        return self.collection.aggregate(self.pipeline(match) + stages)
+
+    # cursor on the stored documents matching a filter (see find), e.g. for explain()
+    def cursor(self, query, sort = None, limit = None, batch_size = 1000, projection = None):
+        cursor = self.collection.find(self.map_fields(self.route(query)), self.map_fields(projection)).batch_size(batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    # flat readings matching a filter, optionally sorted/limited and with only the projected fields
+    def find(self, query, sort = None, limit = None, batch_size = 1000, projection = None):
+        return map(self.load, self.cursor(query, sort, limit, batch_size, projection))
+
+    def find_one(self, query):
+        doc = self.collection.find_one(self.map_fields(query))
+        return self.load(doc) if doc else None
+
+    # readings without an id sort last, so this is read from the id index only
+    def max_id(self):
+        doc = self.collection.find_one({}, {"_id" : 0, "id" : 1}, sort = [("id", -1)])
+        return doc.get("id", 0) if doc else 0
+
+    # raises DuplicateKeyError for a second reading of a city at the same time
+    def insert_one(self, reading):
+        self.collection.insert_one(self.dump(reading))
+
+    # unordered insert: a bad reading doesn't stop the rest of the batch
+    # returns the failed readings as {index: (error code, message)}
+    def insert_many(self, readings):
+        if not readings:
+            return {}
+        try:
+            self.collection.insert_many([self.dump(r) for r in readings], ordered = False)
+        except BulkWriteError as e:
+            return {
+                error["index"] : (error.get("code"), error.get("errmsg", "write error"))
+                for error in e.details.get("writeErrors", [])
+            }
+        return {}
+
+    # filter of a reading by id; on a sharded collection it holds the shard key too (looked
+    # up by id on every shard first), so the findAndModify goes to a single shard
+    def id_filter(self, id):
+        if self.shard_key is None:
+            return {"id" : id}
+        doc = self.collection.find_one({"id" : id}, {"_id" : 0, "id_oras" : 1, "timestamp" : 1})
+        return {"id" : id, **doc} if doc else {"id" : id}
+
+    # set some fields of a reading, returns the reading before the update (None if not found)
+    def update(self, id, fields):
+        doc = self.collection.find_one_and_update(self.id_filter(id), {"$set" : self.map_fields(fields)})
+        return self.load(doc) if doc else None
+
+    # delete a reading, returns it (None if not found)
+    def delete(self, id):
+        doc = self.collection.find_one_and_delete(self.id_filter(id))
+        return self.load(doc) if doc else None
+
+    # set the country of all the readings of some cities: {id_oras: id_tara}
+    # only the readings with another (or no) country are touched
+    def set_countries(self, countries):
+        ops = [
+            UpdateMany(
+                self.map_fields({"id_oras" : city, "id_tara" : {"$ne" : country}}),
+                {"$set" : self.map_fields({"id_tara" : country})}
+            )
+            for city, country in countries.items()
+        ]
+        if not ops:
+            return 0
+        return self.collection.bulk_write(ops, ordered = False).modified_count
+
+    # overwrite the value (and the change sequence) of the stored readings of the same city
+    # and time (duplicates of an import), returns the number of readings changed
+    def set_values(self, readings):
+        ops = [
+            UpdateOne(
+                self.map_fields({"id_oras" : r["id_oras"], "timestamp" : r["timestamp"]}),
+                {"$set" : changed_values(r)}
+            )
+            for r in readings
+        ]
+        if not ops:
+            return 0
+        return self.collection.bulk_write(ops, ordered = False).modified_count
+
+    # every stored reading, in batches (used by the storage migration)
+    def scan(self, batch_size = 10000):
+        return map(self.load, self.collection.find({}, {"_id" : 0}).batch_size(batch_size))
+
+    # rename the stored readings (used by the storage migration), returns the store of the new name
+    def rename(self, name):
+        self.collection.rename(name)
+        return type(self)(self.mongo, name)
+
+
+# MongoDB time-series collection (timeField=timestamp, metaField=meta{id_oras, id_tara}):
+# readings of a city are stored together in compressed buckets, so the collection is much
+# smaller on disk and date range scans of a city/country read only the matching buckets
+# time-series collections have no unique indexes and limited updates (MongoDB 7.0+ is
+# needed for deletes by id), so duplicates are checked here and an update is a delete +
+# insert of the reading
+class TimeSeriesStore(CollectionStore):
+    mode = "timeseries"
+    META_FIELDS = ("id_oras", "id_tara")
+    # documents per insert_many when the collection is copied (see rename)
+    COPY_BATCH_SIZE = 10000
+
+    def __init__(self, mongo, name = "temperatures", granularity = "hours"):
+        super().__init__(mongo, name)
+        self.granularity = granularity
+
+    # create the time-series collection, raises ValueError if a regular collection has its name
+    # (the readings of another layout: they are converted by migrate-storage, not in place)
+    def create(self):
+        info = next(self.mongo.db.list_collections(filter = {"name" : self.name}), None)
+        if info is None:
+            try:
+                self.mongo.db.create_collection(self.name, timeseries = {
+                    "timeField" : "timestamp",
+                    "metaField" : "meta",
+                    "granularity" : self.granularity
+                })
+            except CollectionInvalid:
+                # created by another process in the meantime
+                pass
+        elif info.get("type") != "timeseries":
+            raise ValueError(
+                f"{self.name} is a regular collection, not a time-series one: start the app with the "
+                f"TEMPERATURES_STORAGE of its layout and run python app.py migrate-storage --to {self.mode}"
+            )
+
+    def configure(self):
+        self.create()
+
+        self.collection.create_index("id")
+        self.collection.create_index([("meta.id_oras", 1), ("timestamp", 1)])
+        self.collection.create_index([("meta.id_tara", 1), ("timestamp", 1)])
+
+    def map_fields(self, query):
+        if isinstance(query, list):
+            return [self.map_fields(q) for q in query]
+        if not isinstance(query, dict):
+            return query
+        return {
+            (f"meta.{key}" if key in self.META_FIELDS else key) : self.map_fields(value)
+            for key, value in query.items()
+        }
+
+    def load(self, doc):
+        doc = dict(doc)
+        doc.update(doc.pop("meta", {}))
+        return doc
+
+    def dump(self, reading):
+        doc = {key : value for key, value in reading.items() if key not in self.META_FIELDS}
+        doc["meta"] = {key : reading[key] for key in self.META_FIELDS if key in reading}
+        return doc
+
+    def pipeline(self, match):
+        return [
+            {"$match" : self.map_fields(match)},
+            {"$set" : {"id_oras" : "$meta.id_oras", "id_tara" : "$meta.id_tara"}},
+            {"$unset" : "meta"}
+        ]
+
+    def exists(self, id_oras, timestamp):
+        return self.collection.find_one({"meta.id_oras" : id_oras, "timestamp" : timestamp}, {"_id" : 1}) is not None
+
+    def insert_one(self, reading):
+        if self.exists(reading["id_oras"], reading["timestamp"]):
+            raise DuplicateKeyError(DUPLICATE_READING, 11000)
+        self.collection.insert_one(self.dump(reading))
+
+    def insert_many(self, readings):
+        if not readings:
+            return {}
+
+        # readings already stored, checked with a single query
+        existing = {
+            (doc["meta"]["id_oras"], doc["timestamp"])
+            for doc in self.collection.find(
+                {
+                    "meta.id_oras" : {"$in" : list({r["id_oras"] for r in readings})},
+                    "timestamp" : {"$in" : list({r["timestamp"] for r in readings})}
+                },
+                {"meta.id_oras" : 1, "timestamp" : 1}
+            )
+        }
+
+        failed = {}
+        batch = []
+        for i, r in enumerate(readings):
+            key = (r["id_oras"], r["timestamp"])
+            if key in existing:
+                failed[i] = (11000, DUPLICATE_READING)
+            else:
+                existing.add(key)
+                batch.append(i)
+
+        if batch:
+            try:
+                self.collection.insert_many([self.dump(readings[i]) for i in batch], ordered = False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    failed[batch[error["index"]]] = (error.get("code"), error.get("errmsg", "write error"))
+        return failed
+
+    def update(self, id, fields):
+        previous = self.find_one({"id" : id})
+        if previous is None:
+            return None
+
+        reading = dict(previous, **fields)
+        reading.pop("_id", None)
+        if reading["id_oras"] != previous["id_oras"] and self.exists(reading["id_oras"], reading["timestamp"]):
+            raise DuplicateKeyError(DUPLICATE_READING, 11000)
+
+        self.collection.delete_many({"id" : id})
+        self.collection.insert_one(self.dump(reading))
+        return previous
+
+    def delete(self, id):
+        previous = self.find_one({"id" : id})
+        if previous is None:
+            return None
+        self.collection.delete_many({"id" : id})
+        return previous
+
+    # time-series collections can't be renamed: the readings are copied as they are into a new
+    # time-series collection, then the old one is dropped (if the copy stops, drop the new
+    # collection and run it again)
+    def rename(self, name):
+        target = type(self)(self.mongo, name, self.granularity)
+        target.create()
+
+        batch = []
+        for doc in self.collection.find({}, batch_size = self.COPY_BATCH_SIZE):
+            batch.append(doc)
+            if len(batch) == self.COPY_BATCH_SIZE:
+                target.collection.insert_many(batch)
+                batch = []
+        if batch:
+            target.collection.insert_many(batch)
+
+        self.collection.drop()
+        return target
+
+
+# bucket pattern, for servers without time-series collections: one document per city and day
+#   {"id_oras", "id_tara", "day", "count", "sum", "min", "max",
+#    "readings": [{"id", "valoare", "timestamp"}, ...]}
+# new readings are $push-ed into the bucket of their day, so there is one document (and one
+# index entry per index) for all the readings of a city in a day; queries match the buckets
+# first (by city/country/day) and unwind only those
+class BucketStore(CollectionStore):
+    mode = "buckets"
+    BUCKET_FIELDS = ("id_oras", "id_tara")
+
+    # recompute the summary of a bucket from its readings (pipeline update stage)
+    SUMMARY = {"$set" : {
+        "count" : {"$size" : "$readings"},
+        "sum" : {"$sum" : "$readings.valoare"},
+        "min" : {"$min" : "$readings.valoare"},
+        "max" : {"$max" : "$readings.valoare"}
+    }}
+
+    def configure(self):
+        self.collection.create_index([("id_oras", 1), ("day", 1)], unique = True)
+        self.collection.create_index([("id_tara", 1), ("day", 1)])
+        self.collection.create_index("day")
+        self.collection.create_index("readings.id")
+
+    # coarse filter on the buckets for a filter on the readings: every bucket that may hold
+    # a matching reading is selected (the readings are filtered again after the $unwind)
+    def bucket_filter(self, query):
+        result = {}
+        for key, value in query.items():
+            if key == "$and":
+                parts = [p for p in map(self.bucket_filter, value) if p]
+                if parts:
+                    result["$and"] = parts
+            elif key == "$or":
+                parts = [self.bucket_filter(q) for q in value]
+                # a branch without bucket conditions can match any bucket
+                if all(parts):
+                    result["$or"] = parts
+            elif key in self.BUCKET_FIELDS:
+                result[key] = value
+            elif key == "id":
+                result["readings.id"] = value
+            elif key == "timestamp":
+                day = self.day_filter(value)
+                if day:
+                    result["day"] = day
+        return result
+
+    # readings at / after / before some time -> buckets of the same days
+    def day_filter(self, value):
+        if not isinstance(value, dict):
+            return day_start(value)
+
+        result = {}
+        for op, bound in value.items():
+            if op in ("$gt", "$gte"):
+                result["$gte"] = day_start(bound)
+            elif op in ("$lt", "$lte"):
+                result[op] = bound
+        return result
+
+    def pipeline(self, match):
+        return [
+            {"$match" : self.bucket_filter(match)},
+            {"$unwind" : "$readings"},
+            {"$project" : {
+                "_id" : 0,
+                "id" : "$readings.id",
+                "valoare" : "$readings.valoare",
+                "timestamp" : "$readings.timestamp",
+                "id_oras" : 1,
+                "id_tara" : 1
+            }},
+            {"$match" : match}
+        ]
+
+    # the readings are unwound from the buckets by an aggregation: the cursor is an aggregation
+    # cursor on the flat readings (find maps them with the default load)
+    def cursor(self, query, sort = None, limit = None, batch_size = 1000, projection = None):
+        stages = []
+        if sort:
+            stages.append({"$sort" : dict(sort)})
+        if limit:
+            stages.append({"$limit" : limit})
+        if projection:
+            stages.append({"$project" : projection})
+        # the readings are sorted after the $unwind, which may need more than the 100MB in-memory limit
+        return self.collection.aggregate(self.pipeline(query) + stages, allowDiskUse = True, batchSize = batch_size)
+
+    def find_one(self, query):
+        return next(self.collection.aggregate(self.pipeline(query) + [{"$limit" : 1}]), None)
+
+    def max_id(self):
+        # a descending sort on the multikey index starts with the bucket holding the largest id
+        doc = self.collection.find_one({}, {"readings.id" : 1}, sort = [("readings.id", -1)])
+        return max((r["id"] for r in doc["readings"]), default = 0) if doc else 0
+
+    # (filter, update) that add a reading to the bucket of its city and day
+    # the filter doesn't match a bucket that already has a reading at the same time,
+    # so the upsert fails on the unique (id_oras, day) index instead of adding a duplicate
+    def push(self, reading):
+        return (
+            {
+                "id_oras" : reading["id_oras"],
+                "day" : day_start(reading["timestamp"]),
+                "readings.timestamp" : {"$ne" : reading["timestamp"]}
+            },
+            {
+                "$push" : {"readings" : {
+                    key : value for key, value in reading.items() if key not in self.BUCKET_FIELDS
+                }},
+                "$inc" : {"count" : 1, "sum" : reading["valoare"]},
+                "$min" : {"min" : reading["valoare"]},
+                "$max" : {"max" : reading["valoare"]},
+                "$set" : {"id_tara" : reading.get("id_tara")}
+            }
+        )
+
+    # a duplicate key error is also raised when two writers create the same bucket at once:
+    # without the upsert, the reading is added to the bucket created by the other writer
+    def push_existing(self, reading):
+        return self.collection.update_one(*self.push(reading)).matched_count > 0
+
+    def exists(self, id_oras, timestamp):
+        return self.collection.find_one(
+            {"id_oras" : id_oras, "day" : day_start(timestamp), "readings.timestamp" : timestamp},
+            {"_id" : 1}
+        ) is not None
+
+    def insert_one(self, reading):
+        try:
+            self.collection.update_one(*self.push(reading), upsert = True)
+        except DuplicateKeyError:
+            if not self.push_existing(reading):
+                raise DuplicateKeyError(DUPLICATE_READING, 11000)
+
+    def insert_many(self, readings):
+        if not readings:
+            return {}
+
+        failed = {}
+        try:
+            self.collection.bulk_write([UpdateOne(*self.push(r), upsert = True) for r in readings], ordered = False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed[error["index"]] = (error.get("code"), error.get("errmsg", "write error"))
+
+        for i, (code, _) in list(failed.items()):
+            if code == 11000:
+                if self.push_existing(readings[i]):
+                    del failed[i]
+                else:
+                    failed[i] = (11000, DUPLICATE_READING)
+        return failed
+
+    # remove a reading from its bucket and drop the bucket if it's empty now
+    def remove(self, reading):
+        self.collection.update_one({"readings.id" : reading["id"]}, [
+            {"$set" : {"readings" : {"$filter" : {
+                "input" : "$readings",
+                "cond" : {"$ne" : ["$$this.id", reading["id"]]}
+            }}}},
+            self.SUMMARY
+        ])
+        self.collection.delete_one({"id_oras" : reading["id_oras"], "day" : day_start(reading["timestamp"]), "count" : 0})
+
+    def update(self, id, fields):
+        previous = self.find_one({"id" : id})
+        if previous is None:
+            return None
+
+        reading = dict(previous, **fields)
+        if reading["id_oras"] != previous["id_oras"]:
+            # the reading moves to the bucket of another city
+            if self.exists(reading["id_oras"], reading["timestamp"]):
+                raise DuplicateKeyError(DUPLICATE_READING, 11000)
+            self.remove(previous)
+            self.insert_one(reading)
+            return previous
+
+        values = {key : value for key, value in fields.items() if key not in self.BUCKET_FIELDS}
+        self.collection.update_one({"readings.id" : id}, [
+            {"$set" : {
+                "id_tara" : reading.get("id_tara"),
+                "readings" : {"$map" : {
+                    "input" : "$readings",
+                    "in" : {"$cond" : [
+                        {"$eq" : ["$$this.id", id]},
+                        {"$mergeObjects" : ["$$this", {"$literal" : values}]},
+                        "$$this"
+                    ]}
+                }}
+            }},
+            self.SUMMARY
+        ])
+        return previous
+
+    def delete(self, id):
+        previous = self.find_one({"id" : id})
+        if previous is None:
+            return None
+        self.remove(previous)
+        return previous
+
+    def set_values(self, readings):
+        ops = [
+            UpdateOne(
+                {"id_oras" : r["id_oras"], "day" : day_start(r["timestamp"]), "readings.timestamp" : r["timestamp"]},
+                [
+                    {"$set" : {"readings" : {"$map" : {
+                        "input" : "$readings",
+                        "in" : {"$cond" : [
+                            {"$eq" : ["$$this.timestamp", r["timestamp"]]},
+                            {"$mergeObjects" : ["$$this", {"$literal" : changed_values(r)}]},
+                            "$$this"
+                        ]}
+                    }}}},
+                    self.SUMMARY
+                ]
+            )
+            for r in readings
+        ]
+        if not ops:
+            return 0
+        return self.collection.bulk_write(ops, ordered = False).modified_count
+
+    def scan(self, batch_size = 10000):
+        for doc in self.collection.find({}, {"_id" : 0}).batch_size(batch_size):
+            for r in doc["readings"]:
+                yield dict(r, id_oras = doc["id_oras"], id_tara = doc.get("id_tara"))
+
+
+# range partitions without a sharded cluster: one collection per month (<name>_YYYYMM),
+# each with the indexes of the collection layout; a filter with a time range is sent to
+# the partitions of its months only, and old months can be dropped or archived as a whole
+# the partitions are listed from the database on every read, so the ones created by
+# other workers are seen right away
+# there is no single collection: the readings are read with find / aggregate only
+class PartitionedStore:
+    mode = "partitioned"
+
+    def __init__(self, mongo, name = "temperatures"):
+        self.mongo = mongo
+        self.name = name
+        # partitions whose indexes were created by this process
+        self.configured = set()
+
+    # the partitions store the flat readings
+    def map_fields(self, query):
+        return query
+
+    def load(self, doc):
+        return doc
+
+    def dump(self, reading):
+        return reading
+
+    def pipeline(self, match):
+        return [{"$match" : match}]
+
+    def partition_name(self, timestamp):
+        return f"{self.name}_{timestamp:%Y%m}"
+
+    # a partition, as a store of the collection layout
+    def partition(self, name):
+        return CollectionStore(self.mongo, name)
+
+    # existing partitions, oldest first
+    def partitions(self):
+        pattern = f"^{re.escape(self.name)}_[0-9]{{6}}$"
+        return sorted(self.mongo.db.list_collection_names(filter = {"name" : {"$regex" : pattern}}))
+
+    # earliest and latest time of the readings matching a filter (None when unbounded)
+    def time_bounds(self, query):
+        bounds = [(None, None)]
+        for key, value in query.items():
+            if key == "$and":
+                bounds += [self.time_bounds(part) for part in value]
+            elif key == "$or":
+                # any of the branches: the widest bounds, unbounded if a branch is
+                branches = [self.time_bounds(part) for part in value]
+                lows = [low for low, _ in branches]
+                highs = [high for _, high in branches]
+                bounds.append((
+                    None if None in lows else min(lows),
+                    None if None in highs else max(highs)
+                ))
+            elif key == "timestamp" and isinstance(value, dict):
+                for op, bound in value.items():
+                    if op in ("$gt", "$gte"):
+                        bounds.append((bound, None))
+                    elif op in ("$lt", "$lte"):
+                        bounds.append((None, bound))
+                    elif op == "$in" and bound:
+                        bounds.append((min(bound), max(bound)))
+            elif key == "timestamp":
+                bounds.append((value, value))
+
+        # all the conditions hold: the narrowest bounds
+        lows = [low for low, _ in bounds if low is not None]
+        highs = [high for _, high in bounds if high is not None]
+        return max(lows, default = None), min(highs, default = None)
+
+    def collection_names(self, query = None):
+        names = self.partitions()
+        if not query:
+            return names
+        low, high = self.time_bounds(query)
+        return [
+            name for name in names
+            if (low is None or name >= self.partition_name(low)) and (high is None or name <= self.partition_name(high))
+        ]
+
+    def configure(self):
+        for name in self.partitions():
+            self.configure_partition(name)
+
+    def configure_partition(self, name):
+        if name not in self.configured:
+            self.partition(name).configure()
+            self.configured.add(name)
+
+    # one aggregation on the first partition, the others are added with $unionWith
+    def aggregate(self, match, stages):
+        names = self.collection_names(match)
+        if not names:
+            return iter([])
+        unions = [{"$unionWith" : {"coll" : name, "pipeline" : self.pipeline(match)}} for name in names[1:]]
+        return self.mongo.db[names[0]].aggregate(self.pipeline(match) + unions + stages)
+
+    # the partitions are read one after the other when the readings are sorted by time (a
+    # limit stops before the later partitions are queried), other sorts merge the partitions
+    # (all the sort keys in the same direction, and in the projection)
+    def find(self, query, sort = None, limit = None, batch_size = 1000, projection = None):
+        names = self.collection_names(query)
+        if sort and sort[0][1] == -1:
+            names.reverse()
+        cursors = [self.partition(name).find(query, sort, limit, batch_size, projection) for name in names]
+
+        if sort and sort[0][0] != "timestamp":
+            fields = [field for field, _ in sort]
+            readings = heapq.merge(*cursors, key = lambda r : [r[f] for f in fields], reverse = sort[0][1] == -1)
+        else:
+            readings = chain.from_iterable(cursors)
+        return islice(readings, limit) if limit else readings
+
+    def find_one(self, query):
+        for name in reversed(self.collection_names(query)):
+            reading = self.partition(name).find_one(query)
+            if reading is not None:
+                return reading
+        return None
+
+    def max_id(self):
+        return max((self.partition(name).max_id() for name in self.partitions()), default = 0)
+
+    def insert_one(self, reading):
+        name = self.partition_name(reading["timestamp"])
+        self.configure_partition(name)
+        self.partition(name).insert_one(reading)
+
+    # readings grouped by partition: {name: [index in readings, ...]}
+    def group(self, readings):
+        groups = {}
+        for i, r in enumerate(readings):
+            groups.setdefault(self.partition_name(r["timestamp"]), []).append(i)
+        return groups
+
+    def insert_many(self, readings):
+        failed = {}
+        for name, indexes in self.group(readings).items():
+            self.configure_partition(name)
+            errors = self.partition(name).insert_many([readings[i] for i in indexes])
+            failed.update({indexes[i] : error for i, error in errors.items()})
+        return failed
+
+    # updates by id look in every partition, the newest first
+    def update(self, id, fields):
+        for name in reversed(self.partitions()):
+            previous = self.partition(name).update(id, fields)
+            if previous is not None:
+                return previous
+        return None
+
+    def delete(self, id):
+        for name in reversed(self.partitions()):
+            previous = self.partition(name).delete(id)
+            if previous is not None:
+                return previous
+        return None
+
+    def set_countries(self, countries):
+        return sum(self.partition(name).set_countries(countries) for name in self.partitions())
+
+    def set_values(self, readings):
+        return sum(
+            self.partition(name).set_values([readings[i] for i in indexes])
+            for name, indexes in self.group(readings).items()
+        )
+
+    def scan(self, batch_size = 10000):
+        return chain.from_iterable(self.partition(name).scan(batch_size) for name in self.partitions())
+
+    def rename(self, name):
+        for partition in self.partitions():
+            self.mongo.db[partition].rename(name + partition[len(self.name):])
+        return type(self)(self.mongo, name)
+
+
+STORES = {
+    CollectionStore.mode : CollectionStore,
+    TimeSeriesStore.mode : TimeSeriesStore,
+    BucketStore.mode : BucketStore,
+    PartitionedStore.mode : PartitionedStore
+}
+
+# shard_key: None or a key of SHARD_KEYS (collection layout only)
+def create_store(mongo, mode, name = "temperatures", shard_key = None):
+    if mode not in STORES:
+        raise ValueError(f"unknown temperatures storage mode {mode}, please use one of {', '.join(STORES)}")
+    if shard_key is None:
+        return STORES[mode](mongo, name)
+
+    if shard_key not in SHARD_KEYS:
+        raise ValueError(f"unknown shard key {shard_key}, please use one of {', '.join(SHARD_KEYS)}")
+    if mode != CollectionStore.mode:
+        raise ValueError(f"sharding needs TEMPERATURES_STORAGE=collection, not {mode}")
+    return CollectionStore(mongo, name, SHARD_KEYS[shard_key])
+
+
+# copy the readings from the current layout to another one: the current collection
+# is renamed to `backup` and the readings are copied in batches to a new collection
+# in the target layout (restart the app with the new TEMPERATURES_STORAGE afterwards)
+def migrate(mongo, source_mode, target_mode, backup, batch_size = 10000):
+    source = create_store(mongo, source_mode).rename(backup)
+
+    target = create_store(mongo, target_mode)
+    target.configure()
+
+    copied = 0
+    batch = []
+    for reading in source.scan(batch_size):
+        batch.append(reading)
+        if len(batch) == batch_size:
+            target.insert_many(batch)
+            copied += len(batch)
+            batch = []
+    if batch:
+        target.insert_many(batch)
+        copied += len(batch)
+    return copied
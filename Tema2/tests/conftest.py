@@ -0,0 +1,79 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock = pytest.importorskip("mongomock")
+
+# mongomock's bulk update doesn't take the sort option of pymongo >= 4.11
+_add_update = mongomock.collection.BulkOperationBuilder.add_update
+def add_update(self, *args, sort = None, **kwargs):
+    return _add_update(self, *args, **kwargs)
+mongomock.collection.BulkOperationBuilder.add_update = add_update
+
+
+# the Flask app on an in-memory database (mongomock, no mongod needed)
+@pytest.fixture(scope = "session")
+def app_module():
+    import app
+
+    client = mongomock.MongoClient()
+    app.mongo.cx = client
+    app.mongo.db = client.tema2scd
+    app.configure_mongodb()
+    return app
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+# a new country and one of its cities, returns (country id, city id)
+@pytest.fixture
+def city(client, request):
+    name = request.node.name
+    country = client.post("/api/countries", json = {"nume" : name, "lat" : 45.0, "lon" : 25.0})
+    city = client.post("/api/cities", json = {
+        "idTara" : country.get_json()["id"], "nume" : name, "lat" : 45.0, "lon" : 25.0
+    })
+    return country.get_json()["id"], city.get_json()["id"]
+
+
+# a real mongod for the tests that mongomock can't run (the async app, query plans):
+# MONGO_TEST_URI, by default a tema2scd_test database on localhost; skipped when unreachable
+@pytest.fixture(scope = "session")
+def mongo_uri():
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+
+    uri = os.environ.get("MONGO_TEST_URI", "mongodb://localhost:27017/tema2scd_test")
+    client = MongoClient(uri, serverSelectionTimeoutMS = 1000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip(f"no mongod at {uri}")
+    client.drop_database(client.get_default_database())
+    client.close()
+    return uri
+
+# the Flask app on the real database, switched back to mongomock afterwards
+@pytest.fixture(scope = "module")
+def real_app(app_module, mongo_uri):
+    app = app_module
+    cx, db = app.mongo.cx, app.mongo.db
+
+    def switch():
+        for allocator in (app.country_ids, app.city_ids, app.temperature_ids, app.change_seqs):
+            allocator.reset()
+        app.reference_cache.entries.clear()
+        app.configure_mongodb()
+
+    app.mongo.init_app(app.app, mongo_uri)
+    switch()
+    yield app
+
+    app.mongo.cx.drop_database(app.mongo.db.name)
+    app.mongo.cx.close()
+    app.mongo.cx, app.mongo.db = cx, db
+    switch()
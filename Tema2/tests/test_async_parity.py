@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import app_async
+
+# the async app serves routes 2, 6, 7, 11-13 with the same filters, pages and bodies as app.py
+DAYS = ["2024-03-0%dT12:00:00" % day for day in range(1, 6)]
+
+
+@pytest.fixture(scope = "module")
+def seeded(real_app):
+    client = real_app.app.test_client()
+    country = client.post("/api/countries", json = {"nume" : "Parity", "lat" : 45.0, "lon" : 25.0}).get_json()["id"]
+    near = client.post("/api/cities", json = {"idTara" : country, "nume" : "Near", "lat" : 45.1, "lon" : 25.1}).get_json()["id"]
+    far = client.post("/api/cities", json = {"idTara" : country, "nume" : "Far", "lat" : 47.0, "lon" : 28.0}).get_json()["id"]
+    client.post("/api/temperatures/bulk", json = [
+        {"idOras" : city, "valoare" : float(i), "timestamp" : day}
+        for city in (near, far) for i, day in enumerate(DAYS)
+    ])
+    return client, country, near
+
+def responses(paths, get):
+    return [get(path) for path in paths]
+
+def flask_get(client):
+    def get(path):
+        response = client.get(path)
+        return response.status_code, response.get_json(), response.headers.get("X-Next-Cursor")
+    return get
+
+def async_responses(uri, paths):
+    async def run():
+        app_async.app.config["MONGO_URI"] = uri
+        async with app_async.app.test_app() as test_app:
+            client = test_app.test_client()
+            results = []
+            for path in paths:
+                response = await client.get(path)
+                results.append((response.status_code, await response.get_json(), response.headers.get("X-Next-Cursor")))
+            return results
+    return asyncio.run(run())
+
+def test_list_routes_match(seeded, mongo_uri):
+    client, country, city = seeded
+    paths = [
+        "/api/countries",
+        "/api/cities",
+        "/api/cities?near=45,25&radius=50",
+        "/api/cities?bbox=44,24,46,26",
+        "/api/cities?near=45,25&bbox=44,24,46,26",
+        f"/api/cities/country/{country}",
+        "/api/temperatures?limit=3",
+        "/api/temperatures?limit=3&stream=true",
+        "/api/temperatures?near=45,25&radius=50&from=2024-03-02&until=2024-03-04",
+        "/api/temperatures?bbox=44,24,46,26&limit=2",
+        "/api/temperatures?lat=47.0&lon=28.0",
+        "/api/temperatures?limit=0",
+        "/api/temperatures?after=x",
+        "/api/temperatures?since=0&stream=true",
+        "/api/temperatures?since=-1",
+        "/api/temperatures?limit=abc",
+        "/api/temperatures?from=bad",
+        f"/api/temperatures/cities/{city}?until=2024-13-01",
+        f"/api/temperatures/countries/{country}?from=bad",
+        f"/api/temperatures/cities/{city}?limit=2",
+        f"/api/temperatures/cities/{city}?stream=true",
+        f"/api/temperatures/countries/{country}?limit=4&from=2024-03-02"
+    ]
+
+    expected = responses(paths, flask_get(client))
+    assert async_responses(mongo_uri, paths) == expected
+
+def test_pages_match(seeded, mongo_uri):
+    client, country, _ = seeded
+    path = f"/api/temperatures/countries/{country}?limit=3"
+
+    # follow the X-Next-Cursor of the Flask app through all the pages, on both apps
+    paths = [path]
+    while True:
+        _, _, cursor = flask_get(client)(paths[-1])
+        if not cursor:
+            break
+        paths.append(f"{path}&after={cursor}")
+    assert len(paths) > 1
+
+    assert async_responses(mongo_uri, paths) == responses(paths, flask_get(client))
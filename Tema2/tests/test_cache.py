@@ -0,0 +1,86 @@
+import time
+from types import SimpleNamespace
+
+import mongomock
+
+from cache import Generation, KnownIds, ResponseCache
+
+
+def worker_caches(count):
+    mongo = SimpleNamespace(db = mongomock.MongoClient().tema2scd)
+    return [ResponseCache(generation = Generation(mongo, "reference")) for _ in range(count)]
+
+def worker_known_ids(count):
+    mongo = SimpleNamespace(db = mongomock.MongoClient().tema2scd)
+    mongo.db.cities.insert_one({"id" : 1, "id_tara" : 1})
+    return mongo, [KnownIds(mongo, "cities", ["id_tara"], generation = Generation(mongo, "reference")) for _ in range(count)]
+
+def cached(cache, key, body):
+    version = cache.version()
+    entry = cache.get(key, version)
+    return entry if entry is not None else cache.set(key, body, version)
+
+
+def test_clear_invalidates_other_workers():
+    first, second = worker_caches(2)
+    assert cached(first, "countries", b"[]")[0] == b"[]"
+    assert cached(second, "countries", b"[]")[0] == b"[]"
+
+    first.clear()
+    assert second.get("countries", second.version()) is None
+    assert cached(second, "countries", b"[1]")[0] == b"[1]"
+
+def test_entry_built_during_a_change_is_not_served():
+    first, second = worker_caches(2)
+    version = first.version()
+    second.clear()
+    first.set("countries", b"[]", version)
+    assert first.get("countries", first.version()) is None
+
+def test_write_in_another_worker_refreshes_list(app_module, client):
+    before = client.get("/api/countries")
+    assert before.status_code == 200
+
+    # another worker: its own write and its own cache.clear()
+    app_module.mongo.db.countries.insert_one({"id" : 10 ** 6, "nume_tara" : "Elsewhere", "latitudine" : 0.0, "longitudine" : 0.0})
+    app_module.reference_generation.bump()
+
+    after = client.get("/api/countries", headers = {"If-None-Match" : before.headers["ETag"]})
+    assert after.status_code == 200
+    assert "Elsewhere" in [c["nume"] for c in after.get_json()]
+
+def test_delete_reaches_known_ids_of_other_workers():
+    mongo, (first, second) = worker_known_ids(2)
+    assert first.get(1) == second.get(1) == {"id" : 1, "id_tara" : 1}
+
+    mongo.db.cities.delete_one({"id" : 1})
+    first.discard(1)
+    first.generation.bump()
+    assert second.get(1) is None
+
+def test_update_reaches_known_ids_of_other_workers():
+    mongo, (first, second) = worker_known_ids(2)
+    assert second.get(1)["id_tara"] == 1
+
+    mongo.db.cities.update_one({"id" : 1}, {"$set" : {"id_tara" : 2}})
+    first.generation.bump()
+    assert second.get(1)["id_tara"] == 2
+
+def test_deleted_country_cities_stay_unknown(app_module, client, city):
+    country_id, city_id = city
+    assert client.delete(f"/api/countries/{country_id}").status_code == 200
+    assert app_module.known_cities.get(city_id) is None
+    response = client.post("/api/temperatures", json = {"idOras" : city_id, "valoare" : 1.5})
+    assert response.status_code == 404
+
+# with a max_age, the counter is read from mongo at most that often
+def test_generation_is_read_at_most_every_max_age():
+    mongo = SimpleNamespace(db = mongomock.MongoClient().tema2scd)
+    first, second = Generation(mongo, "reference"), Generation(mongo, "reference", max_age = 0.1)
+    assert second.current() == 0
+
+    first.bump()
+    assert first.current() == 1
+    assert second.current() == 0
+    time.sleep(0.1)
+    assert second.current() == 1
@@ -0,0 +1,112 @@
+import fcntl
+import os
+import threading
+import time
+from datetime import datetime
+
+from pymongo.errors import PyMongoError
+
+import ingest
+
+
+def journal(path, readings, tail = ""):
+    path.write_text("".join(ingest.journal_line(r) for r in readings) + tail, encoding = "utf-8")
+    return path
+
+def reading(id, day, city, country):
+    return {"id" : id, "valoare" : 1.5, "timestamp" : datetime(2024, 1, day), "id_oras" : city, "id_tara" : country}
+
+# the journal of a crashed worker is written by the next replay (at startup or by a new
+# worker), the journal of a running worker (locked) is left alone
+def test_replay_orphaned_journal_only(app_module, city, tmp_path, monkeypatch):
+    country_id, city_id = city
+    first = app_module.temperature_ids.reserve(2)
+    # a line cut by the crash is skipped
+    orphan = journal(tmp_path / "ingest-1-dead.ndjson", [reading(first, 1, city_id, country_id)], '{"id": ')
+    live = journal(tmp_path / "ingest-2-live.ndjson", [reading(first + 1, 2, city_id, country_id)])
+
+    monkeypatch.setitem(app_module.app.config, "INGEST_JOURNAL_DIR", str(tmp_path))
+    with open(live) as held:
+        fcntl.flock(held, fcntl.LOCK_EX)
+        app_module.replay_journals()
+
+    assert not orphan.exists()
+    assert live.exists()
+    store = app_module.temperature_store
+    assert store.find_one({"id" : first})["id_oras"] == city_id
+    assert store.find_one({"id" : first + 1}) is None
+
+# store whose insert_many waits for a permit, so the test decides when each group is written
+class GatedStore:
+    def __init__(self, store):
+        self.store = store
+        self.entered = threading.Semaphore(0)
+        self.permits = threading.Semaphore(0)
+
+    def insert_many(self, readings):
+        self.entered.release()
+        self.permits.acquire()
+        return self.store.insert_many(readings)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+# under a burst the queue never empties: the journal file of a written group is removed
+# anyway, the file of the readings still queued is kept
+def test_journal_rotates_while_queue_is_busy(app_module, city, tmp_path):
+    country_id, city_id = city
+    first = app_module.temperature_ids.reserve(3)
+    store = GatedStore(app_module.temperature_store)
+    write_behind = ingest.WriteBehind(
+        app_module.mongo, store, app_module.change_seqs, batch_size = 1, flush_interval = 0.01,
+        journal_dir = str(tmp_path)
+    )
+    journals = lambda : sorted(tmp_path.glob(ingest.JOURNAL_PATTERN))
+
+    assert write_behind.submit(reading(first, 1, city_id, country_id))
+    assert store.entered.acquire(timeout = 5)
+    # the group taken by the thread is in a file of its own
+    written = write_behind.journals[0]["path"]
+    assert write_behind.submit(reading(first + 1, 2, city_id, country_id))
+    assert write_behind.submit(reading(first + 2, 3, city_id, country_id))
+
+    # the first group is written while the other two readings are still queued
+    store.permits.release()
+    assert store.entered.acquire(timeout = 5)
+    assert not os.path.exists(written)
+    assert any(str(first + 2) in path.read_text() for path in journals())
+
+    for _ in range(2):
+        store.permits.release()
+    write_behind.close()
+    assert journals() == []
+    assert app_module.temperature_store.find_one({"id" : first + 2}) is not None
+
+# an error after the readings are stored (here, in the rollups) retries the same group: the
+# readings keep their seqs and are counted once in the rollups
+def test_retry_after_rollup_error_counts_once(app_module, city, monkeypatch):
+    country_id, city_id = city
+    first = app_module.temperature_ids.reserve(1)
+    apply_increments = ingest.rollups.apply_increments
+    calls = []
+
+    def failing(db, readings, done = None):
+        calls.append(len(readings))
+        if len(calls) == 1:
+            raise PyMongoError("connection lost")
+        return apply_increments(db, readings, done)
+
+    monkeypatch.setattr(ingest.rollups, "apply_increments", failing)
+    monkeypatch.setattr(ingest, "RETRY_INTERVAL", 0)
+    write_behind = ingest.WriteBehind(app_module.mongo, app_module.temperature_store, app_module.change_seqs, flush_interval = 0.01)
+    assert write_behind.submit(reading(first, 4, city_id, country_id))
+    deadline = time.monotonic() + 5
+    while len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    write_behind.close()
+
+    assert calls == [1, 1]
+    stored = app_module.temperature_store.find_one({"id" : first})
+    assert stored["seq"] is not None
+    daily = app_module.mongo.db.temperatures_daily.find_one({"scope" : "city", "ref_id" : city_id})
+    assert daily["count"] == 1
@@ -0,0 +1,51 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+import mongomock
+
+import jobs
+from serialize import utcnow
+
+
+# a runner of another worker, without its monitor thread (the test calls recover itself)
+def runner(monkeypatch):
+    monkeypatch.setattr(jobs.JobRunner, "monitor", lambda self : None)
+    mongo = SimpleNamespace(db = mongomock.MongoClient().tema2scd)
+    return mongo, jobs.JobRunner(mongo, stale_after = 60)
+
+# a job of a worker that stopped `age` seconds after its last heartbeat
+def left_job(mongo, steps, age, status = jobs.RUNNING):
+    job = jobs.document("delete_city", 1, steps)
+    job.update(status = status, heartbeat = utcnow() - timedelta(seconds = age))
+    mongo.db[jobs.JOBS].insert_one(job)
+    return job["_id"]
+
+def test_stale_job_is_run_again(monkeypatch):
+    mongo, job_runner = runner(monkeypatch)
+    mongo.db.temperatures.insert_many([{"id" : 1, "id_oras" : 1}, {"id" : 2, "id_oras" : 2}])
+    stale = left_job(mongo, [("delete_many", "temperatures", {"id_oras" : {"$in" : [1]}})], 120, jobs.PENDING)
+
+    assert job_runner.recover() == 1
+    job_runner.executor.shutdown(wait = True)
+
+    job = job_runner.get(stale)
+    assert job["status"] == jobs.DONE
+    assert job["attempts"] == 2
+    assert [t["id"] for t in mongo.db.temperatures.find()] == [2]
+
+def test_live_job_is_left_alone(monkeypatch):
+    mongo, job_runner = runner(monkeypatch)
+    live = left_job(mongo, [("delete_many", "temperatures", {})], 5)
+
+    assert job_runner.recover() == 0
+    assert job_runner.get(live)["status"] == jobs.RUNNING
+
+def test_stale_job_without_steps_fails(monkeypatch):
+    mongo, job_runner = runner(monkeypatch)
+    old = left_job(mongo, [], 120)
+    mongo.db[jobs.JOBS].update_one({"_id" : old}, {"$unset" : {"steps" : 1}})
+
+    assert job_runner.recover() == 0
+    job = job_runner.get(old)
+    assert job["status"] == jobs.FAILED
+    assert job["finished"] is not None
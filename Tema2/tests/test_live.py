@@ -0,0 +1,68 @@
+import asyncio
+from datetime import datetime
+
+import mongomock
+from pymongo.errors import OperationFailure
+
+import live
+
+
+# a mongomock collection behind the async API used by AsyncLiveUpdates (a standalone
+# mongod: no change streams, the readings are polled)
+class AsyncCollection:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def watch(self, *args, **kwargs):
+        raise OperationFailure("not a replica set", code = live.NOT_A_REPLICA_SET)
+
+    def find(self, *args):
+        return AsyncCursor(self.collection.find(*args))
+
+class AsyncCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args):
+        self.cursor = self.cursor.sort(*args)
+        return self
+
+    async def to_list(self):
+        return list(self.cursor)
+
+# the async app serves many more subscribers than a gthread worker has threads
+def test_async_subscribers_get_new_readings():
+    collection = mongomock.MongoClient().tema2scd.temperatures
+
+    async def run():
+        updates = live.AsyncLiveUpdates(AsyncCollection(collection), max_subscribers = 500, poll_interval = 0.01)
+        city = [updates.subscribe(city = 1) for _ in range(200)]
+        country = updates.subscribe(country = 2)
+        other = updates.subscribe(city = 3)
+        assert updates.subscribe() is not None
+        await asyncio.sleep(0.05)
+
+        collection.insert_one({"id" : 1, "valoare" : 1.5, "timestamp" : datetime(2024, 1, 1), "id_oras" : 1, "id_tara" : 2})
+        readings = await asyncio.gather(*[s.get(1) for s in city + [country]])
+        assert [r["id"] for r in readings] == [1] * 201
+        assert await other.get(0.05) is None
+        assert updates.source == "polling"
+
+        for subscription in list(updates.subscribers):
+            updates.unsubscribe(subscription)
+        await asyncio.wait_for(updates_task(updates), 1)
+
+    async def updates_task(updates):
+        while updates.task is not None:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+
+def test_async_subscriber_limit():
+    async def run():
+        updates = live.AsyncLiveUpdates(None, max_subscribers = 1)
+        updates.task = "running"
+        assert updates.subscribe() is not None
+        assert updates.subscribe() is None
+
+    asyncio.run(run())
@@ -0,0 +1,18 @@
+import os
+import subprocess
+import sys
+
+TEMA2 = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(code, multiproc_dir):
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR = str(multiproc_dir))
+    return subprocess.run([sys.executable, "-c", code], cwd = TEMA2, env = env, check = True, capture_output = True, text = True).stdout
+
+# every worker answers /metrics with the totals of all the workers
+def test_metrics_sum_all_workers(tmp_path):
+    for _ in range(2):
+        run("import metrics; metrics.ingest_readings.labels('written').inc(3)", tmp_path)
+
+    output = run("import metrics; print(metrics.render().decode())", tmp_path)
+    assert 'ingest_readings_total{result="written"} 6.0' in output
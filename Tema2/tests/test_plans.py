@@ -0,0 +1,20 @@
+import plans
+
+# every list route is served from an index only: no COLLSCAN, no FETCH (and no in-memory
+# SORT for the paged reads), the same checks as python app.py explain, on a real mongod
+
+
+def test_list_routes_are_covered(real_app):
+    client = real_app.app.test_client()
+    country = client.post("/api/countries", json = {"nume" : "Plans", "lat" : 45.0, "lon" : 25.0}).get_json()["id"]
+    city = client.post("/api/cities", json = {"idTara" : country, "nume" : "Plans", "lat" : 45.0, "lon" : 25.0}).get_json()["id"]
+    client.post("/api/temperatures/bulk", json = [
+        {"idOras" : city, "valoare" : float(day), "timestamp" : f"2024-03-{day:02d}T12:00:00"} for day in range(1, 29)
+    ])
+
+    failed = {}
+    for name, cursor, ordered in real_app.route_reads():
+        stages, problems = plans.check(cursor, ordered)
+        if problems:
+            failed[name] = f"{' <- '.join(stages)} ({', '.join(problems)})"
+    assert failed == {}
@@ -0,0 +1,33 @@
+import pytest
+
+
+# a malformed limit or date is a 400, never the full (unpaged) result or a 500
+@pytest.mark.parametrize("args", ["limit=abc", "limit=", "limit=0", "limit=1.5", "from=bad", "until=2024-13-01"])
+def test_invalid_arguments(client, city, args):
+    country_id, city_id = city
+    for path in ("/api/temperatures", f"/api/temperatures/cities/{city_id}", f"/api/temperatures/countries/{country_id}"):
+        response = client.get(f"{path}?{args}")
+        assert response.status_code == 400, path
+        assert "error" in response.get_json()
+
+def test_limit_pages(client, city):
+    _, city_id = city
+    client.post("/api/temperatures/bulk", json = [
+        {"idOras" : city_id, "valoare" : 1.5, "timestamp" : f"2024-03-0{day}T12:00:00"} for day in (1, 2, 3)
+    ])
+    response = client.get(f"/api/temperatures/cities/{city_id}?limit=2")
+    assert response.status_code == 200
+    assert len(response.get_json()) == 2
+    assert response.headers.get("X-Next-Cursor")
+
+def test_export_invalid_date(client):
+    response = client.get("/api/export/temperatures?format=ndjson&from=2024-02-30")
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "invalid date, please use YYYY-MM-DD"
+
+@pytest.mark.parametrize("date", ["bad", 20240301])
+def test_batch_invalid_date(client, city, date):
+    _, city_id = city
+    response = client.post("/api/batch/temperatures", json = {"cities" : [city_id], "from" : date})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "invalid date, please use YYYY-MM-DD"
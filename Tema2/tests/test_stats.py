@@ -0,0 +1,45 @@
+import pytest
+
+# readings of two months, one per day around the middle of each
+TIMESTAMPS = [f"2024-{month:02d}-{day:02d}T{hour:02d}:00:00" for month in (2, 3) for day in (10, 15, 20) for hour in (0, 12)]
+
+
+def seed(client, city_id):
+    response = client.post("/api/temperatures/bulk", json = [
+        {"idOras" : city_id, "valoare" : float(i), "timestamp" : t} for i, t in enumerate(TIMESTAMPS)
+    ])
+    assert response.status_code == 201
+
+@pytest.mark.parametrize("args", ["from=bad", "until=2024-13-01", "bucket=month&from=2024-3-1x"])
+def test_invalid_date(client, city, args):
+    country_id, city_id = city
+    for path in (f"/api/temperatures/cities/{city_id}/stats", f"/api/temperatures/countries/{country_id}/stats"):
+        assert client.get(f"{path}?{args}").status_code == 400
+
+# whole buckets only: read from the rollups
+def test_rollup_whole_months(client, city):
+    _, city_id = city
+    seed(client, city_id)
+    response = client.get(f"/api/temperatures/cities/{city_id}/stats?bucket=month&from=2024-03-01")
+    assert response.status_code == 200
+    assert [(b["bucket"], b["count"]) for b in response.get_json()] == [("2024-03", 6)]
+
+# a from / until inside a bucket gives the same result from the rollups as from the raw readings
+# (the partial buckets are aggregated with $dateTrunc: needs a real mongod)
+@pytest.mark.parametrize("args", [
+    "bucket=month&from=2024-02-15",
+    "bucket=month&from=2024-02-15&until=2024-03-15",
+    "bucket=month&from=2024-03-11&until=2024-03-20",
+    "bucket=day&from=2024-02-15&until=2024-03-15",
+    "bucket=day&until=2024-03-10"
+])
+def test_rollup_partial_buckets_match_raw(real_app, args):
+    client = real_app.app.test_client()
+    country = client.post("/api/countries", json = {"nume" : f"Stats {args}", "lat" : 45.0, "lon" : 25.0}).get_json()["id"]
+    city_id = client.post("/api/cities", json = {"idTara" : country, "nume" : "Stats", "lat" : 45.0, "lon" : 25.0}).get_json()["id"]
+    seed(client, city_id)
+
+    path = f"/api/temperatures/cities/{city_id}/stats?{args}"
+    rollup, raw = client.get(path).get_json(), client.get(f"{path}&source=raw").get_json()
+    assert rollup == raw
+    assert rollup
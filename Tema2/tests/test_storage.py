@@ -0,0 +1,47 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import mongomock
+import pytest
+from pymongo import MongoClient
+
+import storage
+
+
+def test_timeseries_on_regular_collection_fails():
+    db = mongomock.MongoClient().tema2scd
+    db.list_collections = lambda filter: iter([{"name" : "temperatures", "type" : "collection"}])
+
+    with pytest.raises(ValueError, match = "migrate-storage --to timeseries"):
+        storage.TimeSeriesStore(SimpleNamespace(db = db)).configure()
+
+
+@pytest.fixture
+def real_mongo(mongo_uri):
+    client = MongoClient(mongo_uri)
+    db = client.get_default_database()
+    yield SimpleNamespace(db = db)
+    client.drop_database(db)
+    client.close()
+
+def collection_type(db, name):
+    return next(db.list_collections(filter = {"name" : name}))["type"]
+
+# time-series collections can't be renamed: migrate copies them
+def test_migrate_timeseries_both_ways(real_mongo):
+    source = storage.TimeSeriesStore(real_mongo)
+    source.configure()
+    readings = [
+        {"id" : i, "valoare" : float(i), "timestamp" : datetime(2024, 3, i), "id_oras" : 1, "id_tara" : 2}
+        for i in range(1, 6)
+    ]
+    source.insert_many(readings)
+
+    assert storage.migrate(real_mongo, "timeseries", "collection", "temperatures_backup_ts") == 5
+    assert collection_type(real_mongo.db, "temperatures") == "collection"
+    assert collection_type(real_mongo.db, "temperatures_backup_ts") == "timeseries"
+    assert storage.CollectionStore(real_mongo).find_one({"id" : 3})["valoare"] == 3.0
+
+    assert storage.migrate(real_mongo, "collection", "timeseries", "temperatures_backup_flat") == 5
+    assert collection_type(real_mongo.db, "temperatures") == "timeseries"
+    assert storage.TimeSeriesStore(real_mongo).find_one({"id" : 3})["id_oras"] == 1
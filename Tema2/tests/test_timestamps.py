@@ -0,0 +1,74 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import importer
+import ingest
+import rollups
+from serialize import parse_timestamp
+from storage import PartitionedStore
+
+# 01:30 in UTC+2 is 23:30 UTC of the day (and month) before
+OFFSET_TIMESTAMP = "2024-03-01T01:30:00+02:00"
+UTC_TIMESTAMP = datetime(2024, 2, 29, 23, 30)
+
+
+def test_parse_timestamp_naive():
+    assert parse_timestamp("2024-03-01T01:30:00") == datetime(2024, 3, 1, 1, 30)
+
+def test_parse_timestamp_offset_crosses_midnight():
+    timestamp = parse_timestamp(OFFSET_TIMESTAMP)
+    assert timestamp == UTC_TIMESTAMP
+    assert timestamp.tzinfo is None
+
+def test_parse_timestamp_utc_suffix():
+    assert parse_timestamp("2024-02-29T23:30:00Z") == UTC_TIMESTAMP
+
+def test_buckets_of_offset_timestamp():
+    timestamp = parse_timestamp(OFFSET_TIMESTAMP)
+    assert rollups.day_start(timestamp) == datetime(2024, 2, 29)
+    assert rollups.month_start(timestamp) == datetime(2024, 2, 1)
+    assert PartitionedStore(None).partition_name(timestamp) == "temperatures_202402"
+
+def test_importer_offset_timestamp():
+    class Cities:
+        def resolve(self, row):
+            return 1, 2
+
+    row = importer.parse({"valoare" : 1.5, "timestamp" : OFFSET_TIMESTAMP, "idOras" : 1}, Cities())
+    assert row["timestamp"] == UTC_TIMESTAMP
+
+def test_journal_offset_timestamp():
+    line = '{"id": 1, "valoare": 1.5, "timestamp": "%s", "id_oras": 1, "id_tara": 2}' % OFFSET_TIMESTAMP
+    assert ingest.parse_journal_line(line)["timestamp"] == UTC_TIMESTAMP
+
+def test_bulk_offset_timestamp(app_module, client, city):
+    country_id, city_id = city
+    response = client.post("/api/temperatures/bulk", json = [
+        {"idOras" : city_id, "valoare" : 1.5, "timestamp" : OFFSET_TIMESTAMP}
+    ])
+    assert response.status_code == 201
+
+    reading = app_module.temperature_store.find_one({"id" : response.get_json()["results"][0]["id"]})
+    assert reading["timestamp"] == UTC_TIMESTAMP
+
+    days = app_module.mongo.db[rollups.DAILY].find({"scope" : "city", "ref_id" : city_id})
+    assert [d["bucket"] for d in days] == [datetime(2024, 2, 29)]
+    months = app_module.mongo.db[rollups.MONTHLY].find({"scope" : "country", "ref_id" : country_id})
+    assert [m["bucket"] for m in months] == [datetime(2024, 2, 1)]
+
+# readings stamped by the server are in UTC too, whatever the time zone of the host
+def test_server_timestamp_is_utc(app_module, client, city, monkeypatch):
+    country_id, city_id = city
+    monkeypatch.setenv("TZ", "Etc/GMT-9")
+    time.tzset()
+    try:
+        response = client.post("/api/temperatures", json = {"idOras" : city_id, "valoare" : 1.5})
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert response.status_code == 201
+
+    reading = app_module.temperature_store.find_one({"id" : response.get_json()["id"]})
+    utc = datetime.now(timezone.utc).replace(tzinfo = None)
+    assert abs(reading["timestamp"] - utc) < timedelta(minutes = 1)
+    assert abs(reading["changed"] - utc) < timedelta(minutes = 1)
@@ -0,0 +1,4 @@
+from app import create_app
+
+# WSGI entry point: gunicorn -c gunicorn.conf.py wsgi:application
+application = create_app()